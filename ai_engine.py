@@ -1,9 +1,39 @@
+"""
+Answer generation: knowledge-base retrieval, prompt building and the Gemini call.
 
+AIEngine depends only on what it is given:
+
+    knowledge_base    object with indexes() -> (KnowledgeIndex, VectorIndex or None) and
+                      precomputed_answer(entry) -> model-rendered answer or None
+    http_client       requests.Session-like object with post(url, headers=, data=, timeout=)
+                      (default: cassette.http_session, so traffic can be recorded and replayed)
+    history_provider  optional callable(conversation_id) -> [{"role", "content"}, ...]
+    async_http_client optional object whose post(...) is a coroutine, used by agenerate()
+    scheduler         optional llm_scheduler.LLMScheduler pacing calls to the model quotas
+                      and choosing between the primary and the fallback model
+    context_cache     optional context_cache.ContextCache holding the instruction and the
+                      whole knowledge base on the Gemini side
+
+so workers, batch evaluators and benchmarks can run it without a Flask app.
+DatabaseKnowledgeBase is the only piece that touches the app database, and it
+only needs an app context when the index is due for a refresh. Each owner
+(TrainingData.user_id) has its own knowledge base, so a prompt only carries
+that owner's pairs. generate_ai_response() keeps the original module-level
+API on shared engines backed by the database, one per owner.
+"""
 import logging
 import os
-import requests
+import copy
 import json
 import time
+import asyncio
+import threading
+from contextlib import nullcontext
+from cassette import http_session
+from context_cache import CONTEXT_CACHE, ContextCache, DatabaseHandles, GeminiCacheBackend
+from llm_scheduler import (
+    PRIORITY_INTERACTIVE, LLMOverloaded, estimate_tokens, model_name, retry_after, usage_tokens
+)
 
 logger = logging.getLogger(__name__)
 
@@ -13,32 +43,25 @@ GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY", "AIzaSyAGyzDmw9f1w-c3HM-yeUCQP
 GEMINI_25_URL = f"https://generativelanguage.googleapis.com/v1/models/gemini-2.5-flash:generateContent?key={GEMINI_API_KEY}"
 # Fallback model (1.5 Flash)
 GEMINI_15_URL = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash:generateContent?key={GEMINI_API_KEY}"
+GEMINI_TIMEOUT = 60
+# Previous turns sent to the model
+HISTORY_TURNS = 10
 
-def generate_ai_response(user_message, history=None):
-    """
-    Generate an AI response using Gemini API with context awareness and fallback mechanism.
-    """
-    context_text = ""
-    try:
-        from models import TrainingData
-        from database import db
-        from app import app
-        
-        with app.app_context():
-            context_data = TrainingData.query.all()
-            
-            if not context_data:
-                logger.warning("Training database is empty")
-                context_text = "لا توجد بيانات تدريب متوفرة حالياً."
-            else:
-                context_text = "بيانات مؤسسة الحبيب الطبية المعتمدة (يجب الالتزام بها حصرياً):\n"
-                for item in context_data:
-                    context_text += f"سؤال: {item.question}\nإجابة: {item.answer}\n---\n"
-    except Exception as e:
-        logger.error(f"Error retrieving context: {str(e)}")
-        context_text = "خطأ في استرجاع البيانات المدربة."
-
-    system_instruction = f"""
+GENERATION_CONFIG = {
+    "temperature": 0.2,
+    "topK": 40,
+    "topP": 0.95,
+    "maxOutputTokens": 2048
+}
+
+ERROR_CONNECTION = "عذراً، واجهت مشكلة في الاتصال بمحرك الذكاء الاصطناعي. يرجى المحاولة مرة أخرى بعد قليل."
+ERROR_RESPONSE = "عذراً، واجهت مشكلة في معالجة الرد. يرجى إعادة صياغة سؤالك."
+ERROR_UNEXPECTED = "عذراً، حدث خطأ غير متوقع أثناء معالجة طلبك."
+ERROR_BUSY = "عذراً، الخدمة مشغولة حالياً بسبب كثرة الطلبات. يرجى المحاولة بعد قليل."
+# Pace Gemini calls of the shared engine to the quotas stored in the database
+LLM_SCHEDULER = os.environ.get("LLM_SCHEDULER", "1") == "1"
+
+SYSTEM_INSTRUCTION = """
     أنت مساعد ذكي وخبير لمؤسسة الحبيب للمستلزمات الطبية (Al-Habib Medical Institution).
     
     قواعد العمل الصارمة:
@@ -54,47 +77,210 @@ def generate_ai_response(user_message, history=None):
     {context_text}
     """
 
-    contents = []
-    if history:
-        recent_history = history[-10:]
-        for msg in recent_history:
+class DatabaseKnowledgeBase:
+    """
+    Training data of one owner (None: every owner's) in the app database,
+    through the indexes knowledge_index keeps per owner.
+    """
+
+    def __init__(self, app=None, owner=None):
+        self.app = app
+        self.owner = owner
+
+    def _app_context(self):
+        from flask import has_app_context
+        # Callers (views, the bot loop) normally run inside an app context already
+        if has_app_context():
+            return nullcontext()
+        if self.app is None:
+            from app import app
+            self.app = app
+        return self.app.app_context()
+
+    def indexes(self):
+        from knowledge_index import cached_index, get_index
+        from vector_index import get_vector_index
+        index = cached_index(self.owner)
+        if index is None:
+            with self._app_context():
+                index = get_index(self.owner)
+        return index, get_vector_index(index)
+
+    def precomputed_answer(self, entry):
+        from precompute import cached_answers, get_answers
+        answers = cached_answers(self.owner)
+        if answers is None:
+            with self._app_context():
+                answers = get_answers(self.owner)
+        return answers.get(entry)
+
+
+class StaticKnowledgeBase:
+    """A fixed set of Q&A pairs held in memory; needs no database."""
+
+    def __init__(self, index, vectors=None):
+        self.index = index
+        self.vectors = vectors
+
+    @classmethod
+    def from_pairs(cls, pairs, vectors=True, folder=None):
+        import tempfile
+        import datetime
+        from arabic_text import token_string
+        from knowledge_index import Entry, KnowledgeIndex
+
+        index = KnowledgeIndex()
+        stamp = datetime.datetime(2024, 1, 1)
+        for entry_id, (question, answer) in enumerate(pairs, start=1):
+            index.add(Entry(entry_id, 1, question, answer, token_string(question), token_string(answer), stamp))
+        index.fingerprint = ('static', len(pairs))
+        vector_index = None
+        if vectors:
+            from vector_index import VectorIndex
+            vector_index = VectorIndex(folder=folder or tempfile.mkdtemp(prefix="kb_vectors_"))
+            vector_index.sync(index)
+        return cls(index, vector_index)
+
+    def indexes(self):
+        return self.index, self.vectors
+
+    def precomputed_answer(self, entry):
+        return None
+
+
+KB_CONTEXT_HEADER = "بيانات مؤسسة الحبيب الطبية المعتمدة (يجب الالتزام بها حصرياً):\n"
+NO_CONTEXT = "لا توجد في البيانات المعتمدة معلومات مرتبطة بهذا السؤال."
+
+
+def knowledge_prefix(index):
+    """System instruction with the whole knowledge base: the cacheable prefix of every request."""
+    parts = [KB_CONTEXT_HEADER]
+    for entry in index.entries():
+        parts.append(f"[{entry.id}] سؤال: {entry.question}\nإجابة: {entry.answer}\n---\n")
+    return SYSTEM_INSTRUCTION.format(context_text="".join(parts))
+
+
+class Prepared:
+    """Outcome of retrieval for one question: a direct answer, or the request for the model."""
+    __slots__ = ("answer", "payload", "route", "cached_payload", "prefix")
+
+    def __init__(self, answer=None, payload=None, route=None, cached_payload=None, prefix=None):
+        self.answer = answer
+        self.payload = payload
+        self.route = route
+        # With a context cache: the request without the instruction and KB, and
+        # (knowledge-base owner, version, callable building that prefix)
+        self.cached_payload = cached_payload
+        self.prefix = prefix
+
+
+class AIEngine:
+    """Retrieval-grounded answers from Gemini, with injected data sources and HTTP client."""
+
+    def __init__(self, knowledge_base, http_client=None, history_provider=None, async_http_client=None,
+                 primary_url=GEMINI_25_URL, fallback_url=GEMINI_15_URL, timeout=GEMINI_TIMEOUT,
+                 history_turns=HISTORY_TURNS, retrieval_options=None, scheduler=None,
+                 priority=PRIORITY_INTERACTIVE, context_cache=None):
+        self.knowledge_base = knowledge_base
+        self.http_client = http_client if http_client is not None else http_session("gemini")
+        self.history_provider = history_provider
+        self.async_http_client = async_http_client
+        self.primary_url = primary_url
+        self.fallback_url = fallback_url
+        self.timeout = timeout
+        self.history_turns = history_turns
+        # Overrides for retrieval.decide (limit, direct_threshold, min_threshold, grounding_candidates)
+        self.retrieval_options = retrieval_options or {}
+        self.scheduler = scheduler
+        # Priority class of calls that do not pass one (see llm_scheduler.py)
+        self.priority = priority
+        self.context_cache = context_cache
+
+    def with_knowledge_base(self, knowledge_base):
+        """An engine answering from ``knowledge_base`` with this one's clients, scheduler and cache."""
+        engine = copy.copy(self)
+        engine.knowledge_base = knowledge_base
+        return engine
+
+    def _context(self, user_message):
+        """
+        (context text, direct answer or None, route, grounding) for the question.
+        grounding is (index, ids of the grounding pairs), or None when there is
+        no usable knowledge base.
+        """
+        from retrieval import decide, render_direct_answer, ROUTE_DIRECT, ROUTE_GROUNDED
+
+        try:
+            index, vectors = self.knowledge_base.indexes()
+            if not len(index):
+                logger.warning("Training database is empty")
+                return "لا توجد بيانات تدريب متوفرة حالياً.", None, None, None
+
+            decision = decide(user_message, index, vectors, **self.retrieval_options)
+            logger.info(f"Retrieval route: {decision.route} (confidence {decision.confidence:.2f})")
+            # A near-exact match on a stored question is answered without calling the model,
+            # with the answer rendered at ingestion time when it is current (see precompute.py)
+            if decision.route == ROUTE_DIRECT:
+                rendered = self.knowledge_base.precomputed_answer(decision.best.entry)
+                return None, render_direct_answer(decision.best, rendered), decision.route, None
+            if decision.route == ROUTE_GROUNDED:
+                context_text = KB_CONTEXT_HEADER
+                for candidate in decision.candidates:
+                    context_text += f"سؤال: {candidate.entry.question}\nإجابة: {candidate.entry.answer}\n---\n"
+                return context_text, None, decision.route, (index, [c.entry.id for c in decision.candidates])
+            return NO_CONTEXT, None, decision.route, (index, [])
+        except Exception as e:
+            logger.error(f"Error retrieving context: {str(e)}")
+            return "خطأ في استرجاع البيانات المدربة.", None, None, None
+
+    def prepare(self, user_message, history=None, conversation_id=None):
+        """Run retrieval and build the Gemini request (no network I/O)."""
+        if history is None and conversation_id is not None and self.history_provider is not None:
+            history = self.history_provider(conversation_id)
+
+        context_text, answer, route, grounding = self._context(user_message)
+        if answer is not None:
+            return Prepared(answer=answer, route=route)
+
+        contents = []
+        for msg in (history or [])[-self.history_turns:]:
             role = "user" if msg["role"] == "user" else "model"
             contents.append({
                 "role": role,
                 "parts": [{"text": msg["content"]}]
             })
-    
-    current_prompt = f"{system_instruction}\n\nسؤال المستخدم الحالي: {user_message}"
-    contents.append({
-        "role": "user",
-        "parts": [{"text": current_prompt}]
-    })
-
-    payload = {
-        "contents": contents,
-        "generationConfig": {
-            "temperature": 0.2,
-            "topK": 40,
-            "topP": 0.95,
-            "maxOutputTokens": 2048
+
+        system_instruction = SYSTEM_INSTRUCTION.format(context_text=context_text)
+        current_prompt = f"{system_instruction}\n\nسؤال المستخدم الحالي: {user_message}"
+        payload = {
+            "contents": contents + [{"role": "user", "parts": [{"text": current_prompt}]}],
+            "generationConfig": GENERATION_CONFIG
         }
-    }
-    
-    headers = {"Content-Type": "application/json"}
-
-    try:
-        logger.info(f"Attempting to generate response for: {user_message[:50]}...")
-        session = requests.Session()
-        response = session.post(GEMINI_25_URL, headers=headers, data=json.dumps(payload), timeout=60)
-        
-        if response.status_code == 429:
-            logger.warning("Gemini 2.5 Flash Rate Limit. Switching to Fallback (1.5 Flash)...")
-            response = session.post(GEMINI_15_URL, headers=headers, data=json.dumps(payload), timeout=60)
-        
+        prepared = Prepared(payload=payload, route=route)
+
+        if self.context_cache is not None and grounding is not None:
+            # The cached prefix numbers every pair; the request only points at the best matches
+            index, refs = grounding
+            if refs:
+                hint = "أقرب الأسئلة في البيانات المعتمدة إلى هذا السؤال: " + "، ".join(f"[{i}]" for i in refs)
+            else:
+                hint = NO_CONTEXT
+            prepared.cached_payload = {
+                "contents": contents + [
+                    {"role": "user", "parts": [{"text": f"{hint}\n\nسؤال المستخدم الحالي: {user_message}"}]}
+                ],
+                "generationConfig": GENERATION_CONFIG
+            }
+            prepared.prefix = (index.owner, repr(index.fingerprint), lambda: knowledge_prefix(index))
+        return prepared
+
+    @staticmethod
+    def parse_response(response):
+        """Answer text of a Gemini HTTP response, or the user-facing error message."""
         if not response.ok:
             logger.error(f"Gemini API Error ({response.status_code}): {response.text}")
-            return "عذراً، واجهت مشكلة في الاتصال بمحرك الذكاء الاصطناعي. يرجى المحاولة مرة أخرى بعد قليل."
-            
+            return ERROR_CONNECTION
+
         result = response.json()
         if 'candidates' in result and len(result['candidates']) > 0:
             candidate = result['candidates'][0]
@@ -103,10 +289,255 @@ def generate_ai_response(user_message, history=None):
                 if candidate.get('finishReason') == 'MAX_TOKENS':
                     response_text += "\n\n(ملاحظة: تم اختصار الإجابة لطولها الزائد)."
                 return response_text
-        
+
         logger.error(f"Unexpected API response structure: {result}")
-        return "عذراً، واجهت مشكلة في معالجة الرد. يرجى إعادة صياغة سؤالك."
-            
-    except Exception as e:
-        logger.error(f"Error calling Gemini API: {str(e)}")
-        return "عذراً، حدث خطأ غير متوقع أثناء معالجة طلبك."
+        return ERROR_RESPONSE
+
+    def _attempts(self, cost, priority):
+        """
+        (model, url) to call, then the next one each time the previous call got
+        a 429. Without a scheduler that is the primary and then the fallback
+        URL; with one, every step is an admission decision over both models.
+        """
+        urls = {model_name(url): url for url in (self.primary_url, self.fallback_url) if url}
+        if self.scheduler is None:
+            yield from urls.items()
+            return
+        deadline = self.scheduler.deadline(priority)
+        for _ in range(len(urls) + 1):
+            model = self.scheduler.acquire(list(urls), cost, priority, deadline)
+            yield model, urls[model]
+
+    def _cost(self, prepared):
+        return estimate_tokens(prepared.payload) if self.scheduler is not None else 0
+
+    def _rate_limited(self, model, response):
+        logger.warning(f"Gemini rate limit on {model}")
+        if self.scheduler is not None:
+            self.scheduler.throttled(model, retry_after(response))
+
+    def _settle(self, model, cost, used):
+        if self.scheduler is not None:
+            self.scheduler.settle(model, cost, used)
+
+    def _cached_request(self, prepared, model, url):
+        """(url, body) referencing the cached prefix of ``model``, or None to send the full prompt."""
+        if self.context_cache is None or prepared.cached_payload is None:
+            return None
+        owner, version, build_prefix = prepared.prefix
+        name = self.context_cache.handle(model, version, build_prefix, namespace=owner)
+        if not name:
+            return None
+        # cachedContent is only accepted by the v1beta API
+        return url.replace('/v1/', '/v1beta/', 1), json.dumps(dict(prepared.cached_payload, cachedContent=name))
+
+    def _post(self, prepared, model, url, **kwargs):
+        """POST one attempt, through the cached prefix when there is one."""
+        headers = {"Content-Type": "application/json"}
+        cached = self._cached_request(prepared, model, url)
+        if cached is not None:
+            response = self.http_client.post(cached[0], headers=headers, data=cached[1], timeout=self.timeout, **kwargs)
+            if response.status_code not in (400, 403, 404):
+                return response
+            # Expired or deleted on Gemini's side: answer with the full prompt, register again next time
+            logger.warning(f"Cached prefix rejected for {model} ({response.status_code}); sending the full prompt")
+            self.context_cache.invalidate(model, namespace=prepared.prefix[0])
+        return self.http_client.post(
+            url, headers=headers, data=json.dumps(prepared.payload), timeout=self.timeout, **kwargs
+        )
+
+    async def _apost(self, prepared, model, url):
+        headers = {"Content-Type": "application/json"}
+        client = self.async_http_client
+        # Registering a prefix is a blocking call
+        cached = await asyncio.to_thread(self._cached_request, prepared, model, url)
+        if cached is not None:
+            response = await client.post(cached[0], headers=headers, data=cached[1], timeout=self.timeout)
+            if response.status_code not in (400, 403, 404):
+                return response
+            logger.warning(f"Cached prefix rejected for {model} ({response.status_code}); sending the full prompt")
+            self.context_cache.invalidate(model, namespace=prepared.prefix[0])
+        return await client.post(url, headers=headers, data=json.dumps(prepared.payload), timeout=self.timeout)
+
+    def complete(self, prepared, priority=None):
+        """Send a prepared request to Gemini and return the answer text."""
+        if prepared.answer is not None:
+            return prepared.answer
+
+        cost = self._cost(prepared)
+        try:
+            for model, url in self._attempts(cost, self.priority if priority is None else priority):
+                response = self._post(prepared, model, url)
+                if response.status_code != 429:
+                    break
+                self._rate_limited(model, response)
+
+            answer = self.parse_response(response)
+            if response.ok:
+                self._settle(model, cost, usage_tokens(response.json()))
+            return answer
+        except LLMOverloaded as e:
+            logger.warning(f"Gemini call not admitted: {e}")
+            return ERROR_BUSY
+        except Exception as e:
+            logger.error(f"Error calling Gemini API: {str(e)}")
+            return ERROR_UNEXPECTED
+
+    def generate(self, user_message, history=None, conversation_id=None, priority=None):
+        """Answer ``user_message``; never raises, failures become an apology text."""
+        prepared = self.prepare(user_message, history, conversation_id)
+        if prepared.answer is None:
+            logger.info(f"Attempting to generate response for: {user_message[:50]}...")
+        return self.complete(prepared, priority)
+
+    @staticmethod
+    def _stream_url(url):
+        url = url.replace(':generateContent', ':streamGenerateContent', 1)
+        return url + ('&' if '?' in url else '?') + 'alt=sse'
+
+    @staticmethod
+    def _stream_events(response):
+        """(text, finish reason, total tokens or None) of each server-sent event of a streaming response."""
+        for line in response.iter_lines(decode_unicode=True):
+            if not line or not line.startswith('data:'):
+                continue
+            event = json.loads(line[5:])
+            for candidate in event.get('candidates', [])[:1]:
+                parts = candidate.get('content', {}).get('parts', [])
+                yield (
+                    "".join(part.get('text', '') for part in parts), candidate.get('finishReason'), usage_tokens(event)
+                )
+
+    def stream(self, user_message, history=None, conversation_id=None, priority=None):
+        """
+        Yield the answer in pieces as Gemini produces them. A direct answer or
+        an error message is a single piece; the concatenation of the pieces
+        matches what generate() would return.
+        """
+        prepared = self.prepare(user_message, history, conversation_id)
+        if prepared.answer is not None:
+            yield prepared.answer
+            return
+
+        logger.info(f"Streaming response for: {user_message[:50]}...")
+        cost = self._cost(prepared)
+        produced = False
+        try:
+            for model, url in self._attempts(cost, self.priority if priority is None else priority):
+                response = self._post(prepared, model, self._stream_url(url), stream=True)
+                if response.status_code != 429:
+                    break
+                self._rate_limited(model, response)
+            if not response.ok:
+                logger.error(f"Gemini API Error ({response.status_code}): {response.text}")
+                yield ERROR_CONNECTION
+                return
+
+            finish_reason = None
+            used = None
+            for text, reason, usage in self._stream_events(response):
+                finish_reason = reason or finish_reason
+                used = usage or used
+                if not produced:
+                    text = text.lstrip()
+                if text:
+                    produced = True
+                    yield text
+            self._settle(model, cost, used)
+            if not produced:
+                yield ERROR_RESPONSE
+            elif finish_reason == 'MAX_TOKENS':
+                yield "\n\n(ملاحظة: تم اختصار الإجابة لطولها الزائد)."
+        except LLMOverloaded as e:
+            logger.warning(f"Gemini call not admitted: {e}")
+            yield ERROR_BUSY
+        except Exception as e:
+            logger.error(f"Error streaming from Gemini API: {str(e)}")
+            if not produced:
+                yield ERROR_UNEXPECTED
+
+    async def agenerate(self, user_message, history=None, conversation_id=None, priority=None):
+        """
+        Async variant of generate(). Retrieval runs in a worker thread; the
+        model call uses async_http_client when one was given, otherwise the
+        whole sync call runs in a thread.
+        """
+        if self.async_http_client is None:
+            return await asyncio.to_thread(self.generate, user_message, history, conversation_id, priority)
+
+        prepared = await asyncio.to_thread(self.prepare, user_message, history, conversation_id)
+        if prepared.answer is not None:
+            return prepared.answer
+
+        cost = self._cost(prepared)
+        attempts = self._attempts(cost, self.priority if priority is None else priority)
+        try:
+            while True:
+                # Waiting for quota blocks, so it happens off the event loop
+                step = await asyncio.to_thread(next, attempts, None)
+                if step is None:
+                    break
+                model, url = step
+                response = await self._apost(prepared, model, url)
+                if response.status_code != 429:
+                    break
+                self._rate_limited(model, response)
+            answer = self.parse_response(response)
+            if response.ok:
+                self._settle(model, cost, usage_tokens(response.json()))
+            return answer
+        except LLMOverloaded as e:
+            logger.warning(f"Gemini call not admitted: {e}")
+            return ERROR_BUSY
+        except Exception as e:
+            logger.error(f"Error calling Gemini API: {str(e)}")
+            return ERROR_UNEXPECTED
+
+
+_engine = None
+_owner_engines = {}
+_engine_lock = threading.Lock()
+
+
+def get_engine(owner=None):
+    """
+    The shared engine used by the web app and the bot: the database KB of
+    ``owner`` (None: every owner's rows), one pooled HTTP session, scheduler
+    and context cache for all owners.
+    """
+    global _engine
+    if owner is not None:
+        engine = _owner_engines.get(owner)
+        if engine is None:
+            shared = get_engine()
+            with _engine_lock:
+                engine = _owner_engines.get(owner)
+                if engine is None:
+                    engine = shared.with_knowledge_base(DatabaseKnowledgeBase(owner=owner))
+                    _owner_engines[owner] = engine
+        return engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                scheduler = None
+                if LLM_SCHEDULER:
+                    from llm_scheduler import default_scheduler
+                    scheduler = default_scheduler()
+                context_cache = None
+                if CONTEXT_CACHE:
+                    context_cache = ContextCache(GeminiCacheBackend(), shared=DatabaseHandles())
+                _engine = AIEngine(DatabaseKnowledgeBase(), scheduler=scheduler, context_cache=context_cache)
+    return _engine
+
+
+def stream_ai_response(user_message, history=None, priority=PRIORITY_INTERACTIVE, owner=None):
+    """Like generate_ai_response, but yields the answer in pieces as they arrive."""
+    return get_engine(owner).stream(user_message, history=history, priority=priority)
+
+
+def generate_ai_response(user_message, history=None, priority=PRIORITY_INTERACTIVE, owner=None):
+    """
+    Generate an AI response using Gemini API with context awareness and fallback mechanism,
+    grounded in the training data of ``owner`` (None: every owner's).
+    """
+    return get_engine(owner).generate(user_message, history=history, priority=priority)
@@ -1,5 +1,6 @@
 import os
 import logging
+import threading
 from flask import Flask
 from flask_login import LoginManager
 from werkzeug.middleware.proxy_fix import ProxyFix
@@ -9,6 +10,54 @@ from database import db
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# Schema work (reflection, ALTERs, backfills) runs in `python migrate.py`;
+# set AUTO_MIGRATE=1 to also run it whenever the app is created
+AUTO_MIGRATE = os.environ.get("AUTO_MIGRATE", "0") == "1"
+# Import and register the blueprints on the first request instead of at import time
+LAZY_BLUEPRINTS = os.environ.get("LAZY_BLUEPRINTS", "1") == "1"
+
+
+def register_blueprints(app):
+    from auth import auth_bp
+    from chat import chat_bp
+    from training import training_bp
+    from metrics import metrics_bp
+
+    app.register_blueprint(auth_bp)
+    app.register_blueprint(chat_bp)
+    app.register_blueprint(training_bp)
+    app.register_blueprint(metrics_bp)
+    # downloads_bp (a zip of the source tree) is deliberately not registered:
+    # accounts are self-registered, so login_required does not restrict it
+
+
+class LazyBlueprints:
+    """
+    WSGI middleware that registers the blueprints just before the first
+    request is dispatched, so processes that never serve HTTP (the Telegram
+    bot, scripts) do not import the views and everything they pull in.
+    """
+
+    def __init__(self, app, wsgi_app):
+        self.app = app
+        self.wsgi_app = wsgi_app
+        self.loaded = False
+        self._lock = threading.Lock()
+
+    def load(self):
+        if self.loaded:
+            return
+        with self._lock:
+            if not self.loaded:
+                register_blueprints(self.app)
+                self.loaded = True
+
+    def __call__(self, environ, start_response):
+        if not self.loaded:
+            self.load()
+        return self.wsgi_app(environ, start_response)
+
+
 def create_app():
     app = Flask(__name__)
     app.secret_key = os.environ.get("SESSION_SECRET", "dev_secret_key")
@@ -47,22 +96,20 @@ def create_app():
         from models import User
         return User.query.get(int(user_id))
 
-    with app.app_context():
-        import models
-        db.create_all()
-        
-        from auth import auth_bp
-        from chat import chat_bp
-        from training import training_bp
-        
-        app.register_blueprint(auth_bp)
-        app.register_blueprint(chat_bp)
-        app.register_blueprint(training_bp)
-
-        @app.route('/')
-        def index():
-            from flask import render_template
-            return render_template('index.html')
+    if AUTO_MIGRATE:
+        with app.app_context():
+            from schema import upgrade_schema
+            upgrade_schema()
+
+    if LAZY_BLUEPRINTS:
+        app.wsgi_app = LazyBlueprints(app, app.wsgi_app)
+    else:
+        register_blueprints(app)
+
+    @app.route('/')
+    def index():
+        from flask import render_template
+        return render_template('index.html')
 
     return app
 
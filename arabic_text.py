@@ -0,0 +1,69 @@
+"""
+Arabic text normalization shared by indexing, deduplication and retrieval.
+
+normalize() folds the spelling variants that make plain LIKE matching miss:
+diacritics and tatweel are removed, alef/hamza forms are unified, taa marbuta
+becomes haa and alef maqsura becomes yaa. tokenize() additionally drops
+punctuation, stop words and the common attached prefixes (و، ف، ب، ك، ل، ال).
+"""
+import re
+
+_DIACRITICS = re.compile('[\u0610-\u061a\u064b-\u065f\u0670\u06d6-\u06ed]')
+_TATWEEL = '\u0640'
+_NON_WORD = re.compile(r'[^\w]+', re.UNICODE)
+
+_CHAR_MAP = str.maketrans({
+    'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ٱ': 'ا',
+    'ؤ': 'و', 'ئ': 'ي', 'ى': 'ي', 'ة': 'ه',
+    '٠': '0', '١': '1', '٢': '2', '٣': '3', '٤': '4',
+    '٥': '5', '٦': '6', '٧': '7', '٨': '8', '٩': '9',
+    '۰': '0', '۱': '1', '۲': '2', '۳': '3', '۴': '4',
+    '۵': '5', '۶': '6', '۷': '7', '۸': '8', '۹': '9',
+    '_': ' ',
+})
+
+# Attached prefixes, longest first; stripped only when a 2+ letter stem remains
+_PREFIXES = ('وبال', 'وكال', 'ولل', 'فلل', 'وال', 'فال', 'بال', 'كال', 'لل', 'ال')
+
+# Written in normalized form (see normalize())
+STOP_WORDS = frozenset("""
+    في من الي علي عن مع هل ما ماذا متي اين كيف كم لماذا اي هو هي هم انا نحن انت انتم
+    هذا هذه ذلك تلك التي الذي الذين او ام ثم ان انه كان كانت يكون لا لم لن قد كل
+    بعض غير بين عند لدي لديكم لكم لنا به بها له لها و يا the a an of to in is are and or
+    for on with what how do does you your we our
+""".split())
+
+
+def normalize(text):
+    """Return a normalized, lower-cased form of ``text`` (punctuation kept)."""
+    if not text:
+        return ''
+    text = _DIACRITICS.sub('', text).replace(_TATWEEL, '')
+    text = text.translate(_CHAR_MAP).lower()
+    return ' '.join(text.split())
+
+
+def _strip_prefix(token):
+    for prefix in _PREFIXES:
+        if token.startswith(prefix) and len(token) - len(prefix) >= 2:
+            return token[len(prefix):]
+    return token
+
+
+def tokenize(text, keep_stop_words=False):
+    """Split text into normalized search tokens."""
+    tokens = []
+    for word in _NON_WORD.split(normalize(text)):
+        if not word:
+            continue
+        if not keep_stop_words and word in STOP_WORDS:
+            continue
+        word = _strip_prefix(word)
+        if keep_stop_words or word not in STOP_WORDS:
+            tokens.append(word)
+    return tokens
+
+
+def token_string(text):
+    """Tokens joined by single spaces; the form stored in *_norm columns."""
+    return ' '.join(tokenize(text))
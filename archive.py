@@ -0,0 +1,239 @@
+"""
+Cold storage for old chat and Telegram messages.
+
+Messages of conversations that have been inactive for ARCHIVE_AFTER_DAYS are
+moved out of the hot tables into gzip-compressed JSON-lines segment files
+under ARCHIVE_FOLDER, one or more per conversation:
+
+    <ARCHIVE_FOLDER>/<table>/<owner id>/<first id>-<last id>.jsonl.gz
+
+An ArchivedSegment row records each file with its id range, so the hot
+tables and their indexes only hold recent conversations. Archiving always
+takes every message of an inactive conversation, so the archived messages of
+a conversation are exactly its oldest ones: readers append them to the hot
+rows when a page runs past the oldest hot message.
+
+    python archive_messages.py --days 90
+"""
+import os
+import gzip
+import json
+import logging
+import datetime
+from collections import OrderedDict
+from sqlalchemy import func, select
+from database import db
+from models import ArchivedSegment, Message, TelegramMessage
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_FOLDER = os.environ.get("ARCHIVE_FOLDER") or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "instance", "archive"
+)
+# Conversations without a message for this many days are archived
+ARCHIVE_AFTER_DAYS = int(os.environ.get("ARCHIVE_AFTER_DAYS", "90"))
+# Messages per segment file
+SEGMENT_ROWS = int(os.environ.get("ARCHIVE_SEGMENT_ROWS", "5000"))
+# Decoded segments kept in memory per process
+SEGMENT_CACHE_SIZE = 32
+
+# Table -> (model, column of the conversation the messages belong to)
+ARCHIVED_TABLES = {
+    'messages': (Message, Message.conversation_id),
+    'telegram_messages': (TelegramMessage, TelegramMessage.telegram_user_id),
+}
+
+
+class ArchivedMessage:
+    """Read-only message restored from a segment; quacks like the ORM rows for templates and APIs."""
+    __slots__ = ("id", "role", "content", "created_at", "conversation_id", "telegram_user_id")
+
+    archived = True
+
+    def __init__(self, id, role, content, created_at, conversation_id=None, telegram_user_id=None):
+        self.id = id
+        self.role = role
+        self.content = content
+        self.created_at = created_at
+        self.conversation_id = conversation_id
+        self.telegram_user_id = telegram_user_id
+
+
+def _encode(row):
+    return json.dumps({
+        'id': row.id,
+        'role': row.role,
+        'content': row.content,
+        'created_at': row.created_at.isoformat() if row.created_at else None,
+    }, ensure_ascii=False)
+
+
+def _write_segment(relative, rows, folder):
+    path = os.path.join(folder, relative)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as raw:
+        with gzip.GzipFile(fileobj=raw, mode='wb', mtime=0) as out:
+            for row in rows:
+                out.write(_encode(row).encode('utf-8'))
+                out.write(b'\n')
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(tmp_path, path)
+    return os.path.getsize(path)
+
+
+_segment_cache = OrderedDict()
+
+
+def _read_segment(segment, folder):
+    key = (folder, segment.path)
+    records = _segment_cache.get(key)
+    if records is not None:
+        _segment_cache.move_to_end(key)
+        return records
+
+    owner_field = 'conversation_id' if segment.table_name == 'messages' else 'telegram_user_id'
+    records = []
+    try:
+        with gzip.open(os.path.join(folder, segment.path), 'rt', encoding='utf-8') as f:
+            for line in f:
+                data = json.loads(line)
+                created_at = data['created_at']
+                records.append(ArchivedMessage(
+                    data['id'], data['role'], data['content'],
+                    datetime.datetime.fromisoformat(created_at) if created_at else None,
+                    **{owner_field: segment.owner_id}
+                ))
+    except FileNotFoundError:
+        # ARCHIVE_FOLDER is not shared with the process that archived it, or was wiped: pages skip it
+        logger.error(f"Archive segment {segment.path} is missing from {folder}; its messages are skipped")
+        return []
+    _segment_cache[key] = records
+    if len(_segment_cache) > SEGMENT_CACHE_SIZE:
+        _segment_cache.popitem(last=False)
+    return records
+
+
+def archived_messages(table, owner_id, before=None, limit=None, folder=ARCHIVE_FOLDER):
+    """Archived messages of one conversation with id < ``before``, oldest first (the newest ``limit``)."""
+    query = ArchivedSegment.query.filter_by(table_name=table, owner_id=owner_id)
+    if before:
+        query = query.filter(ArchivedSegment.first_message_id < before)
+    result = []
+    for segment in query.order_by(ArchivedSegment.first_message_id.desc()):
+        records = _read_segment(segment, folder)
+        if before:
+            records = [r for r in records if r.id < before]
+        result[:0] = records
+        if limit and len(result) >= limit:
+            return result[-limit:]
+    return result
+
+
+def fill_page(table, owner_id, rows, before, limit, folder=ARCHIVE_FOLDER):
+    """
+    Complete a newest-first page of hot rows (fetched with ``limit + 1``)
+    with archived messages once the hot table has run out.
+    """
+    if len(rows) > limit:
+        return rows
+    oldest = rows[-1].id if rows else before
+    older = archived_messages(table, owner_id, before=oldest, limit=limit + 1 - len(rows), folder=folder)
+    return rows + older[::-1]
+
+
+def archived_counts(table, owner_ids):
+    """{owner id: number of archived messages} for the given conversations."""
+    if not owner_ids:
+        return {}
+    rows = db.session.query(ArchivedSegment.owner_id, func.sum(ArchivedSegment.row_count)).filter(
+        ArchivedSegment.table_name == table, ArchivedSegment.owner_id.in_(owner_ids)
+    ).group_by(ArchivedSegment.owner_id)
+    return {owner_id: int(count) for owner_id, count in rows}
+
+
+def total_archived(table):
+    return int(db.session.query(func.coalesce(func.sum(ArchivedSegment.row_count), 0)).filter(
+        ArchivedSegment.table_name == table
+    ).scalar())
+
+
+def inactive_owners(table, cutoff, limit=None):
+    """Conversations whose newest hot message is older than ``cutoff``."""
+    model, owner = ARCHIVED_TABLES[table]
+    query = select(owner).group_by(owner).having(func.max(model.created_at) < cutoff).order_by(owner)
+    if limit:
+        query = query.limit(limit)
+    return [owner_id for (owner_id,) in db.session.execute(query)]
+
+
+def archive_owner(table, owner_id, folder=ARCHIVE_FOLDER, segment_rows=SEGMENT_ROWS):
+    """Move every hot message of one conversation into segment files. Returns (messages, bytes)."""
+    model, owner = ARCHIVED_TABLES[table]
+    archived = written = 0
+    while True:
+        rows = model.query.filter(owner == owner_id).order_by(model.id).limit(segment_rows).all()
+        if not rows:
+            break
+        first_id, last_id = rows[0].id, rows[-1].id
+        relative = f"{table}/{owner_id}/{first_id}-{last_id}.jsonl.gz"
+        size = _write_segment(relative, rows, folder)
+        try:
+            db.session.add(ArchivedSegment(
+                table_name=table, owner_id=owner_id, path=relative,
+                first_message_id=first_id, last_message_id=last_id, row_count=len(rows), size_bytes=size,
+                first_created_at=rows[0].created_at, last_created_at=rows[-1].created_at
+            ))
+            model.query.filter(owner == owner_id, model.id.between(first_id, last_id)).delete(
+                synchronize_session=False
+            )
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            os.remove(os.path.join(folder, relative))
+            raise
+        archived += len(rows)
+        written += size
+        if len(rows) < segment_rows:
+            break
+    return archived, written
+
+
+def archive_inactive(days=ARCHIVE_AFTER_DAYS, folder=ARCHIVE_FOLDER, limit=None, dry_run=False):
+    """Archive every conversation idle for ``days``. Returns a summary dict per table."""
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+    report = {}
+    for table in ARCHIVED_TABLES:
+        owners = inactive_owners(table, cutoff, limit)
+        summary = {'conversations': len(owners), 'messages': 0, 'bytes': 0}
+        if not dry_run:
+            for owner_id in owners:
+                messages, size = archive_owner(table, owner_id, folder)
+                summary['messages'] += messages
+                summary['bytes'] += size
+            if owners:
+                logger.info(f"Archived {summary['messages']} {table} rows of {len(owners)} conversations")
+        report[table] = summary
+    return report
+
+
+def drop_archived(table, owner_id, folder=ARCHIVE_FOLDER):
+    """
+    Delete the segment rows of a conversation in the caller's transaction.
+    Returns the file paths, to be removed once the transaction has committed.
+    """
+    segments = ArchivedSegment.query.filter_by(table_name=table, owner_id=owner_id).all()
+    paths = [os.path.join(folder, s.path) for s in segments]
+    for segment in segments:
+        _segment_cache.pop((folder, segment.path), None)
+        db.session.delete(segment)
+    return paths
+
+
+def remove_files(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
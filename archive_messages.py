@@ -0,0 +1,35 @@
+"""
+Move messages of inactive conversations into compressed cold storage
+(see archive.archive_inactive).
+
+Meant to run periodically, e.g. from cron:
+
+    python archive_messages.py               # archive conversations idle for ARCHIVE_AFTER_DAYS
+    python archive_messages.py --days 30
+    python archive_messages.py --dry-run     # only report
+"""
+import sys
+import argparse
+from app import app
+from archive import archive_inactive, ARCHIVE_AFTER_DAYS
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--days", type=int, default=ARCHIVE_AFTER_DAYS, help="inactivity before a conversation is archived")
+    parser.add_argument("--limit", type=int, help="at most this many conversations per table")
+    parser.add_argument("--dry-run", action="store_true", help="report what would be archived")
+    args = parser.parse_args(argv)
+
+    with app.app_context():
+        report = archive_inactive(days=args.days, limit=args.limit, dry_run=args.dry_run)
+    for table, summary in report.items():
+        if args.dry_run:
+            print(f"{table}: {summary['conversations']} conversations would be archived")
+        else:
+            print(f"{table}: {summary['messages']} messages of {summary['conversations']} conversations "
+                  f"archived into {summary['bytes']} bytes")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,448 @@
+"""
+Offline benchmarks for the chatbot's hot paths.
+
+Runs against a throwaway SQLite database and fake network calls, so it can be
+executed anywhere without Telegram or Gemini credentials:
+
+    python benchmark.py telegram --chats 50 --messages 10
+    python benchmark.py queue --consumers 1 2 4 8 --latency-ms 200
+    python benchmark.py vectors --sizes 10000 100000
+    python benchmark.py reingest --pairs 5000 --edits 3
+    python benchmark.py corpus --sizes 10000 100000
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+_tmp_dir = tempfile.mkdtemp(prefix="alhabib_bench_")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(_tmp_dir, 'bench.db')}")
+# The throwaway database needs its schema created when the app is
+os.environ.setdefault("AUTO_MIGRATE", "1")
+
+
+class RoundTripCounter:
+    """Counts statements and commits sent to the database engine."""
+
+    def __init__(self, engine):
+        from sqlalchemy import event
+        self.statements = 0
+        self.commits = 0
+        event.listen(engine, "before_cursor_execute", self._on_execute)
+        event.listen(engine, "commit", self._on_commit)
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements += 1
+
+    def _on_commit(self, conn):
+        self.commits += 1
+
+    def reset(self):
+        self.statements = 0
+        self.commits = 0
+
+    @property
+    def round_trips(self):
+        return self.statements + self.commits
+
+
+def _fake_update(update_id, chat_id, text):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "chat": {"id": chat_id, "first_name": f"Customer {chat_id}"},
+            "text": text
+        }
+    }
+
+
+def bench_telegram(args):
+    import telegram_bot
+    import ai_engine
+    from app import app, db
+    from models import TelegramMessage, TelegramUser
+    from telegram_store import TelegramStore
+
+    telegram_bot.send_message = lambda *a, **kw: None
+    telegram_bot.send_chat_action = lambda *a, **kw: None
+    ai_engine.generate_ai_response = lambda text, history=None, **kw: f"رد تجريبي على: {text}"
+    ai_engine.stream_ai_response = lambda text, history=None, **kw: iter([f"رد تجريبي على: {text}"])
+
+    with app.app_context():
+        counter = RoundTripCounter(db.engine)
+
+    print(f"{'mode':<22}{'phase':<8}{'msgs':>7}{'stmts/msg':>11}{'commits/msg':>13}{'trips/msg':>11}{'ms/msg':>9}")
+    for label, batch_size in (("unit-of-work", 0), (f"write-behind({args.batch})", args.batch)):
+        with app.app_context():
+            TelegramMessage.query.delete()
+            TelegramUser.query.delete()
+            db.session.commit()
+        telegram_bot.store = TelegramStore(batch_size=batch_size)
+
+        update_id = 1
+        for phase, rounds in (("cold", 1), ("warm", args.messages - 1)):
+            counter.reset()
+            started = time.perf_counter()
+            sent = 0
+            for _ in range(rounds):
+                batch = []
+                for chat in range(args.chats):
+                    batch.append(_fake_update(update_id, 1000 + chat, "ما هو رقم التواصل؟"))
+                    update_id += 1
+                telegram_bot.handle_updates({"ok": True, "result": batch})
+                sent += len(batch)
+            with app.app_context():
+                telegram_bot.store.flush(force=True)
+            elapsed = time.perf_counter() - started
+            if not sent:
+                continue
+            print(
+                f"{label:<22}{phase:<8}{sent:>7}{counter.statements / sent:>11.2f}"
+                f"{counter.commits / sent:>13.2f}{counter.round_trips / sent:>11.2f}{elapsed * 1000 / sent:>9.2f}"
+            )
+
+        with app.app_context():
+            stored = TelegramMessage.query.count()
+        expected = args.chats * args.messages * 2
+        if stored != expected:
+            print(f"  !! expected {expected} stored messages, found {stored}")
+
+
+class _RandomEmbedder:
+    """Stands in for a real embedder when only index search cost is measured."""
+    name = "bench-random"
+
+    def __init__(self, dim):
+        import numpy as np
+        self.dim = dim
+        self._rng = np.random.default_rng(0)
+
+    def embed(self, texts):
+        import numpy as np
+        vectors = self._rng.standard_normal((len(texts), self.dim)).astype(np.float32)
+        return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+class _SyntheticCorpus:
+    """The parts of KnowledgeIndex that VectorIndex.sync() reads."""
+
+    def __init__(self, size):
+        from knowledge_index import Entry
+        self.fingerprint = ("synthetic", size)
+        self._entries = {i: Entry(i, 1, f"q{i}", f"a{i}", "", "", None) for i in range(1, size + 1)}
+
+    def stamps(self):
+        return {i: e.updated_at for i, e in self._entries.items()}
+
+    def get(self, entry_id):
+        return self._entries.get(entry_id)
+
+
+def _percentiles(samples, points=(50, 95, 99)):
+    ordered = sorted(samples)
+    return [ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] for p in points]
+
+
+def bench_vectors(args):
+    import vector_index
+    from vector_index import VectorIndex, HashingEmbedder
+
+    embedder = HashingEmbedder()
+    texts = [f"كيف يمكنني التواصل مع مؤسسة الحبيب الطبية بخصوص الطلب رقم {i}" for i in range(1000)]
+    started = time.perf_counter()
+    embedder.embed(texts)
+    print(f"hashing embedder: {(time.perf_counter() - started) * 1000 / len(texts):.3f} ms/text")
+
+    print(f"{'size':>8}{'dtype':>9}{'layout':>8}{'build s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for size in args.sizes:
+        for dtype in ("float32", "int8"):
+            folder = tempfile.mkdtemp(prefix="vectors_", dir=_tmp_dir)
+            index = VectorIndex(embedder=_RandomEmbedder(args.dim), folder=folder, dtype=dtype)
+            started = time.perf_counter()
+            index.sync(_SyntheticCorpus(size), batch_size=8192)
+            index.search("warm-up", 1)
+            build = time.perf_counter() - started
+
+            queries = index.embedder.embed(["q"] * args.queries)
+            latencies = []
+            original_embed = index.embedder.embed
+            for q in queries:
+                index.embedder.embed = lambda texts, q=q: q[None, :]
+                started = time.perf_counter()
+                index.search("q", 10)
+                latencies.append((time.perf_counter() - started) * 1000)
+            index.embedder.embed = original_embed
+
+            layout = "ivf" if index.ivf is not None else "flat"
+            p50, p95, p99 = _percentiles(latencies)
+            print(f"{size:>8}{dtype:>9}{layout:>8}{build:>9.2f}{p50:>9.3f}{p95:>9.3f}{p99:>9.3f}")
+
+
+def bench_reingest(args):
+    import random
+    from app import app, db
+    from models import User, TrainingData
+    from reingest import reingest_source
+
+    rng = random.Random(0)
+    words = "جهاز فحص دم مختبر صيانة ضمان عرض سعر توريد مستشفى عناية مركزة تخدير اشعة موجات مراقبة".split()
+
+    def sentence(n):
+        return " ".join(rng.choice(words) for _ in range(n))
+
+    pairs = [(f"{sentence(6)} رقم {i}؟", sentence(25)) for i in range(args.pairs)]
+    def snapshot(user_id):
+        return dict(db.session.query(TrainingData.id, TrainingData.updated_at).filter_by(user_id=user_id))
+
+    with app.app_context():
+        counter = RoundTripCounter(db.engine)
+        user = User.query.filter_by(username="bench").first()
+        if user is None:
+            user = User(username="bench", email="bench@example.com")
+            user.set_password("bench")
+            db.session.add(user)
+            db.session.commit()
+        TrainingData.query.filter_by(user_id=user.id).delete()
+        db.session.commit()
+
+        print(f"{'run':<18}{'added':>7}{'changed':>9}{'removed':>9}{'unchanged':>11}"
+              f"{'rows touched':>14}{'stmts':>8}{'s':>8}")
+        edited = list(pairs)
+        for i in rng.sample(range(len(edited)), args.edits):
+            question, answer = edited[i]
+            edited[i] = (question, answer + " (محدث)")
+        for label, version in (("initial load", pairs), ("same file", pairs), (f"{args.edits} edits", edited)):
+            before = snapshot(user.id)
+            counter.reset()
+            started = time.perf_counter()
+            report = reingest_source(user.id, "bench.txt", version)
+            elapsed = time.perf_counter() - started
+            statements = counter.statements
+            after = snapshot(user.id)
+            # Rows whose update stamp changed, appeared or disappeared: what the indexes reload
+            touched = len(before.keys() ^ after.keys()) + sum(
+                1 for i in before.keys() & after.keys() if before[i] != after[i]
+            )
+            print(f"{label:<18}{report['added']:>7}{report['changed']:>9}{report['removed']:>9}"
+                  f"{report['unchanged']:>11}{touched:>14}{statements:>8}{elapsed:>8.2f}")
+
+
+def _measure(load):
+    """
+    (result, seconds, retained bytes, peak bytes, GC-tracked objects, ms added
+    to a full collection) of ``load()``.
+    """
+    import gc
+    import tracemalloc
+
+    def collect_ms():
+        started = time.perf_counter()
+        gc.collect()
+        return (time.perf_counter() - started) * 1000
+
+    baseline_ms = min(collect_ms() for _ in range(3))
+    objects = len(gc.get_objects())
+    started = time.perf_counter()
+    result = load()
+    elapsed = time.perf_counter() - started
+    objects = len(gc.get_objects()) - objects
+    added_ms = min(collect_ms() for _ in range(3)) - baseline_ms
+    del result
+    gc.collect()
+
+    # Memory in a second run: tracing slows the load down
+    tracemalloc.start()
+    result = load()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, retained, peak, objects, added_ms
+
+
+def bench_corpus(args):
+    import gc
+    import random
+    from sqlalchemy import insert
+    from app import app, db
+    from models import User, TrainingData
+    from arabic_text import token_string
+    from corpus_store import CorpusStore
+
+    rng = random.Random(0)
+    words = "جهاز فحص دم مختبر صيانة ضمان عرض سعر توريد مستشفى عناية مركزة تخدير اشعة موجات مراقبة".split()
+
+    def sentence(n):
+        return " ".join(rng.choice(words) for _ in range(n))
+
+    with app.app_context():
+        user = User.query.filter_by(username="bench").first()
+        if user is None:
+            user = User(username="bench", email="bench@example.com")
+            user.set_password("bench")
+            db.session.add(user)
+            db.session.commit()
+
+        def orm():
+            return TrainingData.query.filter_by(user_id=user.id).all()
+
+        def dicts():
+            return [{
+                "id": row.id, "question": row.question, "answer": row.answer,
+                "question_norm": row.question_norm, "answer_norm": row.answer_norm, "updated_at": row.updated_at
+            } for row in TrainingData.query.filter_by(user_id=user.id)]
+
+        approaches = (("query.all()", orm), ("list of dicts", dicts), ("CorpusStore", lambda: CorpusStore.load(user.id)))
+        print(f"{'rows':>8}  {'approach':<15}{'text MiB':>10}{'held MiB':>10}{'peak MiB':>10}"
+              f"{'objects':>10}{'gc ms':>8}{'load s':>8}")
+        for size in args.sizes:
+            TrainingData.query.filter_by(user_id=user.id).delete()
+            db.session.commit()
+            for start in range(0, size, 10000):
+                batch = []
+                for i in range(start, min(size, start + 10000)):
+                    question, answer = f"{sentence(6)} رقم {i}؟", sentence(25)
+                    batch.append({
+                        "user_id": user.id, "question": question, "answer": answer, "source_type": "file",
+                        "question_norm": token_string(question), "answer_norm": token_string(answer)
+                    })
+                db.session.execute(insert(TrainingData), batch)
+                db.session.commit()
+
+            # UTF-8 bytes of the four text fields: what any representation has to hold
+            text = len(CorpusStore.load(user.id).text)
+            for label, load in approaches:
+                result, elapsed, retained, peak, objects, collect_ms = _measure(load)
+                print(f"{size:>8}  {label:<15}{text / 2 ** 20:>10.1f}{retained / 2 ** 20:>10.1f}{peak / 2 ** 20:>10.1f}"
+                      f"{objects:>10}{collect_ms:>8.1f}{elapsed:>8.2f}")
+                del result
+                # The ORM run leaves its instances in the session's identity map
+                db.session.expunge_all()
+                gc.collect()
+
+
+def _queue_consumer(latency_ms, ready, go, done):
+    """One bot consumer process with a fake LLM that takes ``latency_ms`` per answer."""
+    import logging
+    import telegram_bot
+    import ai_engine
+
+    logging.disable(logging.WARNING)
+
+    def answer(text, history=None, **kw):
+        time.sleep(latency_ms / 1000)
+        return f"رد تجريبي على: {text}"
+
+    telegram_bot.send_message = lambda *a, **kw: None
+    telegram_bot.send_chat_action = lambda *a, **kw: None
+    ai_engine.generate_ai_response = answer
+    ai_engine.stream_ai_response = lambda text, history=None, **kw: iter([answer(text)])
+    ready.set()
+    go.wait()
+    telegram_bot.consume(idle_sleep=0.05, until_empty=True)
+    done.set()
+
+
+def bench_queue(args):
+    import multiprocessing
+    import telegram_queue
+    from app import app, db
+    from models import TelegramMessage, TelegramUpdate, TelegramUser
+    from telegram_store import TelegramStore
+
+    with app.app_context():
+        TelegramStore().load_offset()
+        telegram_queue.ensure_partitions()
+
+    ctx = multiprocessing.get_context("spawn")
+    total = args.chats * args.messages
+    print(f"{args.chats} chats x {args.messages} messages, fake LLM {args.latency_ms} ms per answer")
+    print(f"{'consumers':>10}{'msgs':>7}{'seconds':>9}{'msgs/s':>9}{'speedup':>9}")
+    baseline = None
+    for consumers in args.consumers:
+        with app.app_context():
+            TelegramUpdate.query.delete()
+            TelegramMessage.query.delete()
+            TelegramUser.query.delete()
+            db.session.commit()
+            # Interleaved like real traffic: the n-th message of every chat, then the next
+            updates = [
+                _fake_update(1 + n * args.chats + chat, 1000 + chat, f"سؤال رقم {n}")
+                for n in range(args.messages) for chat in range(args.chats)
+            ]
+            telegram_queue.enqueue(updates)
+
+        ready = [ctx.Event() for _ in range(consumers)]
+        done = [ctx.Event() for _ in range(consumers)]
+        go = ctx.Event()
+        processes = [
+            ctx.Process(target=_queue_consumer, args=(args.latency_ms, r, go, d)) for r, d in zip(ready, done)
+        ]
+        for process in processes:
+            process.start()
+        # Timed from when every consumer is up until the last one has drained the queue
+        for r in ready:
+            r.wait()
+        started = time.perf_counter()
+        go.set()
+        for d in done:
+            d.wait()
+        elapsed = time.perf_counter() - started
+        for process in processes:
+            process.join()
+
+        with app.app_context():
+            stored = TelegramMessage.query.filter_by(role="user").order_by(TelegramMessage.id).all()
+            left = telegram_queue.pending_count()
+        # Each chat's messages must be stored in the order they were sent
+        last_seen = {}
+        out_of_order = 0
+        for message in stored:
+            if message.update_id < last_seen.get(message.telegram_user_id, 0):
+                out_of_order += 1
+            last_seen[message.telegram_user_id] = message.update_id
+        throughput = total / elapsed
+        baseline = baseline or throughput
+        print(f"{consumers:>10}{total:>7}{elapsed:>9.2f}{throughput:>9.1f}{throughput / baseline:>8.2f}x")
+        if len(stored) != total or left or out_of_order:
+            print(f"  !! stored {len(stored)}/{total} messages, {left} left in the queue, {out_of_order} out of order")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    telegram = sub.add_parser("telegram", help="DB round trips per Telegram message")
+    telegram.add_argument("--chats", type=int, default=50)
+    telegram.add_argument("--messages", type=int, default=10, help="messages per chat")
+    telegram.add_argument("--batch", type=int, default=20, help="write-behind batch size")
+    telegram.set_defaults(func=bench_telegram)
+
+    queue = sub.add_parser("queue", help="Telegram throughput with N consumer processes on the update queue")
+    queue.add_argument("--consumers", type=int, nargs="+", default=[1, 2, 4, 8])
+    queue.add_argument("--chats", type=int, default=32)
+    queue.add_argument("--messages", type=int, default=5, help="messages per chat")
+    queue.add_argument("--latency-ms", type=int, default=200, help="fake LLM time per answer")
+    queue.set_defaults(func=bench_queue)
+
+    vectors = sub.add_parser("vectors", help="Vector index search latency (excluding query embedding)")
+    vectors.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    vectors.add_argument("--dim", type=int, default=256)
+    vectors.add_argument("--queries", type=int, default=200)
+    vectors.set_defaults(func=bench_vectors)
+
+    reingest = sub.add_parser("reingest", help="Rows written when a training file is re-ingested")
+    reingest.add_argument("--pairs", type=int, default=5000)
+    reingest.add_argument("--edits", type=int, default=3)
+    reingest.set_defaults(func=bench_reingest)
+
+    corpus = sub.add_parser("corpus", help="Memory of the loaded training data: ORM rows against CorpusStore")
+    corpus.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    corpus.set_defaults(func=bench_corpus)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,172 @@
+"""
+Record/replay of outbound HTTP traffic (Gemini and Telegram).
+
+Every outbound client is created through http_session(name). Normally that
+is a plain requests.Session; with HTTP_CASSETTE set it is a CassetteSession:
+
+    record   requests go to the network and each request/response pair is
+             appended, with its duration, to <HTTP_CASSETTE_DIR>/<name>.jsonl.gz
+    replay   responses are served from that file without any network access,
+             after the recorded duration times HTTP_CASSETTE_LATENCY_SCALE
+             (1 = original timings, 0 = immediately)
+
+Requests are keyed by a hash of the method, the URL without credentials
+(Gemini key, Telegram bot token) and the JSON body with sorted keys, so the
+same logical request matches across runs. Pairs recorded several times under
+one key (polling, typing actions) are replayed in their recorded order.
+
+    HTTP_CASSETTE=record python evaluate.py --llm live
+    HTTP_CASSETTE=replay HTTP_CASSETTE_LATENCY_SCALE=0 python evaluate.py --llm live
+"""
+import os
+import re
+import gzip
+import json
+import time
+import logging
+import threading
+from hashlib import sha256
+import requests
+
+logger = logging.getLogger(__name__)
+
+CASSETTE_MODE = os.environ.get("HTTP_CASSETTE", "")  # '', 'record' or 'replay'
+CASSETTE_DIR = os.environ.get("HTTP_CASSETTE_DIR") or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "instance", "cassettes"
+)
+LATENCY_SCALE = float(os.environ.get("HTTP_CASSETTE_LATENCY_SCALE", "1.0"))
+
+_SECRETS = (
+    (re.compile(r'([?&]key=)[^&]+'), r'\1KEY'),
+    (re.compile(r'(/bot)[^/]+'), r'\1TOKEN'),
+)
+
+
+class CassetteMiss(requests.ConnectionError):
+    """A replayed request that was never recorded."""
+
+
+def redact_url(url):
+    for pattern, replacement in _SECRETS:
+        url = pattern.sub(replacement, url)
+    return url
+
+
+def _normalize_body(data=None, json_body=None):
+    if json_body is not None:
+        body = json_body
+    elif data is None:
+        return ""
+    else:
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        try:
+            body = json.loads(data)
+        except (TypeError, ValueError):
+            return data if isinstance(data, str) else json.dumps(data, sort_keys=True)
+    return json.dumps(body, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+
+
+def request_key(method, url, data=None, json_body=None, params=None):
+    url = redact_url(url)
+    if params:
+        url += "?" + "&".join(f"{k}={params[k]}" for k in sorted(params))
+    payload = f"{method.upper()} {url}\n{_normalize_body(data, json_body)}"
+    return sha256(payload.encode('utf-8')).hexdigest()[:32]
+
+
+def _build_response(record, url):
+    response = requests.Response()
+    response.status_code = record['status']
+    response._content = record['body'].encode('utf-8')
+    # Lets iter_lines()/iter_content() of streamed requests read the recorded body
+    response._content_consumed = True
+    response.encoding = 'utf-8'
+    response.headers['Content-Type'] = record.get('content_type') or 'application/json'
+    response.url = url
+    return response
+
+
+class CassetteSession:
+    """requests.Session stand-in that records to or replays from a cassette file."""
+
+    def __init__(self, path, mode, session=None, latency_scale=LATENCY_SCALE):
+        if mode not in ('record', 'replay'):
+            raise ValueError(f"Unknown cassette mode: {mode}")
+        self.path = path
+        self.mode = mode
+        self.latency_scale = latency_scale
+        self.session = session if session is not None else requests.Session()
+        self._lock = threading.Lock()
+        self._recorded = {}  # key -> [records]
+        self._played = {}    # key -> next position
+        if mode == 'replay':
+            self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            raise FileNotFoundError(f"No cassette at {self.path}; record one with HTTP_CASSETTE=record")
+        # Recording appends one gzip member per pair; gzip reads them as one stream
+        with gzip.open(self.path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    self._recorded.setdefault(record['key'], []).append(record)
+        logger.info(f"Loaded {sum(map(len, self._recorded.values()))} recorded requests from {self.path}")
+
+    def _append(self, record):
+        line = json.dumps(record, ensure_ascii=False, separators=(',', ':')) + "\n"
+        member = gzip.compress(line.encode('utf-8'), mtime=0)
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            # One write per member on an O_APPEND file, so parallel recorders do not interleave
+            with open(self.path, 'ab') as f:
+                f.write(member)
+
+    def _replay(self, key, method, url):
+        with self._lock:
+            records = self._recorded.get(key)
+            if not records:
+                raise CassetteMiss(f"No recorded response for {method.upper()} {redact_url(url)}")
+            position = self._played.get(key, 0)
+            record = records[min(position, len(records) - 1)]
+            self._played[key] = position + 1
+        if self.latency_scale:
+            time.sleep(record['elapsed'] * self.latency_scale)
+        return _build_response(record, url)
+
+    def request(self, method, url, data=None, json=None, params=None, **kwargs):
+        key = request_key(method, url, data, json, params)
+        if self.mode == 'replay':
+            return self._replay(key, method, url)
+
+        started = time.perf_counter()
+        response = self.session.request(method, url, data=data, json=json, params=params, **kwargs)
+        self._append({
+            'key': key,
+            'method': method.upper(),
+            'url': redact_url(url),
+            'status': response.status_code,
+            'content_type': response.headers.get('Content-Type'),
+            'body': response.text,
+            'elapsed': round(time.perf_counter() - started, 4),
+        })
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, data=None, json=None, **kwargs):
+        return self.request('POST', url, data=data, json=json, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+def http_session(name, mode=None, folder=None, latency_scale=None):
+    """The outbound HTTP client for one upstream (e.g. 'gemini', 'telegram')."""
+    mode = CASSETTE_MODE if mode is None else mode
+    if not mode:
+        return requests.Session()
+    path = os.path.join(folder or CASSETTE_DIR, f"{name}.jsonl.gz")
+    return CassetteSession(path, mode, latency_scale=LATENCY_SCALE if latency_scale is None else latency_scale)
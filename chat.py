@@ -1,37 +1,157 @@
 import logging
 import json
+import datetime
 from flask import Blueprint, render_template, request, jsonify, redirect, url_for, flash
 from flask_login import login_required, current_user
-from models import Conversation, Message, TelegramUser, TelegramMessage, AppSetting
+from sqlalchemy import false
+from models import Conversation, Message, TelegramUser, TelegramMessage, AppSetting, TrainingData, TrainingFile
 from database import db
-from ai_engine import generate_ai_response
+from ai_engine import HISTORY_TURNS, generate_ai_response
+from intent_router import count_keys, route_message
+from stats import get_counter, increment, stats_cache
+from search import search_messages, search_telegram_messages, telegram_user_filter, highlight
+from archive import archived_messages, archived_counts, drop_archived, fill_page, remove_files
 
 chat_bp = Blueprint('chat', __name__)
 logger = logging.getLogger(__name__)
 
+# Page sizes for the admin listings (keyset pagination on the primary key)
+CUSTOMERS_PAGE_SIZE = 50
+MESSAGES_PAGE_SIZE = 100
+
+def _dashboard_stats(user_id):
+    return {
+        'telegram_users_count': get_counter('telegram_users'),
+        'total_messages': get_counter('telegram_messages'),
+        'training_count': TrainingData.query.filter_by(user_id=user_id).count(),
+        'files_count': TrainingFile.query.filter_by(user_id=user_id).count(),
+    }
+
 @chat_bp.route('/dashboard')
 @login_required
 def dashboard():
-    # Basic stats for dashboard
-    telegram_users_count = TelegramUser.query.count()
-    total_messages = TelegramMessage.query.count()
-    return render_template('dashboard.html', 
-                         telegram_users_count=telegram_users_count, 
-                         total_messages=total_messages)
+    # Counters are maintained by the bot and the result is cached for a few seconds
+    stats = stats_cache.get(('dashboard', current_user.id), lambda: _dashboard_stats(current_user.id))
+    return render_template('dashboard.html', **stats)
 
 @chat_bp.route('/admin/telegram')
 @login_required
 def telegram_admin():
-    users = TelegramUser.query.order_by(TelegramUser.created_at.desc()).all()
+    search = request.args.get('q', '').strip()
+    before = request.args.get('before', type=int)
+
+    query = TelegramUser.query
+    if search:
+        # Word-prefix match through the full-text index (see search.py)
+        matches = telegram_user_filter(search)
+        query = query.filter(matches if matches is not None else false())
+    if before:
+        query = query.filter(TelegramUser.id < before)
+
+    # Newest customers first; fetch one extra row to know whether another page exists
+    users = query.order_by(TelegramUser.id.desc()).limit(CUSTOMERS_PAGE_SIZE + 1).all()
+    next_before = users[CUSTOMERS_PAGE_SIZE - 1].id if len(users) > CUSTOMERS_PAGE_SIZE else None
+    users = users[:CUSTOMERS_PAGE_SIZE]
+
     admin_id = AppSetting.get_setting("admin_telegram_id", "")
-    return render_template('telegram_admin.html', users=users, admin_id=admin_id)
+    return render_template('telegram_admin.html', users=users, admin_id=admin_id,
+                           search=search, before=before, next_before=next_before)
 
 @chat_bp.route('/admin/telegram/user/<int:user_id>')
 @login_required
 def telegram_user_messages(user_id):
     user = TelegramUser.query.get_or_404(user_id)
-    messages = TelegramMessage.query.filter_by(telegram_user_id=user.id).order_by(TelegramMessage.created_at.asc()).all()
-    return render_template('telegram_messages.html', user=user, messages=messages)
+    before = request.args.get('before', type=int)
+
+    query = TelegramMessage.query.filter_by(telegram_user_id=user.id)
+    if before:
+        query = query.filter(TelegramMessage.id < before)
+
+    # Latest page of the conversation, displayed oldest to newest; old pages come from the archive
+    page = query.order_by(TelegramMessage.id.desc()).limit(MESSAGES_PAGE_SIZE + 1).all()
+    page = fill_page('telegram_messages', user.id, page, before, MESSAGES_PAGE_SIZE)
+    older_before = page[MESSAGES_PAGE_SIZE - 1].id if len(page) > MESSAGES_PAGE_SIZE else None
+    messages = list(reversed(page[:MESSAGES_PAGE_SIZE]))
+
+    return render_template('telegram_messages.html', user=user, messages=messages,
+                           before=before, older_before=older_before)
+
+def _search_filters():
+    """Date range from ?date_from=YYYY-MM-DD&date_to=YYYY-MM-DD (inclusive); None if malformed."""
+    try:
+        date_from = request.args.get('date_from')
+        date_to = request.args.get('date_to')
+        date_from = datetime.datetime.strptime(date_from, '%Y-%m-%d') if date_from else None
+        date_to = datetime.datetime.strptime(date_to, '%Y-%m-%d') + datetime.timedelta(days=1) if date_to else None
+    except ValueError:
+        return None
+    return {
+        'date_from': date_from,
+        'date_to': date_to,
+        'before': request.args.get('before', type=int),
+        'limit': request.args.get('limit', type=int),
+    }
+
+@chat_bp.route('/admin/telegram/search')
+@login_required
+def telegram_search():
+    search = request.args.get('q', '').strip()
+    user_id = request.args.get('user_id', type=int)
+    filters = _search_filters()
+    if filters is None:
+        flash('صيغة التاريخ غير صحيحة، استخدم YYYY-MM-DD', 'danger')
+        return redirect(url_for('chat.telegram_search', q=search, user_id=user_id))
+
+    customer = TelegramUser.query.get_or_404(user_id) if user_id else None
+    messages, terms, next_before = search_telegram_messages(search, telegram_user_id=user_id, **filters)
+    customers = {u.id: u for u in TelegramUser.query.filter(
+        TelegramUser.id.in_({m.telegram_user_id for m in messages})
+    )} if messages else {}
+    results = [(m, customers.get(m.telegram_user_id), highlight(m.content, terms)) for m in messages]
+    return render_template('telegram_search.html', search=search, customer=customer, results=results,
+                           date_from=request.args.get('date_from', ''), date_to=request.args.get('date_to', ''),
+                           before=filters['before'], next_before=next_before)
+
+@chat_bp.route('/api/search/telegram', methods=['GET'])
+@login_required
+def api_search_telegram():
+    filters = _search_filters()
+    if filters is None:
+        return jsonify({'error': 'Dates must be YYYY-MM-DD'}), 400
+    messages, terms, next_before = search_telegram_messages(
+        request.args.get('q', ''), telegram_user_id=request.args.get('user_id', type=int), **filters
+    )
+    return jsonify({
+        'results': [{
+            'id': m.id,
+            'telegram_user_id': m.telegram_user_id,
+            'role': m.role,
+            'snippet': str(highlight(m.content, terms)),
+            'created_at': m.created_at.isoformat()
+        } for m in messages],
+        'next_before': next_before
+    })
+
+@chat_bp.route('/api/search/messages', methods=['GET'])
+@login_required
+def api_search_messages():
+    filters = _search_filters()
+    if filters is None:
+        return jsonify({'error': 'Dates must be YYYY-MM-DD'}), 400
+    messages, terms, next_before = search_messages(
+        request.args.get('q', ''), current_user.id,
+        conversation_id=request.args.get('conversation_id', type=int), **filters
+    )
+    return jsonify({
+        'results': [{
+            'id': m.id,
+            'conversation_id': m.conversation_id,
+            'role': m.role,
+            'snippet': str(highlight(m.content, terms)),
+            'created_at': m.created_at.isoformat()
+        } for m in messages],
+        'next_before': next_before
+    })
 
 @chat_bp.route('/admin/telegram/settings', methods=['POST'])
 @login_required
@@ -68,13 +188,14 @@ def get_conversations():
     conversations = Conversation.query.filter_by(
         user_id=current_user.id
     ).order_by(Conversation.updated_at.desc()).all()
+    archived = archived_counts('messages', [conv.id for conv in conversations])
     
     result = [{
         'id': conv.id,
         'title': conv.title,
         'created_at': conv.created_at.isoformat(),
         'updated_at': conv.updated_at.isoformat(),
-        'message_count': conv.messages.count()
+        'message_count': conv.messages.count() + archived.get(conv.id, 0)
     } for conv in conversations]
     
     return jsonify(result)
@@ -102,8 +223,10 @@ def delete_conversation(conversation_id):
         id=conversation_id, user_id=current_user.id
     ).first_or_404()
     
+    archived_files = drop_archived('messages', conversation.id)
     db.session.delete(conversation)
     db.session.commit()
+    remove_files(archived_files)
     
     return jsonify({'success': True})
 
@@ -117,6 +240,7 @@ def get_messages(conversation_id):
     messages = Message.query.filter_by(
         conversation_id=conversation.id
     ).order_by(Message.created_at).all()
+    messages = archived_messages('messages', conversation.id) + messages
     
     result = [{
         'id': msg.id,
@@ -140,6 +264,9 @@ def send_message(conversation_id):
         logger.warning("Message missing in request data")
         return jsonify({'error': 'Message is required'}), 400
     
+    # Before anything is added to the session: loading the router's settings may query the database
+    routed = route_message(data['message'], 'web')
+    
     # Create user message
     user_message = Message(
         conversation_id=conversation.id,
@@ -158,13 +285,26 @@ def send_message(conversation_id):
     
     # Generate AI response
     try:
-        # Get conversation history for context
-        history_messages = Message.query.filter_by(conversation_id=conversation.id).order_by(Message.created_at.asc()).all()
-        history = [{"role": msg.role, "content": msg.content} for msg in history_messages]
+        if routed is not None:
+            ai_response = routed.reply
+        else:
+            # Get conversation history for context. Nothing is flushed yet, so no write
+            # transaction is held open while the model answers. Only the turns the engine keeps are
+            # loaded; the archive is read when the hot rows are fewer than that
+            with db.session.no_autoflush:
+                history_messages = Message.query.filter_by(conversation_id=conversation.id).order_by(
+                    Message.id.desc()).limit(HISTORY_TURNS).all()[::-1]
+                if len(history_messages) < HISTORY_TURNS:
+                    before = history_messages[0].id if history_messages else None
+                    history_messages = archived_messages(
+                        'messages', conversation.id, before=before, limit=HISTORY_TURNS - len(history_messages)
+                    ) + history_messages
+            history = [{"role": msg.role, "content": msg.content} for msg in history_messages]
+            history.append({"role": user_message.role, "content": user_message.content})
 
-        logger.info(f"Generating AI response for message: {data['message'][:50]} with history of {len(history)} messages...")
-        ai_response = generate_ai_response(data['message'], history=history)
-        logger.info("AI response generated successfully")
+            logger.info(f"Generating AI response for message: {data['message'][:50]} with history of {len(history)} messages...")
+            ai_response = generate_ai_response(data['message'], history=history, owner=current_user.id)
+            logger.info("AI response generated successfully")
         
         # Create assistant message
         assistant_message = Message(
@@ -176,6 +316,8 @@ def send_message(conversation_id):
         
         # Update conversation timestamp
         conversation.updated_at = db.func.now()
+        for key in count_keys('web', routed):
+            increment(key)
         
         db.session.commit()
         
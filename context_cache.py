@@ -0,0 +1,386 @@
+"""
+Provider-side caching of the stable prompt prefix.
+
+With caching, the system instruction and the whole knowledge base are
+registered once per model and knowledge-base version as a Gemini
+cachedContents resource. Requests then carry only the conversation, the
+question and the ids of the best-matching pairs, and reference the prefix by
+its handle:
+
+    ContextCache.handle(model, version, build_text, namespace) -> "cachedContents/..." or None
+
+Each knowledge base (namespace: its owner) has its own handle per model. A
+handle is re-registered when the knowledge base changes (the old one is
+deleted), extended shortly before its TTL runs out, and dropped by
+invalidate() when Gemini no longer knows it. Beyond GEMINI_CACHE_MAX_HANDLES
+live handles, the least recently used one is deleted (cached storage is
+billed per hour). Prefixes below GEMINI_CACHE_MIN_TOKENS (Gemini refuses
+small caches and they save little) or above GEMINI_CACHE_MAX_TOKENS are not
+cached; callers then send the regular prompt.
+
+Backends:
+    GeminiCacheBackend   the cachedContents REST API
+    LocalCacheBackend    in-memory stand-in for offline runs (see evaluate.py)
+
+With a DatabaseHandles store (what the app uses) the handle name, its
+knowledge-base version and expiry live in the gemini_cache_handles table, so
+every process reuses one registration: a process that finds no current
+handle claims the row for CREATE_LEASE seconds and registers it while the
+others send uncached requests. Without it handles are kept per process.
+Uploads and extensions run outside the cache's lock, with one thread per key.
+"""
+import os
+import time
+import logging
+import datetime
+import threading
+from collections import OrderedDict
+from contextlib import nullcontext
+from llm_scheduler import CHARS_PER_TOKEN
+
+logger = logging.getLogger(__name__)
+
+CONTEXT_CACHE = os.environ.get("GEMINI_CONTEXT_CACHE", "0") == "1"
+CACHE_TTL = int(os.environ.get("GEMINI_CACHE_TTL", "3600"))
+CACHE_MIN_TOKENS = int(os.environ.get("GEMINI_CACHE_MIN_TOKENS", "4096"))
+CACHE_MAX_TOKENS = int(os.environ.get("GEMINI_CACHE_MAX_TOKENS", "700000"))
+CACHE_MAX_HANDLES = int(os.environ.get("GEMINI_CACHE_MAX_HANDLES", "16"))
+# A handle is extended when it has less than this many seconds left
+REFRESH_MARGIN = 120
+# After a failed registration, requests go uncached for this long before trying again
+RETRY_AFTER_FAILURE = 60
+# Seconds a process may take to register a shared handle before another one may try
+CREATE_LEASE = 120
+# While another process registers a shared handle, requests go uncached and look again after this long
+CLAIM_WAIT = 5
+
+GEMINI_API_BASE = "https://generativelanguage.googleapis.com/v1beta"
+
+
+def _parse_expire_time(value, fallback):
+    try:
+        # RFC 3339 with up to nanoseconds, e.g. 2025-01-01T10:00:00.123456789Z
+        stamp = value.rstrip('Z').split('.')[0]
+        return datetime.datetime.fromisoformat(stamp).replace(tzinfo=datetime.timezone.utc).timestamp()
+    except (AttributeError, ValueError):
+        return fallback
+
+
+class GeminiCacheBackend:
+    """cachedContents through the Gemini REST API."""
+
+    def __init__(self, http_client=None, api_key=None, base_url=GEMINI_API_BASE, timeout=60):
+        if http_client is None:
+            from cassette import http_session
+            http_client = http_session("gemini")
+        if api_key is None:
+            from ai_engine import GEMINI_API_KEY
+            api_key = GEMINI_API_KEY
+        self.http_client = http_client
+        self.api_key = api_key
+        self.base_url = base_url
+        self.timeout = timeout
+
+    def create(self, model, text, ttl):
+        """Register ``text`` as the system instruction of ``model``. Returns (name, expires at)."""
+        response = self.http_client.post(
+            f"{self.base_url}/cachedContents?key={self.api_key}",
+            json={"model": f"models/{model}", "systemInstruction": {"parts": [{"text": text}]}, "ttl": f"{ttl}s"},
+            timeout=self.timeout
+        )
+        if not response.ok:
+            raise RuntimeError(f"cachedContents.create failed ({response.status_code}): {response.text[:300]}")
+        result = response.json()
+        return result["name"], _parse_expire_time(result.get("expireTime"), time.time() + ttl)
+
+    def extend(self, name, ttl):
+        """New expiry time, or None if the handle is gone."""
+        response = self.http_client.request(
+            "PATCH", f"{self.base_url}/{name}?updateMask=ttl&key={self.api_key}",
+            json={"ttl": f"{ttl}s"}, timeout=self.timeout
+        )
+        if not response.ok:
+            return None
+        return _parse_expire_time(response.json().get("expireTime"), time.time() + ttl)
+
+    def delete(self, name):
+        self.http_client.request("DELETE", f"{self.base_url}/{name}?key={self.api_key}", timeout=self.timeout)
+
+
+class LocalCacheBackend:
+    """In-memory cachedContents: resolve() gives a fake model the registered text."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._contents = {}  # name -> (model, text, expires at)
+        self.created = 0
+        self.extended = 0
+        self.deleted = 0
+
+    def create(self, model, text, ttl):
+        with self._lock:
+            self.created += 1
+            name = f"cachedContents/local-{self.created}"
+            expires_at = time.time() + ttl
+            self._contents[name] = (model, text, expires_at)
+            return name, expires_at
+
+    def extend(self, name, ttl):
+        with self._lock:
+            content = self._contents.get(name)
+            if content is None or content[2] < time.time():
+                return None
+            self.extended += 1
+            expires_at = time.time() + ttl
+            self._contents[name] = (content[0], content[1], expires_at)
+            return expires_at
+
+    def delete(self, name):
+        with self._lock:
+            if self._contents.pop(name, None) is not None:
+                self.deleted += 1
+
+    def resolve(self, name):
+        """Registered text of a live handle, else None."""
+        content = self._contents.get(name)
+        if content is None or content[2] < time.time():
+            return None
+        return content[1]
+
+
+class _Handle:
+    __slots__ = ("name", "version", "expires_at")
+
+    def __init__(self, name, version, expires_at):
+        self.name = name
+        self.version = version
+        self.expires_at = expires_at
+
+
+class DatabaseHandles:
+    """Handles in the gemini_cache_handles table, shared by every process using the database."""
+
+    def __init__(self, app=None):
+        self.app = app
+
+    def _app_context(self):
+        from flask import has_app_context
+        if has_app_context():
+            return nullcontext()
+        if self.app is None:
+            from app import app
+            self.app = app
+        return self.app.app_context()
+
+    @staticmethod
+    def _row(key):
+        from models import GeminiCacheHandle
+
+        table = GeminiCacheHandle.__table__
+        model, namespace = key
+        # NULLs are distinct in a unique index: the shared knowledge base is stored as ''
+        namespace = "" if namespace is None else str(namespace)
+        return table, (table.c.model == model, table.c.namespace == namespace), {"model": model, "namespace": namespace}
+
+    def load(self, key):
+        from sqlalchemy import select
+        from database import db
+
+        table, where, _ = self._row(key)
+        # Its own connection: the caller's session may have uncommitted work
+        with self._app_context(), db.engine.begin() as conn:
+            row = conn.execute(select(table).where(*where)).first()
+        if row is None or row.kb_version is None:
+            return None
+        return _Handle(row.name, row.kb_version, row.expires_at)
+
+    def claim(self, key, until):
+        """Take the right to register ``key``'s handle until ``until``; False while another process holds it."""
+        from sqlalchemy import insert, or_, select, update
+        from sqlalchemy.exc import IntegrityError
+        from database import db
+
+        table, where, values = self._row(key)
+        now = time.time()
+        with self._app_context():
+            try:
+                with db.engine.begin() as conn:
+                    free = or_(table.c.creating_until.is_(None), table.c.creating_until < now)
+                    if conn.execute(update(table).where(*where, free).values(creating_until=until)).rowcount:
+                        return True
+                    if conn.execute(select(table.c.id).where(*where)).first() is not None:
+                        return False
+                    conn.execute(insert(table).values(creating_until=until, **values))
+                    return True
+            except IntegrityError:
+                return False  # Another process created the row first
+
+    def save(self, key, handle):
+        """Store ``key``'s handle and end the claim on it. Returns the name it replaced, if any."""
+        from sqlalchemy import select, update
+        from database import db
+
+        table, where, _ = self._row(key)
+        with self._app_context(), db.engine.begin() as conn:
+            previous = conn.execute(select(table.c.name).where(*where)).scalar()
+            conn.execute(update(table).where(*where).values(
+                name=handle.name, kb_version=handle.version, expires_at=handle.expires_at,
+                creating_until=None, used_at=time.time()
+            ))
+        return previous
+
+    def remove(self, key, name):
+        from sqlalchemy import delete
+        from database import db
+
+        table, where, _ = self._row(key)
+        with self._app_context(), db.engine.begin() as conn:
+            conn.execute(delete(table).where(*where, table.c.name == name))
+
+    def trim(self, max_handles):
+        """Forget the least recently used handles beyond ``max_handles``. Returns their names."""
+        from sqlalchemy import delete, select
+        from database import db
+        from models import GeminiCacheHandle
+
+        table = GeminiCacheHandle.__table__
+        removed = []
+        with self._app_context(), db.engine.begin() as conn:
+            rows = conn.execute(
+                select(table.c.id, table.c.name).where(table.c.name.isnot(None)).order_by(table.c.used_at.desc())
+            ).all()
+            for row_id, name in rows[max_handles:]:
+                if conn.execute(delete(table).where(table.c.id == row_id, table.c.name == name)).rowcount:
+                    removed.append(name)
+        return removed
+
+
+class ContextCache:
+    """Keeps one cached prefix per model and knowledge base current with the knowledge-base version."""
+
+    def __init__(self, backend, ttl=CACHE_TTL, min_tokens=CACHE_MIN_TOKENS, max_tokens=CACHE_MAX_TOKENS,
+                 refresh_margin=REFRESH_MARGIN, max_handles=CACHE_MAX_HANDLES, shared=None):
+        self.backend = backend
+        self.ttl = ttl
+        self.min_tokens = min_tokens
+        self.max_tokens = max_tokens
+        self.refresh_margin = refresh_margin
+        self.max_handles = max_handles
+        # DatabaseHandles to share handles between processes (None: this process only)
+        self.shared = shared
+        self._lock = threading.Lock()
+        # (model, namespace) -> _Handle (name None: send uncached until expires_at), least recently used first
+        self._handles = OrderedDict()
+        # Keys being registered or extended by some thread
+        self._busy = set()
+
+    def _usable(self, handle, version, now):
+        """The handle's answer (a name, or None for uncached) if it needs no renewal, else False."""
+        if handle is None or handle.version != version:
+            return False
+        if handle.name is None:
+            return None if now < handle.expires_at else False
+        return handle.name if handle.expires_at - now > self.refresh_margin else False
+
+    def handle(self, model, version, build_text, namespace=None):
+        """Name of the cached prefix for this knowledge-base version, registering it if needed."""
+        key = (model, namespace)
+        with self._lock:
+            now = time.time()
+            current = self._handles.get(key)
+            if current is not None:
+                self._handles.move_to_end(key)
+            usable = self._usable(current, version, now)
+            if usable is not False:
+                return usable
+            if key in self._busy:
+                # Another thread is renewing it: keep using a still valid handle, else go uncached
+                if current is not None and current.version == version and current.name and current.expires_at > now:
+                    return current.name
+                return None
+            self._busy.add(key)
+
+        # Network calls happen outside the lock, so other keys (and valid handles) are not held up
+        stale = []
+        handle = None
+        try:
+            handle = self._renew(key, version, build_text, current, stale)
+        finally:
+            with self._lock:
+                self._busy.discard(key)
+                if handle is not None:
+                    previous = self._handles.get(key)
+                    self._handles[key] = handle
+                    self._handles.move_to_end(key)
+                    if self.shared is None:
+                        if previous is not None and previous.name and previous.name != handle.name:
+                            stale.append(previous.name)
+                        live = [k for k, h in self._handles.items() if h.name]
+                        for k in live[:max(0, len(live) - self.max_handles)]:
+                            stale.append(self._handles.pop(k).name)
+            for name in stale:
+                self._delete(name)
+        return handle.name if handle is not None else None
+
+    def _renew(self, key, version, build_text, current, stale):
+        """A current handle for ``key``: adopted from another process, extended, or registered."""
+        model, namespace = key
+        now = time.time()
+        if self.shared is not None:
+            shared = self.shared.load(key)
+            if self._usable(shared, version, now) is not False:
+                return shared
+            if shared is not None and shared.version == version:
+                current = shared
+        if current is not None and current.version == version and current.name:
+            expires_at = self._extend(current.name)
+            if expires_at:
+                handle = _Handle(current.name, version, expires_at)
+                if self.shared is not None:
+                    self.shared.save(key, handle)
+                return handle
+        if self.shared is not None and not self.shared.claim(key, now + CREATE_LEASE):
+            # Another process is registering it: uncached until it is done
+            return _Handle(None, version, now + CLAIM_WAIT)
+
+        text = build_text()
+        tokens = len(text) // CHARS_PER_TOKEN
+        if not self.min_tokens <= tokens <= self.max_tokens:
+            # Same answer until the knowledge base changes
+            handle = _Handle(None, version, float('inf'))
+        else:
+            try:
+                name, expires_at = self.backend.create(model, text, self.ttl)
+                handle = _Handle(name, version, expires_at)
+                logger.info(f"Cached the prompt prefix for {model}/{namespace} ({tokens} tokens est.) as {name}")
+            except Exception as e:
+                logger.error(f"Could not cache the prompt prefix for {model}: {e}")
+                handle = _Handle(None, version, now + RETRY_AFTER_FAILURE)
+        if self.shared is not None:
+            previous = self.shared.save(key, handle)
+            if previous and previous != handle.name:
+                stale.append(previous)
+            if handle.name:
+                stale.extend(self.shared.trim(self.max_handles))
+        return handle
+
+    def _extend(self, name):
+        try:
+            return self.backend.extend(name, self.ttl)
+        except Exception as e:
+            logger.warning(f"Could not extend cached prefix {name}: {e}")
+            return None
+
+    def _delete(self, name):
+        try:
+            self.backend.delete(name)
+        except Exception as e:
+            logger.warning(f"Could not delete cached prefix {name}: {e}")
+
+    def invalidate(self, model, namespace=None):
+        """Forget a handle Gemini no longer accepts; the next request registers a new one."""
+        key = (model, namespace)
+        with self._lock:
+            handle = self._handles.pop(key, None)
+        if self.shared is not None and handle is not None and handle.name:
+            self.shared.remove(key, handle.name)
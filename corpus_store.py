@@ -0,0 +1,187 @@
+"""
+Compact in-memory corpus of training pairs.
+
+TrainingData ORM instances (instance state, attribute dicts, the session's
+identity map) or lists of dicts take several times the memory of the text
+they hold, and give the garbage collector an object per row and field to
+traverse. CorpusStore keeps a corpus in a handful of buffers instead:
+
+    text        one UTF-8 bytearray with every field of every row
+    offsets     array('q') of field boundaries in ``text``
+    ids, user_ids, updated
+                array('q') columns (updated: updated_at in microseconds since
+                the epoch)
+
+Rows are read through Record views (__slots__, created on access) and are
+loaded straight from a server-side cursor, so no ORM object is built and
+only one chunk of result rows exists at a time. kb_snapshot.py writes these
+buffers as they are. ``python benchmark.py corpus`` compares the memory with
+TrainingData.query.all().
+"""
+import bisect
+import datetime
+import logging
+from array import array
+import numpy as np
+from arabic_text import token_string
+
+logger = logging.getLogger(__name__)
+
+# Text fields of a row, in storage order
+FIELDS = ("question", "answer", "question_norm", "answer_norm")
+# Rows fetched per round trip of the server-side cursor
+FETCH_SIZE = 1000
+EPOCH = datetime.datetime(1970, 1, 1)
+# Stamp of a NULL updated_at
+NO_STAMP = np.iinfo(np.int64).min
+
+
+def to_stamp(updated_at):
+    return NO_STAMP if updated_at is None else (updated_at - EPOCH) // datetime.timedelta(microseconds=1)
+
+
+def from_stamp(value):
+    return None if value == NO_STAMP else EPOCH + datetime.timedelta(microseconds=int(value))
+
+
+class Record:
+    """View of one row of a CorpusStore, with the attributes of a knowledge_index.Entry."""
+    __slots__ = ("_store", "_row")
+
+    def __init__(self, store, row):
+        self._store = store
+        self._row = row
+
+    @property
+    def id(self):
+        return self._store.ids[self._row]
+
+    @property
+    def user_id(self):
+        return self._store.user_ids[self._row]
+
+    @property
+    def updated_at(self):
+        return from_stamp(self._store.updated[self._row])
+
+    @property
+    def question(self):
+        return self._store.text_of(self._row, 0)
+
+    @property
+    def answer(self):
+        return self._store.text_of(self._row, 1)
+
+    @property
+    def question_norm(self):
+        return self._store.text_of(self._row, 2)
+
+    @property
+    def answer_norm(self):
+        return self._store.text_of(self._row, 3)
+
+    def __repr__(self):
+        return f"<Record {self.id}>"
+
+
+class CorpusStore:
+    """Training pairs of one owner (None: every owner's) in columnar buffers, in id order."""
+
+    def __init__(self, owner=None):
+        self.owner = owner
+        self.fingerprint = None
+        self.text = bytearray()
+        self.offsets = array("q", [0])
+        self.ids = array("q")
+        self.user_ids = array("q")
+        self.updated = array("q")
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, row):
+        if not 0 <= row < len(self.ids):
+            raise IndexError(row)
+        return Record(self, row)
+
+    def __iter__(self):
+        return (Record(self, row) for row in range(len(self.ids)))
+
+    def __contains__(self, entry_id):
+        return self.row_of(entry_id) is not None
+
+    def append(self, entry_id, user_id, updated_at, question, answer, question_norm, answer_norm):
+        """Add a row; ids must come in increasing order (get() searches them by bisection)."""
+        if self.ids and entry_id <= self.ids[-1]:
+            raise ValueError(f"row {entry_id} added after row {self.ids[-1]}")
+        for text in (question, answer, question_norm, answer_norm):
+            self.text += text.encode("utf-8")
+            self.offsets.append(len(self.text))
+        self.ids.append(entry_id)
+        self.user_ids.append(user_id)
+        self.updated.append(to_stamp(updated_at))
+
+    def text_of(self, row, field):
+        start = len(FIELDS) * row + field
+        return self.text[self.offsets[start]:self.offsets[start + 1]].decode("utf-8")
+
+    def row_of(self, entry_id):
+        row = bisect.bisect_left(self.ids, entry_id)
+        if row < len(self.ids) and self.ids[row] == entry_id:
+            return row
+        return None
+
+    def get(self, entry_id):
+        row = self.row_of(entry_id)
+        return None if row is None else Record(self, row)
+
+    def stamps(self):
+        """{id: updated_at}, as KnowledgeIndex.stamps() (what VectorIndex.sync() reads)."""
+        return {entry_id: from_stamp(stamp) for entry_id, stamp in zip(self.ids, self.updated)}
+
+    @property
+    def memory(self):
+        """Bytes held by the buffers (allocated capacity aside)."""
+        columns = (self.offsets, self.ids, self.user_ids, self.updated)
+        return len(self.text) + sum(column.itemsize * len(column) for column in columns)
+
+    def arrays(self):
+        """
+        NumPy views of the buffers, without copying. The store cannot grow
+        while they are alive.
+        """
+        return {
+            "ids": np.frombuffer(self.ids, dtype=np.int64),
+            "user_ids": np.frombuffer(self.user_ids, dtype=np.int64),
+            "updated": np.frombuffer(self.updated, dtype=np.int64),
+            "text": np.frombuffer(self.text, dtype=np.uint8),
+            "offsets": np.frombuffer(self.offsets, dtype=np.int64),
+        }
+
+    @classmethod
+    def load(cls, owner=None, fetch_size=FETCH_SIZE):
+        """``owner``'s training data (needs an app context), streamed from a server-side cursor."""
+        from sqlalchemy import select
+        from database import db
+        from models import TrainingData
+        from knowledge_index import data_fingerprint
+
+        store = cls(owner)
+        # Taken first: a change made while loading shows up as a newer fingerprint at the next check
+        store.fingerprint = data_fingerprint(owner)
+        query = select(
+            TrainingData.id, TrainingData.user_id, TrainingData.updated_at, TrainingData.question,
+            TrainingData.answer, TrainingData.question_norm, TrainingData.answer_norm
+        ).order_by(TrainingData.id)
+        if owner is not None:
+            query = query.where(TrainingData.user_id == owner)
+        # yield_per streams the result (a named cursor on PostgreSQL) instead of buffering it all
+        result = db.session.execute(query.execution_options(yield_per=fetch_size))
+        for entry_id, user_id, updated_at, question, answer, question_norm, answer_norm in result:
+            store.append(
+                entry_id, user_id, updated_at, question, answer,
+                question_norm if question_norm is not None else token_string(question),
+                answer_norm if answer_norm is not None else token_string(answer)
+            )
+        logger.info(f"Corpus of owner {owner} loaded: {len(store)} rows, {store.memory // 1024} KiB")
+        return store
@@ -0,0 +1,237 @@
+"""
+Ingestion-time duplicate detection for training pairs.
+
+Questions are compared on their normalized text (see arabic_text) using
+MinHash signatures over character 4-gram shingles and LSH banding. Band keys
+are kept in sorted ``array('Q')`` columns rather than dicts of lists, so the
+index for 100k+ pairs stays in the tens of megabytes, and each lookup is a
+handful of binary searches instead of a scan of the corpus.
+"""
+import logging
+import os
+import random
+import zlib
+from array import array
+from bisect import bisect_left
+from hashlib import blake2b, sha256
+from database import db
+from models import TrainingData
+from arabic_text import normalize, token_string
+
+logger = logging.getLogger(__name__)
+
+NUM_PERM = 32
+BANDS = 8
+ROWS_PER_BAND = NUM_PERM // BANDS
+SHINGLE_SIZE = 4
+# Estimated Jaccard similarity at or above which two questions are near duplicates
+NEAR_DUPLICATE_THRESHOLD = float(os.environ.get("DEDUPE_THRESHOLD", "0.8"))
+DEFAULT_POLICY = os.environ.get("DEDUPE_POLICY", "skip")
+POLICIES = ('skip', 'replace', 'merge')
+# Matches listed individually in a TrainingFile report
+REPORT_MATCH_LIMIT = 50
+
+_MASK32 = 0xFFFFFFFF
+_rng = random.Random(20240601)
+_HASH_PARAMS = [(_rng.randrange(1, _MASK32) | 1, _rng.randrange(0, _MASK32)) for _ in range(NUM_PERM)]
+_EMPTY_SIGNATURE = array('I', [_MASK32] * NUM_PERM)
+
+
+def _shingles(text):
+    text = text or ''
+    if len(text) <= SHINGLE_SIZE:
+        return {zlib.crc32(text.encode('utf-8'))} if text else set()
+    return {zlib.crc32(text[i:i + SHINGLE_SIZE].encode('utf-8')) for i in range(len(text) - SHINGLE_SIZE + 1)}
+
+
+def signature(question_norm):
+    """MinHash signature (array of NUM_PERM uint32) of a normalized question."""
+    shingles = _shingles(question_norm)
+    if not shingles:
+        return array('I', _EMPTY_SIGNATURE)
+    return array('I', [min([(a * x + b) & _MASK32 for x in shingles]) for a, b in _HASH_PARAMS])
+
+
+def signature_bytes(question_norm):
+    return signature(question_norm).tobytes()
+
+
+def pair_hash(question, answer):
+    """SHA-256 of a pair's exact text (surrounding whitespace ignored)."""
+    return sha256(f"{(question or '').strip()}\x1f{(answer or '').strip()}".encode('utf-8')).hexdigest()
+
+
+def _exact_key(question_norm):
+    return int.from_bytes(blake2b(question_norm.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def _band_hashes(sig):
+    raw = sig.tobytes()
+    step = ROWS_PER_BAND * 4
+    return [zlib.crc32(raw[b * step:(b + 1) * step]) for b in range(BANDS)]
+
+
+class LSHIndex:
+    """
+    MinHash LSH index with compact storage.
+
+    Each band is a sorted array of ``band_hash << 32 | slot``; items added after
+    the last compaction live in small per-band dicts until compact() merges them.
+    """
+
+    def __init__(self):
+        self.signatures = array('I')
+        self._bands = [array('Q') for _ in range(BANDS)]
+        self._recent = [{} for _ in range(BANDS)]
+        self._recent_count = 0
+        self._exact = {}
+
+    def __len__(self):
+        return len(self.signatures) // NUM_PERM
+
+    def add(self, sig, question_norm):
+        slot = len(self)
+        self.signatures.extend(sig)
+        for band, h in enumerate(_band_hashes(sig)):
+            self._recent[band].setdefault(h, []).append(slot)
+        self._exact.setdefault(_exact_key(question_norm), slot)
+        self._recent_count += 1
+        # Geometric compaction keeps bulk loading O(n log n)
+        if self._recent_count >= max(4096, slot // 2):
+            self.compact()
+        return slot
+
+    def compact(self):
+        for band in range(BANDS):
+            keys = list(self._bands[band])
+            for h, slots in self._recent[band].items():
+                keys.extend((h << 32) | slot for slot in slots)
+            keys.sort()
+            self._bands[band] = array('Q', keys)
+            self._recent[band] = {}
+        self._recent_count = 0
+
+    def exact(self, question_norm):
+        return self._exact.get(_exact_key(question_norm))
+
+    def similarity(self, sig, slot):
+        offset = slot * NUM_PERM
+        stored = self.signatures[offset:offset + NUM_PERM]
+        return sum(1 for a, b in zip(sig, stored) if a == b) / NUM_PERM
+
+    def candidates(self, sig):
+        found = set()
+        for band, h in enumerate(_band_hashes(sig)):
+            keys = self._bands[band]
+            i = bisect_left(keys, h << 32)
+            while i < len(keys) and keys[i] >> 32 == h:
+                found.add(keys[i] & _MASK32)
+                i += 1
+            found.update(self._recent[band].get(h, ()))
+        return found
+
+    def best_match(self, sig, question_norm):
+        """(slot, similarity, kind) of the closest stored question, or None."""
+        slot = self.exact(question_norm)
+        if slot is not None:
+            return slot, 1.0, 'exact'
+        best = None
+        for candidate in self.candidates(sig):
+            score = self.similarity(sig, candidate)
+            if score >= NEAR_DUPLICATE_THRESHOLD and (best is None or score > best[1]):
+                best = (candidate, score, 'near')
+        return best
+
+
+class Deduplicator:
+    """
+    Applies a duplicate policy while training pairs are ingested for one owner.
+
+    skip    - keep the existing pair, drop the new one
+    replace - overwrite the existing answer with the new one
+    merge   - append the new answer to the existing one unless already contained
+    """
+
+    def __init__(self, user_id, policy=DEFAULT_POLICY):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown duplicate policy: {policy}")
+        self.user_id = user_id
+        self.policy = policy
+        self.index = LSHIndex()
+        # slot -> existing row id, or -1 for a TrainingData object added in this run
+        self._row_ids = array('q')
+        self._new_rows = {}
+        self.report = {
+            'policy': policy, 'pairs': 0, 'inserted': 0,
+            'exact_duplicates': 0, 'near_duplicates': 0,
+            'skipped': 0, 'replaced': 0, 'merged': 0, 'matches': []
+        }
+        self._load_existing()
+
+    def _load_existing(self):
+        query = db.session.query(
+            TrainingData.id, TrainingData.question, TrainingData.question_norm, TrainingData.question_signature
+        ).filter(TrainingData.user_id == self.user_id).order_by(TrainingData.id).execution_options(yield_per=1000)
+        for row in query:
+            question_norm = row.question_norm if row.question_norm is not None else token_string(row.question)
+            question_norm = question_norm or normalize(row.question)
+            if row.question_signature:
+                sig = array('I')
+                sig.frombytes(row.question_signature)
+            else:
+                sig = signature(question_norm)
+            self.index.add(sig, question_norm)
+            self._row_ids.append(row.id)
+        self.index.compact()
+
+    def _row(self, slot):
+        row = self._new_rows.get(slot)
+        if row is None:
+            row = db.session.get(TrainingData, self._row_ids[slot])
+        return row
+
+    def add(self, question, answer, source_type='file', source_name=None):
+        """Insert the pair or resolve it against a duplicate. Returns the action taken."""
+        self.report['pairs'] += 1
+        question_norm = token_string(question) or normalize(question)
+        sig = signature(question_norm)
+        match = self.index.best_match(sig, question_norm)
+
+        if match is None:
+            row = TrainingData(
+                user_id=self.user_id, question=question, answer=answer,
+                source_type=source_type, source_name=source_name
+            )
+            db.session.add(row)
+            slot = self.index.add(sig, question_norm)
+            self._row_ids.append(-1)
+            self._new_rows[slot] = row
+            self.report['inserted'] += 1
+            return 'inserted'
+
+        slot, similarity, kind = match
+        self.report['exact_duplicates' if kind == 'exact' else 'near_duplicates'] += 1
+        existing = self._row(slot)
+        action = self._resolve(existing, answer)
+        self.report[action] += 1
+        if len(self.report['matches']) < REPORT_MATCH_LIMIT:
+            self.report['matches'].append({
+                'question': question,
+                'matched_id': existing.id,
+                'matched_question': existing.question,
+                'similarity': round(similarity, 3),
+                'kind': kind,
+                'action': action
+            })
+        return action
+
+    def _resolve(self, existing, answer):
+        if self.policy == 'skip' or token_string(answer) == token_string(existing.answer):
+            return 'skipped'
+        if self.policy == 'replace':
+            existing.answer = answer
+            return 'replaced'
+        if normalize(answer) in normalize(existing.answer):
+            return 'skipped'
+        existing.answer = f"{existing.answer}\n\n{answer}"
+        return 'merged'
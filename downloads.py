@@ -1,15 +1,22 @@
+import io
 import os
+import time
+import struct
 import logging
-import zipfile
-import tempfile
-import shutil
-from datetime import datetime
-from flask import Blueprint, send_file, abort, flash, redirect, url_for, current_app
-from flask_login import login_required, current_user
+import threading
+import zlib
+from hashlib import sha256
+from flask import Blueprint, request, flash, redirect, url_for, current_app
+from flask_login import login_required
+from werkzeug.exceptions import HTTPException
+from werkzeug.wsgi import wrap_file
 
 downloads_bp = Blueprint('downloads', __name__)
 logger = logging.getLogger(__name__)
 
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+ARCHIVE_NAME = 'ai_assistant_project.zip'
+
 # List of files and directories to include in the download
 # We'll exclude some items like __pycache__, .env, etc.
 EXCLUDED_ITEMS = {
@@ -21,6 +28,10 @@ EXCLUDED_ITEMS = {
     '.idea',
     '.vscode',
     'tmp',
+    'uploads',   # User files, not project source
+    'instance',  # Local indexes
+    '.venv',
+    'venv',
     '*.pyc',
     '*.pyo',
     '*.pyd',
@@ -30,82 +41,243 @@ EXCLUDED_ITEMS = {
     '*.zip',  # Exclude any zip files
 }
 
+# Zip32 limits; the project tree is far below them
+_ZIP32_LIMIT = 0xFFFFFFFF
+_READ_SIZE = 64 * 1024
+# General purpose flag 11: file names are UTF-8
+_FLAG_UTF8 = 0x0800
+
+
 def should_include_item(item_name):
     """Check if an item should be included in the download"""
     if item_name in EXCLUDED_ITEMS:
         return False
-    
+
     for pattern in EXCLUDED_ITEMS:
         if '*' in pattern:
             prefix, suffix = pattern.split('*', 1)
             if item_name.startswith(prefix) and item_name.endswith(suffix):
                 return False
-    
+
     return True
 
+
+def scan_tree(root_dir=ROOT_DIR):
+    """[(arcname, path, size, mtime_ns, mode)] of the files to archive, sorted by name."""
+    files = []
+    for dir_path, dir_names, file_names in os.walk(root_dir):
+        dir_names[:] = sorted(d for d in dir_names if should_include_item(d))
+        for file_name in file_names:
+            if not should_include_item(file_name):
+                continue
+            path = os.path.join(dir_path, file_name)
+            try:
+                st = os.stat(path)
+            except OSError as e:
+                logger.warning(f"Skipping {path}: {str(e)}")
+                continue
+            if st.st_size >= _ZIP32_LIMIT:
+                logger.warning(f"Skipping {path}: too large for the archive")
+                continue
+            arcname = os.path.relpath(path, root_dir).replace(os.sep, '/')
+            files.append((arcname, path, st.st_size, st.st_mtime_ns, st.st_mode))
+    files.sort()
+    return files
+
+
+# path -> (size, mtime_ns, crc32); only files whose size or mtime changed are re-read
+_crc_cache = {}
+
+
+def _file_crc(path, size, mtime_ns):
+    cached = _crc_cache.get(path)
+    if cached and cached[0] == size and cached[1] == mtime_ns:
+        return cached[2]
+    crc = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_READ_SIZE), b''):
+            crc = zlib.crc32(chunk, crc)
+    _crc_cache[path] = (size, mtime_ns, crc)
+    return crc
+
+
+def _dos_datetime(mtime_ns):
+    t = time.localtime(max(mtime_ns // 1_000_000_000, 315532800))
+    dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    dos_date = ((max(t.tm_year, 1980) - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    return dos_time, dos_date
+
+
+class ProjectArchive:
+    """
+    Byte layout of an uncompressed (stored) zip of the project tree.
+
+    Every header is computed up front, so the total length and the offset of
+    each member are known before a byte is sent: the archive can be streamed
+    straight from the source files and any byte range can be served without
+    building the zip anywhere.
+    """
+
+    def __init__(self, files):
+        self.segments = []  # (offset, length, bytes or (path, size))
+        self.files = len(files)
+        central = []
+        offset = 0
+        digest = sha256()
+        for arcname, path, size, mtime_ns, mode in files:
+            name = arcname.encode('utf-8')
+            crc = _file_crc(path, size, mtime_ns)
+            dos_time, dos_date = _dos_datetime(mtime_ns)
+            local = struct.pack(
+                '<IHHHHHIIIHH', 0x04034b50, 20, _FLAG_UTF8, 0, dos_time, dos_date,
+                crc, size, size, len(name), 0
+            ) + name
+            central.append(struct.pack(
+                '<IHHHHHHIIIHHHHHII', 0x02014b50, (3 << 8) | 20, 20, _FLAG_UTF8, 0, dos_time, dos_date,
+                crc, size, size, len(name), 0, 0, 0, 0, (mode & 0xFFFF) << 16, offset
+            ) + name)
+            offset = self._append(offset, local)
+            offset = self._append(offset, (path, size), size)
+
+        directory = b''.join(central)
+        end = struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, len(files), len(files), len(directory), offset, 0)
+        offset = self._append(offset, directory + end)
+        digest.update(directory + end)
+        if offset >= _ZIP32_LIMIT:
+            raise ValueError("Project archive exceeds the zip32 size limit")
+        self.size = offset
+        # The central directory repeats every local header field (names, times,
+        # CRCs, sizes) and adds modes and offsets; with member data identified by
+        # CRC and size, it is what distinguishes one archive from another
+        self.etag = digest.hexdigest()[:32]
+        self.last_modified = max((f[3] for f in files), default=0) / 1e9
+
+    def _append(self, offset, data, length=None):
+        length = len(data) if length is None else length
+        if length:
+            self.segments.append((offset, length, data))
+        return offset + length
+
+    def open(self):
+        return ArchiveReader(self)
+
+
+class ArchiveReader(io.RawIOBase):
+    """Seekable read-only view of a ProjectArchive that reads member data from disk on demand."""
+
+    def __init__(self, archive):
+        self.archive = archive
+        self.position = 0
+        self._segment = 0
+        self._file = None
+        self._file_path = None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.archive.size
+        self.position = max(0, offset)
+        self._segment = 0
+        return self.position
+
+    def _find_segment(self):
+        segments = self.archive.segments
+        while self._segment < len(segments):
+            start, length, data = segments[self._segment]
+            if self.position < start + length:
+                return start, length, data
+            self._segment += 1
+        return None
+
+    def readinto(self, buffer):
+        segment = self._find_segment()
+        if segment is None:
+            return 0
+        start, length, data = segment
+        skip = self.position - start
+        count = min(len(buffer), length - skip)
+        if isinstance(data, bytes):
+            chunk = data[skip:skip + count]
+        else:
+            chunk = self._read_member(data, skip, count)
+        buffer[:len(chunk)] = chunk
+        self.position += len(chunk)
+        return len(chunk)
+
+    def _read_member(self, member, skip, count):
+        path, size = member
+        if self._file_path != path:
+            self._close_file()
+            self._file = open(path, 'rb')
+            self._file_path = path
+        self._file.seek(skip)
+        chunk = self._file.read(count)
+        if len(chunk) < count:
+            # The file shrank after the listing; keep the advertised length
+            logger.warning(f"{path} changed while it was being downloaded")
+            chunk += b'\0' * (count - len(chunk))
+        return chunk
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._file_path = None
+
+    def close(self):
+        self._close_file()
+        super().close()
+
+
+_archive = None
+_archive_key = None
+_archive_lock = threading.Lock()
+
+
+def get_project_archive(root_dir=ROOT_DIR):
+    """The archive for the current tree; rebuilt only when a file was added, removed or modified."""
+    global _archive, _archive_key
+    files = scan_tree(root_dir)
+    key = tuple((f[0], f[2], f[3], f[4]) for f in files)
+    with _archive_lock:
+        if _archive is None or key != _archive_key:
+            _archive = ProjectArchive(files)
+            _archive_key = key
+            logger.info(f"Project archive prepared: {_archive.files} files, {_archive.size} bytes")
+        return _archive
+
+
 @downloads_bp.route('/download-project')
 @login_required
 def download_project():
-    """Generate a ZIP file of the project and send it to the client for download"""
+    """Stream a ZIP of the project, with ETag and Range support for resumed downloads"""
     try:
-        # Create a temporary directory for the zip file
-        temp_dir = os.path.join(current_app.config['TMP_FOLDER'], f'ai_assistant_{datetime.now().strftime("%Y%m%d_%H%M%S")}')
-        os.makedirs(temp_dir, exist_ok=True)
-        
-        # Path for the zip file
-        zip_filename = os.path.join(temp_dir, 'ai_assistant_project.zip')
-        
-        # Get the root directory of the project
-        root_dir = os.path.dirname(os.path.abspath(__file__))
-        
-        # Create a temp project directory with copies of all files
-        temp_project_dir = os.path.join(temp_dir, 'project')
-        os.makedirs(temp_project_dir, exist_ok=True)
-        
-        # Copy all important files to temp directory first
-        for dir_path, dir_names, file_names in os.walk(root_dir):
-            # Skip excluded directories
-            dir_names[:] = [d for d in dir_names if should_include_item(d)]
-            
-            # Calculate the relative path
-            rel_path = os.path.relpath(dir_path, root_dir)
-            if rel_path == '.':
-                rel_path = ''
-            
-            # Create subdirectory in temp location if needed
-            if rel_path:
-                os.makedirs(os.path.join(temp_project_dir, rel_path), exist_ok=True)
-            
-            # Copy files
-            for file_name in file_names:
-                if should_include_item(file_name):
-                    # Skip temporary files
-                    if dir_path.startswith(os.path.join(root_dir, 'tmp')):
-                        continue
-                    
-                    try:
-                        src_file = os.path.join(dir_path, file_name)
-                        dst_file = os.path.join(temp_project_dir, rel_path, file_name)
-                        shutil.copy2(src_file, dst_file)
-                    except Exception as copy_err:
-                        logger.warning(f"Error copying file {file_name}: {str(copy_err)}")
-        
-        # Create zip from the temporary project directory
-        shutil.make_archive(
-            os.path.join(temp_dir, 'ai_assistant_project'),  # base name without extension
-            'zip',                                           # format
-            temp_project_dir                                 # root directory to zip
-        )
-        
-        # Send the file to the client
-        return send_file(
-            zip_filename,
+        archive = get_project_archive()
+        response = current_app.response_class(
+            wrap_file(request.environ, archive.open(), buffer_size=_READ_SIZE),
             mimetype='application/zip',
-            as_attachment=True,
-            download_name='ai_assistant_project.zip'
+            direct_passthrough=True
         )
-    
+        response.content_length = archive.size
+        response.set_etag(archive.etag)
+        response.last_modified = archive.last_modified
+        response.headers.set('Content-Disposition', 'attachment', filename=ARCHIVE_NAME)
+        response.cache_control.no_cache = True
+        return response.make_conditional(request.environ, accept_ranges=True, complete_length=archive.size)
+
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error creating download: {str(e)}")
         flash('An error occurred while preparing the download.', 'danger')
-        return redirect(url_for('chat.dashboard'))
\ No newline at end of file
+        return redirect(url_for('chat.dashboard'))
@@ -0,0 +1,333 @@
+"""
+Offline batch evaluation of answer quality against latency.
+
+Runs the labeled questions of eval/retrieval_eval.jsonl through AIEngine for
+every combination of the given settings and reports, per configuration,
+answer accuracy, latency percentiles and prompt sizes:
+
+    python evaluate.py
+    python evaluate.py --distractors 0 5000 --history-turns 0 10 --direct-thresholds 0.5 1.01
+    python evaluate.py --llm live --models gemini-2.5-flash --workers 4
+    python evaluate.py --llm recorded --responses eval/responses.jsonl
+    python evaluate.py --distractors 20000 --context-cache 0 1 --fake-ms-per-kchar 2
+
+An answer is correct when it contains most of the expected pair's answer
+tokens, or, for questions the knowledge base cannot answer, when it says the
+information is not available. The knowledge base is parsed from a training
+file, optionally padded with synthetic distractor pairs to model a larger
+KB; no database is needed.
+
+LLM backends:
+    fake      deterministic local stand-in: answers with the first grounded
+              answer in the prompt (or the "not available" reply), after
+              --fake-latency-ms plus --fake-ms-per-kchar per 1000 uploaded
+              prompt chars (a cached prefix is not uploaded again)
+    recorded  answers previously saved with --save-responses, by question
+    live      the Gemini API (needs GEMINI_API_KEY)
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import itertools
+import concurrent.futures
+
+import ai_engine
+import context_cache
+import llm_scheduler
+import retrieval
+from arabic_text import normalize, tokenize
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+GEMINI_MODEL_URL = "https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent?key={key}"
+
+# Share of the expected answer's tokens a response must contain to count as correct
+ANSWER_MATCH = 0.6
+NOT_AVAILABLE = "عذراً، هذه المعلومة غير متوفرة لدي حالياً. يرجى التواصل مع إدارة مؤسسة الحبيب للمستلزمات الطبية لمزيد من التفاصيل."
+_NOT_AVAILABLE_MARK = normalize("غير متوفرة")
+_CONTEXT_MARK = "السياق المعتمد للمؤسسة:"
+_QUESTION_MARK = "سؤال المستخدم الحالي: "
+_REF = re.compile(r'\[(\d+)\]')
+
+
+class FakeResponse:
+    """Just enough of requests.Response for AIEngine.parse_response."""
+
+    def __init__(self, text, status_code=200):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self._body = {'candidates': [{'content': {'parts': [{'text': text}]}, 'finishReason': 'STOP'}]}
+        self.text = json.dumps(self._body, ensure_ascii=False)
+
+    def json(self):
+        return self._body
+
+
+def _prompt(data):
+    return json.loads(data)['contents'][-1]['parts'][0]['text']
+
+
+class FakeGemini:
+    """
+    Deterministic local LLM: repeats the first grounded answer of the prompt.
+    With a cache_backend (context_cache.LocalCacheBackend) it also serves
+    requests that reference a cached prefix, answering with the first pair
+    the request points at.
+    """
+
+    def __init__(self, latency_ms=0.0, ms_per_kchar=0.0, cache_backend=None):
+        self.latency_ms = latency_ms
+        self.ms_per_kchar = ms_per_kchar
+        self.cache_backend = cache_backend
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        delay = self.latency_ms + self.ms_per_kchar * len(data) / 1000
+        if delay:
+            time.sleep(delay / 1000)
+        cached = json.loads(data).get('cachedContent')
+        if cached:
+            return self._answer_cached(cached, _prompt(data))
+        context = _prompt(data).split(_CONTEXT_MARK, 1)[-1]
+        if "إجابة: " in context:
+            return FakeResponse(context.split("إجابة: ", 1)[1].split("\n---", 1)[0].strip())
+        return FakeResponse(NOT_AVAILABLE)
+
+    def _answer_cached(self, name, prompt):
+        prefix = self.cache_backend.resolve(name) if self.cache_backend is not None else None
+        if prefix is None:
+            return FakeResponse(f"unknown cached content: {name}", status_code=404)
+        ref = _REF.search(prompt.rsplit(_QUESTION_MARK, 1)[0])
+        if ref:
+            entry = prefix.split(f"[{ref.group(1)}] سؤال: ", 1)[-1]
+            if "إجابة: " in entry:
+                return FakeResponse(entry.split("إجابة: ", 1)[1].split("\n---", 1)[0].strip())
+        return FakeResponse(NOT_AVAILABLE)
+
+
+class RecordedGemini:
+    """Replays answers saved by an earlier run (--save-responses), looked up by question."""
+
+    def __init__(self, path):
+        self.answers = {}
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    self.answers[record['query']] = record['answer']
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        query = _prompt(data).rsplit(_QUESTION_MARK, 1)[-1]
+        if query not in self.answers:
+            return FakeResponse(f"no recorded response for: {query}", status_code=404)
+        return FakeResponse(self.answers[query])
+
+
+def load_pairs(path):
+    from training import parse_training_text
+    with open(path, 'r', encoding='utf-8') as f:
+        return parse_training_text(f.read())
+
+
+def load_cases(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def distractor_pairs(pairs, count, seed=0):
+    """``count`` synthetic pairs built from the KB's own vocabulary."""
+    rng = random.Random(seed)
+    words = sorted({w for question, answer in pairs for w in (question + " " + answer).split() if len(w) > 2})
+    return [
+        (" ".join(rng.choices(words, k=6)) + "؟", " ".join(rng.choices(words, k=15)))
+        for _ in range(count)
+    ]
+
+
+def is_correct(response, expected_answer):
+    if expected_answer is None:
+        return _NOT_AVAILABLE_MARK in normalize(response)
+    expected = set(tokenize(expected_answer))
+    if not expected:
+        return normalize(expected_answer) in normalize(response)
+    return len(expected & set(tokenize(response))) / len(expected) >= ANSWER_MATCH
+
+
+def _percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+# Per-process engine, built once by _init_worker (or directly for thread pools)
+_worker = {}
+
+
+def build_engine(pairs, config, llm):
+    kb = ai_engine.StaticKnowledgeBase.from_pairs(pairs, vectors=config['vectors'])
+    cache_backend = None
+    if config['context_cache']:
+        cache_backend = context_cache.LocalCacheBackend() if llm['kind'] != 'live' else None
+    if llm['kind'] == 'fake':
+        client = FakeGemini(llm['latency_ms'], llm['ms_per_kchar'], cache_backend)
+    elif llm['kind'] == 'recorded':
+        client = RecordedGemini(llm['responses'])
+    else:
+        client = None  # requests.Session
+    scheduler = None
+    if llm['kind'] == 'live' and ai_engine.LLM_SCHEDULER:
+        # Live runs draw on the production quota, behind web and Telegram traffic
+        scheduler = llm_scheduler.default_scheduler()
+    cache = None
+    if config['context_cache']:
+        # Cache whatever the size, so small test KBs exercise the cached path too
+        cache = context_cache.ContextCache(
+            cache_backend or context_cache.GeminiCacheBackend(client), min_tokens=0
+        )
+    options = {'direct_threshold': config['direct_threshold'], 'limit': config['context_limit']}
+    return ai_engine.AIEngine(
+        kb, http_client=client, history_turns=config['history_turns'], retrieval_options=options,
+        primary_url=GEMINI_MODEL_URL.format(model=config['model'], key=ai_engine.GEMINI_API_KEY),
+        fallback_url=None, scheduler=scheduler, priority=llm_scheduler.PRIORITY_BATCH, context_cache=cache
+    )
+
+
+def _init_worker(pairs, config, llm):
+    _worker['engine'] = build_engine(pairs, config, llm)
+
+
+def run_case(case, engine=None):
+    engine = engine or _worker['engine']
+    started = time.perf_counter()
+    prepared = engine.prepare(case['query'], history=case['history'])
+    retrieved = time.perf_counter()
+    answer = engine.complete(prepared)
+    finished = time.perf_counter()
+    # What is uploaded per request: without the instruction and KB when they are cached
+    uploaded = prepared.cached_payload if engine.context_cache is not None and prepared.cached_payload else prepared.payload
+    prompt_chars = len(json.dumps(uploaded, ensure_ascii=False)) if uploaded else 0
+    return {
+        'query': case['query'],
+        'route': prepared.route,
+        'llm_call': prepared.payload is not None,
+        'answer': answer,
+        'correct': is_correct(answer, case['expected_answer']),
+        'retrieval_ms': (retrieved - started) * 1000,
+        'latency_ms': (finished - started) * 1000,
+        'prompt_chars': prompt_chars,
+    }
+
+
+def evaluate_config(pairs, cases, config, llm, workers=1, pool='thread'):
+    """Run every case under one configuration. Returns (summary, per-case results)."""
+    kb_pairs = pairs + distractor_pairs(pairs, config['distractors'])
+    history = [
+        {"role": role, "content": text}
+        for case in cases[:config['history_turns'] // 2] for role, text in (("user", case['query']), ("assistant", "."))
+    ]
+    jobs = [dict(case, history=history) for case in cases]
+
+    started = time.perf_counter()
+    if pool == 'process' and workers > 1:
+        with concurrent.futures.ProcessPoolExecutor(
+            workers, initializer=_init_worker, initargs=(kb_pairs, config, llm)
+        ) as executor:
+            results = list(executor.map(run_case, jobs))
+    else:
+        engine = build_engine(kb_pairs, config, llm)
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            results = list(executor.map(lambda job: run_case(job, engine), jobs))
+    elapsed = time.perf_counter() - started
+
+    latencies = [r['latency_ms'] for r in results]
+    prompts = [r['prompt_chars'] for r in results if r['llm_call']]
+    answerable = [r for r, case in zip(results, cases) if case['expected_answer'] is not None]
+    summary = dict(config)
+    summary.update({
+        'kb_pairs': len(kb_pairs),
+        'accuracy': sum(r['correct'] for r in results) / len(results),
+        'answerable_accuracy': sum(r['correct'] for r in answerable) / len(answerable) if answerable else 1.0,
+        'llm_calls': sum(r['llm_call'] for r in results),
+        'latency_p50_ms': _percentile(latencies, 0.5),
+        'latency_p95_ms': _percentile(latencies, 0.95),
+        'latency_p99_ms': _percentile(latencies, 0.99),
+        'retrieval_p50_ms': _percentile([r['retrieval_ms'] for r in results], 0.5),
+        'prompt_chars_p50': _percentile(prompts, 0.5),
+        'prompt_chars_p95': _percentile(prompts, 0.95),
+        'prompt_chars_max': max(prompts, default=0),
+        'throughput_qps': len(results) / elapsed if elapsed else 0.0,
+    })
+    return summary, results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--kb", default=os.path.join(ROOT, "alhabib_medical_data.txt"))
+    parser.add_argument("--eval", default=os.path.join(ROOT, "eval", "retrieval_eval.jsonl"))
+    parser.add_argument("--llm", choices=("fake", "recorded", "live"), default="fake")
+    parser.add_argument("--responses", help="JSONL of recorded answers for --llm recorded")
+    parser.add_argument("--save-responses", help="write the model's answers of the last configuration as JSONL")
+    parser.add_argument("--fake-latency-ms", type=float, default=0.0)
+    parser.add_argument("--fake-ms-per-kchar", type=float, default=0.0)
+    parser.add_argument("--distractors", type=int, nargs="+", default=[0], help="synthetic pairs added to the KB")
+    parser.add_argument("--context-limits", type=int, nargs="+", default=[retrieval.KB_CONTEXT_LIMIT])
+    parser.add_argument("--direct-thresholds", type=float, nargs="+",
+                        default=[retrieval.DIRECT_THRESHOLD], help="above 1 disables direct answers")
+    parser.add_argument("--history-turns", type=int, nargs="+", default=[ai_engine.HISTORY_TURNS])
+    parser.add_argument("--models", nargs="+", default=["gemini-2.5-flash"])
+    parser.add_argument("--context-cache", type=int, nargs="+", choices=(0, 1), default=[0],
+                        help="1: instruction and whole KB in a cached prefix (see context_cache.py)")
+    parser.add_argument("--no-vectors", action="store_true", help="lexical retrieval only")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--pool", choices=("thread", "process"), default="thread")
+    parser.add_argument("--output", help="write the full report (summaries and every answer) as JSON")
+    args = parser.parse_args(argv)
+    if args.llm == "recorded" and not args.responses:
+        parser.error("--llm recorded needs --responses")
+
+    pairs = load_pairs(args.kb)
+    answers = {normalize(q): a for q, a in pairs}
+    cases = []
+    for case in load_cases(args.eval):
+        expected = case.get('expected')
+        if expected and normalize(expected) not in answers:
+            raise SystemExit(f"Expected question not in the KB: {expected}")
+        cases.append({'query': case['query'], 'expected_answer': answers[normalize(expected)] if expected else None})
+
+    llm = {'kind': args.llm, 'responses': args.responses,
+           'latency_ms': args.fake_latency_ms, 'ms_per_kchar': args.fake_ms_per_kchar}
+    grid = itertools.product(args.distractors, args.context_limits, args.direct_thresholds,
+                             args.history_turns, args.models, args.context_cache)
+    print(f"KB pairs: {len(pairs)}   questions: {len(cases)}   llm: {args.llm}   workers: {args.workers} ({args.pool})")
+    print(f"{'kb':>7}{'ctx':>5}{'direct':>8}{'hist':>6}  {'model':<18}{'cache':>6}{'acc':>7}{'llm':>5}"
+          f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'prompt p50':>12}{'p95':>8}")
+    report = {'kb': args.kb, 'eval': args.eval, 'llm': args.llm, 'configurations': []}
+    results = []
+    for distractors, context_limit, direct_threshold, history_turns, model, cached in grid:
+        config = {'distractors': distractors, 'context_limit': context_limit, 'direct_threshold': direct_threshold,
+                  'history_turns': history_turns, 'model': model, 'vectors': not args.no_vectors,
+                  'context_cache': bool(cached)}
+        summary, results = evaluate_config(pairs, cases, config, llm, args.workers, args.pool)
+        report['configurations'].append({'summary': summary, 'results': results})
+        print(f"{summary['kb_pairs']:>7}{context_limit:>5}{direct_threshold:>8.2f}{history_turns:>6}  {model:<18}{cached:>6}"
+              f"{summary['accuracy']:>7.1%}{summary['llm_calls']:>5}{summary['latency_p50_ms']:>9.1f}"
+              f"{summary['latency_p95_ms']:>9.1f}{summary['latency_p99_ms']:>9.1f}"
+              f"{summary['prompt_chars_p50']:>12.0f}{summary['prompt_chars_p95']:>8.0f}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=1)
+        print(f"\nReport written to {args.output}")
+    if args.save_responses:
+        with open(args.save_responses, 'w', encoding='utf-8') as f:
+            for r in results:
+                if r['llm_call']:
+                    f.write(json.dumps({'query': r['query'], 'answer': r['answer']}, ensure_ascii=False) + "\n")
+        print(f"Model answers written to {args.save_responses}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,34 @@
+"""
+Delete upload files that are no longer needed (see upload_store.collect_garbage).
+
+Meant to run periodically, e.g. from cron:
+
+    python gc_uploads.py            # delete
+    python gc_uploads.py --dry-run  # only report
+"""
+import sys
+import argparse
+from app import app
+from upload_store import collect_garbage, GC_GRACE_SECONDS, RETENTION_DAYS
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dry-run", action="store_true", help="report what would be deleted")
+    parser.add_argument("--grace-seconds", type=int, default=GC_GRACE_SECONDS)
+    parser.add_argument("--retention-days", type=int, default=RETENTION_DAYS)
+    args = parser.parse_args(argv)
+
+    with app.app_context():
+        report = collect_garbage(
+            app.config['UPLOAD_FOLDER'], grace_seconds=args.grace_seconds,
+            retention_days=args.retention_days, dry_run=args.dry_run
+        )
+    action = "Would free" if args.dry_run else "Freed"
+    print(f"{action} {report['bytes_freed']} bytes: {report['orphaned']} orphaned, "
+          f"{report['incomplete']} incomplete, {report['expired']} expired; "
+          f"{report['adopted']} legacy files moved to content-addressed storage")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,6 +3,7 @@ import re
 from app import create_app
 from database import db
 from models import TrainingData, User
+from dedupe import Deduplicator
 
 def parse_training_data(file_path):
     with open(file_path, 'r', encoding='utf-8') as f:
@@ -35,25 +36,18 @@ def import_data():
         
         print(f"Found {len(training_items)} training items.")
         
+        # Exact and near-duplicate questions are skipped
+        deduplicator = Deduplicator(user.id, policy='skip')
         for item in training_items:
-            # Check if already exists to avoid duplicates
-            exists = TrainingData.query.filter_by(
-                user_id=user.id, 
-                question=item['question']
-            ).first()
-            
-            if not exists:
-                new_data = TrainingData(
-                    user_id=user.id,
-                    question=item['question'],
-                    answer=item['answer'],
-                    source_type='file',
-                    source_name='alhabib_training_data_extensive.txt'
-                )
-                db.session.add(new_data)
+            deduplicator.add(
+                item['question'], item['answer'],
+                source_type='file', source_name='alhabib_training_data_extensive.txt'
+            )
         
         db.session.commit()
-        print("Successfully imported training data.")
+        report = deduplicator.report
+        print(f"Successfully imported training data: {report['inserted']} new, "
+              f"{report['exact_duplicates'] + report['near_duplicates']} duplicates skipped.")
 
 if __name__ == "__main__":
     import_data()
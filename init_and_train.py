@@ -3,13 +3,14 @@ import sys
 from app import app, db
 from models import User, TrainingData, TrainingFile
 from training import process_training_file
-import shutil
+from schema import upgrade_schema
+from upload_store import save_stream, find_processed
 
 def init_and_train():
     with app.app_context():
         # 1. Create tables
         print("Creating database tables...")
-        db.create_all()
+        upgrade_schema()
         
         # 2. Create a default user if not exists
         admin = User.query.filter_by(username='admin').first()
@@ -31,22 +32,27 @@ def init_and_train():
             return
 
         upload_folder = app.config['UPLOAD_FOLDER']
-        os.makedirs(upload_folder, exist_ok=True)
-        
-        unique_filename = "alhabib_medical_data_v1.txt"
-        dest_path = os.path.join(upload_folder, unique_filename)
-        shutil.copy(source_file, dest_path)
+        with open(source_file, 'rb') as f:
+            content_hash, size, stored_name = save_stream(f, upload_folder)
         
         # 4. Create TrainingFile record
-        # Check if already exists to avoid duplicates
-        existing_file = TrainingFile.query.filter_by(original_filename='alhabib_medical_data.txt').first()
+        # Identical content already trained: nothing to do
+        previous = find_processed(admin.id, content_hash)
+        if previous:
+            print(f"Training file already processed (ID {previous.id}).")
+            return
+        # Retry an earlier attempt with this content rather than adding another record
+        existing_file = TrainingFile.query.filter_by(
+            user_id=admin.id, content_hash=content_hash
+        ).order_by(TrainingFile.id).first()
         if not existing_file:
             training_file = TrainingFile(
                 user_id=admin.id,
-                filename=unique_filename,
+                filename=stored_name,
                 original_filename='alhabib_medical_data.txt',
-                file_size=os.path.getsize(dest_path),
+                file_size=size,
                 file_type='text/plain',
+                content_hash=content_hash,
                 status='processing'
             )
             db.session.add(training_file)
@@ -0,0 +1,449 @@
+"""
+Pre-LLM routing of messages that need no knowledge-base answer.
+
+Greetings, thanks, goodbyes, "ok"/emoji acknowledgements, "how are you",
+a bare phone number and requests for contact details get a templated reply
+without a Gemini call. Both the web chat and the Telegram bot ask the router
+first:
+
+    routed = route_message(text, channel)   -> Routed(intent, reply, phone) or None
+
+Two stages, both pure in-memory lookups (well under a millisecond):
+
+    rules        the normalized message is short and made only of intent
+                 vocabulary (plus fillers such as "يا" or "جزيلا"), so
+                 "السلام عليكم، ما أسعار الأجهزة؟" still goes to the model
+    classifier   a naive Bayes model over words and character trigrams, trained
+                 from logged messages labelled by the rules (python intent_router.py
+                 train), catches variants the rules miss ("مشكووورين يا غالي");
+                 it only answers short messages and only above CLASSIFIER_THRESHOLD
+
+Replies are AppSetting values (intent_reply_<intent>), with DEFAULT_REPLIES
+when unset; an intent whose reply is empty goes to the model as before.
+Contact requests have no default, because the contact details normally live
+in the knowledge base. Checked and routed messages are counted in
+stat_counters and exported at /metrics (see metrics.py).
+
+    python intent_router.py train              fit the classifier on logged messages
+    python intent_router.py check "شكراً لك"   show how a message is routed
+"""
+import os
+import re
+import sys
+import json
+import math
+import time
+import logging
+import argparse
+import threading
+from collections import Counter
+from arabic_text import normalize
+
+logger = logging.getLogger(__name__)
+
+INTENT_ROUTER = os.environ.get("INTENT_ROUTER", "1") == "1"
+# Posterior the classifier needs before a message skips the model
+CLASSIFIER_THRESHOLD = float(os.environ.get("INTENT_CLASSIFIER_THRESHOLD", "0.9"))
+# Longer messages are always left to the model
+MAX_TOKENS = 6
+# Logged messages read by `train`, newest first
+TRAIN_LIMIT = 20000
+# Features seen fewer times are dropped from the stored model
+MIN_FEATURE_COUNT = 2
+# Seconds the templates and the model are reused before checking AppSetting again
+SETTINGS_TTL = int(os.environ.get("INTENT_SETTINGS_TTL", "60"))
+
+GREETING = 'greeting'
+THANKS = 'thanks'
+GOODBYE = 'goodbye'
+ACK = 'ack'
+SMALL_TALK = 'small_talk'
+CONTACT = 'contact'
+PHONE = 'phone'
+KNOWLEDGE = 'knowledge'
+INTENTS = (GREETING, THANKS, GOODBYE, ACK, SMALL_TALK, CONTACT, PHONE)
+# Intents that may share a message, in order of precedence on ties
+SOCIAL = (GREETING, THANKS, GOODBYE, SMALL_TALK, ACK)
+
+REPLY_KEY = "intent_reply_{}"
+MODEL_KEY = "intent_model"
+
+DEFAULT_REPLIES = {
+    GREETING: "وعليكم السلام ورحمة الله وبركاته، أهلاً بك في مؤسسة الحبيب للمستلزمات الطبية. كيف يمكنني مساعدتك؟",
+    THANKS: "العفو، سعداء بخدمتك. هل يمكنني مساعدتك في شيء آخر؟",
+    GOODBYE: "شكراً لتواصلك مع مؤسسة الحبيب للمستلزمات الطبية، نتمنى لك يوماً سعيداً.",
+    ACK: "هل يمكنني مساعدتك في شيء آخر؟",
+    SMALL_TALK: "بخير والحمد لله، شكراً لسؤالك. كيف يمكنني مساعدتك اليوم؟",
+    PHONE: "شكراً لك، تم حفظ رقم هاتفك بنجاح. كيف يمكنني مساعدتك الآن؟",
+    CONTACT: "",
+}
+
+# Written in normalized form (see arabic_text.normalize), repeated letters collapsed
+VOCABULARY = {
+    GREETING: """
+        السلام سلام عليكم عليك وعليكم ورحمه رحمه الله وبركاته مرحبا مرحبتين مراحب اهلا اهلين هلا
+        هلو هاي صباح مساء الخير النور hi hello hey salam
+    """,
+    THANKS: """
+        شكرا شكر شكرن مشكور مشكورين مشكوره يعطيك يعطيكم العافيه جزاك جزاكم خيرا خير تسلم
+        تسلمو تسلموا تسلمي ممنون ممنونك thanks thank thx merci
+    """,
+    GOODBYE: """
+        مع السلامه باي وداعا الي اللقاء لقاء تصبح تصبحون بخير في امان الله bye goodbye
+    """,
+    ACK: """
+        ok okay okey اوكي اوك اوكيه تمام طيب حسنا ماشي زين عظيم ممتاز رائع جميل فهمت واضح
+    """,
+    SMALL_TALK: """
+        كيف كيفك كيفكم حالك حالكم الحال شلونك شلونكم اخبارك اخباركم عامل عاملين ايش وش انت انتم
+        how are
+    """,
+    CONTACT: """
+        رقم رقمكم ارقام هاتف هاتفكم تلفون تليفون جوال جوالكم موبايل واتساب واتس الواتس ايميل
+        الايميل بريد البريد تواصل التواصل اتواصل نتواصل اتصال الاتصال اتصل نتصل معكم بكم لكم
+        عندكم لديكم الخاص خاص ممكن اريد ابغي ابي ابغا عطني اعطني ارسل ارسلو كيف ما هو
+        phone number contact whatsapp email
+    """,
+}
+VOCABULARY = {intent: frozenset(words.split()) for intent, words in VOCABULARY.items()}
+# Words that may accompany any intent
+FILLERS = frozenset("""
+    يا و لك لكم جدا جزيلا كثير كتير اخي اخوي اخت اختي عزيزي الغالي غالي حبيبي استاذ دكتور
+    علي المساعده مساعدتك مساعدتكم الجميع very much you so
+""".split())
+# Intents that need one of these words, not only generic ones ("ممكن" is no contact request, "كيف" no small talk)
+KEYWORDS = {
+    CONTACT: frozenset("""
+        رقم رقمكم ارقام هاتف هاتفكم تلفون تليفون جوال جوالكم موبايل واتساب واتس الواتس ايميل
+        الايميل بريد البريد تواصل التواصل اتواصل نتواصل اتصال الاتصال اتصل نتصل phone number
+        contact whatsapp email
+    """.split()),
+    SMALL_TALK: frozenset("كيفك كيفكم حالك حالكم الحال شلونك شلونكم اخبارك اخباركم how".split()),
+}
+
+_WORD = re.compile(r'\w+', re.UNICODE)
+_REPEATS = re.compile(r'(.)\1{2,}')
+_PHONE = re.compile(r'^\+?[\d\s\-().]+$')
+# International (+ or 00 and 8-15 digits), Saudi mobile (05 and 8 digits) or Yemeni mobile
+# (7x and 7 digits, with or without the leading 0): other digit runs are order numbers or quantities
+_PHONE_SHAPE = re.compile(r'^(?:(?:\+|00)\d{8,15}|05\d{8}|0?7[01378]\d{7})$')
+# Letters or digits in any script; a message without any is emoji or punctuation only
+_HAS_TEXT = re.compile(r'[^\W_]', re.UNICODE)
+
+
+def _words(text):
+    # "شكراااا" and "شكرا" are the same word here
+    return _REPEATS.sub(r'\1', normalize(text)).replace('_', ' ')
+
+
+def tokens(text):
+    return _WORD.findall(_words(text))
+
+
+def features(text):
+    """Words and padded character trigrams of each word."""
+    found = []
+    for word in tokens(text):
+        found.append(word)
+        padded = f" {word} "
+        found.extend(f"#{padded[i:i + 3]}" for i in range(len(padded) - 2))
+    return found
+
+
+def phone_number(text):
+    """The number if the whole message is a phone number, else None."""
+    text = normalize(text)
+    if not _PHONE.match(text):
+        return None
+    compact = re.sub(r'[\s\-().]', '', text)
+    if not _PHONE_SHAPE.match(compact):
+        return None
+    return compact
+
+
+def match_rules(text):
+    """The intent whose vocabulary covers the whole message, or None."""
+    if not text or not text.strip():
+        return None
+    if phone_number(text):
+        return PHONE
+    words = tokens(text)
+    if not words:
+        # Emoji, stickers as text, punctuation
+        return ACK if not _HAS_TEXT.search(text) else None
+    if len(words) > MAX_TOKENS:
+        return None
+    content = [w for w in words if w not in FILLERS]
+    if not content:
+        return None
+    if all(w in VOCABULARY[CONTACT] for w in content):
+        return CONTACT if any(w in KEYWORDS[CONTACT] for w in content) else None
+    # Social intents may be combined ("السلام عليكم كيف حالك"); the one with most words wins
+    if not all(any(w in VOCABULARY[intent] for intent in SOCIAL) for w in content):
+        return None
+    best, best_hits = None, 0
+    for intent in SOCIAL:
+        keywords = KEYWORDS.get(intent)
+        if keywords is not None and not any(w in keywords for w in content):
+            continue
+        hits = sum(w in VOCABULARY[intent] for w in content)
+        if hits > best_hits:
+            best, best_hits = intent, hits
+    return best
+
+
+class NaiveBayes:
+    """Multinomial naive Bayes over features(); small enough to live in an AppSetting."""
+
+    def __init__(self, priors, weights, unseen):
+        self.priors = priors      # class -> log prior
+        self.weights = weights    # feature -> {class: log likelihood}
+        self.unseen = unseen      # class -> log likelihood of a feature the class never had
+
+    @classmethod
+    def fit(cls, examples, min_count=MIN_FEATURE_COUNT):
+        """``examples``: [(text, label)]."""
+        class_counts = Counter()
+        feature_counts = {}
+        for text, label in examples:
+            class_counts[label] += 1
+            for feature in features(text):
+                feature_counts.setdefault(feature, Counter())[label] += 1
+
+        feature_counts = {f: c for f, c in feature_counts.items() if sum(c.values()) >= min_count}
+        totals = Counter()
+        for counts in feature_counts.values():
+            totals.update(counts)
+        vocabulary = len(feature_counts) or 1
+        total = sum(class_counts.values())
+        priors = {label: math.log(count / total) for label, count in class_counts.items()}
+        # Laplace smoothing
+        unseen = {label: -math.log(totals[label] + vocabulary) for label in class_counts}
+        weights = {
+            feature: {label: math.log(counts[label] + 1) + unseen[label] for label in counts}
+            for feature, counts in feature_counts.items()
+        }
+        return cls(priors, weights, unseen)
+
+    def predict(self, text):
+        """(label, posterior) of the most likely class."""
+        scores = dict(self.priors)
+        for feature in features(text):
+            weights = self.weights.get(feature)
+            if weights is None:
+                continue
+            for label in scores:
+                scores[label] += weights.get(label, self.unseen[label])
+        label = max(scores, key=scores.get)
+        top = scores[label]
+        posterior = 1.0 / sum(math.exp(score - top) for score in scores.values())
+        return label, posterior
+
+    def to_json(self):
+        return json.dumps({'priors': self.priors, 'weights': self.weights, 'unseen': self.unseen},
+                          ensure_ascii=False, separators=(',', ':'))
+
+    @classmethod
+    def from_json(cls, text):
+        data = json.loads(text)
+        return cls(data['priors'], data['weights'], data['unseen'])
+
+
+class Routed:
+    __slots__ = ("intent", "reply", "phone", "stage")
+
+    def __init__(self, intent, reply, phone=None, stage='rules'):
+        self.intent = intent
+        self.reply = reply
+        self.phone = phone
+        self.stage = stage
+
+
+class IntentRouter:
+    """Rules, then the classifier; routes only intents that have a reply."""
+
+    def __init__(self, replies=None, model=None, threshold=CLASSIFIER_THRESHOLD):
+        self.replies = dict(DEFAULT_REPLIES, **(replies or {}))
+        self.model = model
+        self.threshold = threshold
+
+    def route(self, text):
+        if not text:
+            return None
+        intent, stage = match_rules(text), 'rules'
+        if intent is None and self.model is not None:
+            words = tokens(text)
+            if 0 < len(words) <= MAX_TOKENS:
+                label, posterior = self.model.predict(text)
+                if label != KNOWLEDGE and label in self.replies and posterior >= self.threshold:
+                    intent, stage = label, 'classifier'
+        if intent is None:
+            return None
+        reply = self.replies.get(intent)
+        if not reply:
+            return None
+        return Routed(intent, reply, phone_number(text) if intent == PHONE else None, stage)
+
+
+def checked_key(channel):
+    return f"intent_checked_{channel}"
+
+
+def routed_key(channel, intent):
+    return f"intent_routed_{channel}_{intent}"
+
+
+def counter_keys(channels=('web', 'telegram')):
+    return [checked_key(c) for c in channels] + [routed_key(c, i) for c in channels for i in INTENTS]
+
+
+def _load_settings():
+    """(fingerprint, replies, model JSON) from AppSetting in one query."""
+    from models import AppSetting
+    rows = AppSetting.query.filter(AppSetting.key.like("intent_%")).all()
+    fingerprint = tuple(sorted((row.key, row.updated_at) for row in rows))
+    replies = {}
+    model = None
+    prefix = REPLY_KEY.format("")
+    for row in rows:
+        if row.key == MODEL_KEY:
+            model = row.value
+        elif row.key.startswith(prefix):
+            replies[row.key[len(prefix):]] = row.value.strip()
+    return fingerprint, replies, model
+
+
+_router = None
+_fingerprint = None
+_checked_at = 0.0
+_lock = threading.Lock()
+
+
+def get_router():
+    """The process-wide router, rebuilt when its AppSetting rows change (checked every SETTINGS_TTL s)."""
+    global _router, _fingerprint, _checked_at
+    now = time.monotonic()
+    if _router is not None and now - _checked_at < SETTINGS_TTL:
+        return _router
+    with _lock:
+        if _router is None or now - _checked_at >= SETTINGS_TTL:
+            try:
+                fingerprint, replies, model = _load_settings()
+                if _router is None or fingerprint != _fingerprint:
+                    if _router is None:
+                        from metrics import ensure_counters
+                        ensure_counters(counter_keys())
+                    _router = IntentRouter(replies, NaiveBayes.from_json(model) if model else None)
+                    _fingerprint = fingerprint
+            except Exception as e:
+                logger.error(f"Could not load intent router settings: {e}")
+                if _router is None:
+                    _router = IntentRouter()
+            _checked_at = now
+    return _router
+
+
+def route_message(text, channel):
+    """
+    Routed reply for ``text`` or None (answer with the model). Needs an app
+    context when the settings are due for a check. Counting is left to the
+    caller, which does it in its own transaction (see count_keys()).
+    """
+    if not INTENT_ROUTER:
+        return None
+    routed = get_router().route(text)
+    # Only the bot stores a customer's phone number
+    if routed is not None and routed.intent == PHONE and channel != 'telegram':
+        return None
+    if routed is not None:
+        logger.info(f"Routed {channel} message to intent {routed.intent} ({routed.stage})")
+    return routed
+
+
+def count_keys(channel, routed):
+    """stat_counters keys to increment for one checked message."""
+    keys = [checked_key(channel)]
+    if routed is not None:
+        keys.append(routed_key(channel, routed.intent))
+    return keys
+
+
+def training_examples(limit=TRAIN_LIMIT):
+    """
+    [(text, label)] from the stored questions and the logged customer
+    messages: messages the rules route get that intent; stored questions and
+    long messages are knowledge. Short unmatched messages are left out,
+    they are what the classifier has to decide.
+    """
+    from models import Message, TelegramMessage, TrainingData
+
+    examples = [(word, intent) for intent, vocabulary in VOCABULARY.items() for word in vocabulary
+                if intent not in KEYWORDS or word in KEYWORDS[intent]]
+    examples.extend((question, KNOWLEDGE) for (question,) in TrainingData.query.with_entities(TrainingData.question))
+    logged = []
+    for model in (Message, TelegramMessage):
+        logged.extend(content for (content,) in model.query.with_entities(model.content).filter(
+            model.role == 'user'
+        ).order_by(model.id.desc()).limit(limit))
+    for text in logged:
+        intent = match_rules(text)
+        if intent == PHONE:
+            continue
+        if intent is not None:
+            examples.append((text, intent))
+        elif len(tokens(text)) > MAX_TOKENS:
+            examples.append((text, KNOWLEDGE))
+    return examples
+
+
+def train(limit=TRAIN_LIMIT):
+    """Fit the classifier on the logged messages and store it in AppSetting."""
+    from database import db
+    from models import AppSetting
+
+    examples = training_examples(limit)
+    labels = Counter(label for _, label in examples)
+    if not labels[KNOWLEDGE]:
+        # A model that never saw a real question would route every short one
+        raise ValueError("No stored questions or long messages to learn the knowledge class from")
+    model = NaiveBayes.fit(examples)
+    setting = AppSetting.query.filter_by(key=MODEL_KEY).first()
+    if setting is None:
+        setting = AppSetting(key=MODEL_KEY, value="", description="Intent classifier (python intent_router.py train)")
+        db.session.add(setting)
+    setting.value = model.to_json()
+    db.session.commit()
+    logger.info(f"Intent classifier trained on {len(examples)} examples: {dict(labels)}")
+    return labels, len(model.weights)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+    train_parser = sub.add_parser("train", help="fit the classifier on logged messages")
+    train_parser.add_argument("--limit", type=int, default=TRAIN_LIMIT, help="logged messages per table")
+    check_parser = sub.add_parser("check", help="show how messages are routed")
+    check_parser.add_argument("messages", nargs="+")
+    args = parser.parse_args(argv)
+
+    from app import app
+    with app.app_context():
+        if args.command == "train":
+            try:
+                labels, features_kept = train(args.limit)
+            except ValueError as e:
+                raise SystemExit(str(e))
+            print(f"{sum(labels.values())} examples, {features_kept} features: "
+                  + ", ".join(f"{label} {count}" for label, count in labels.most_common()))
+            return
+        router = get_router()
+        for text in args.messages:
+            started = time.perf_counter()
+            routed = router.route(text)
+            elapsed = (time.perf_counter() - started) * 1000
+            target = f"{routed.intent} ({routed.stage})" if routed else "model"
+            print(f"{text!r}: {target}  {elapsed:.3f} ms")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
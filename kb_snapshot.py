@@ -0,0 +1,410 @@
+"""
+Knowledge-base snapshots shared by every process on the host.
+
+Rather than each gunicorn worker and Telegram process building a private
+KnowledgeIndex (memory growing with the number of processes), an owner's
+index is serialized into one immutable file that every process maps
+read-only, so its pages are shared through the OS page cache:
+
+    header      magic, JSON (owner, data fingerprint, section offsets)
+    rows        ids, user ids, updated_at, BM25 lengths
+    text        UTF-8 pool of question, answer and their normalized forms
+    postings    sorted vocabulary (UTF-8 pool), and per token a range of
+                document numbers and term frequencies
+    vectors     pair embeddings (see vector_index.py), grouped by IVF
+                cluster when there are enough of them
+
+When the training data changes, the first process to notice rebuilds the
+file under a lock and swaps it in with os.replace(). Processes keep serving
+the version they have mapped while the rebuild runs, and pick up the new one
+at their next check; a newly started worker maps the current file and is
+ready without loading anything. The rows are streamed into a CorpusStore
+(see corpus_store.py), whose buffers become the rows and text sections;
+only changed pairs are re-embedded, the vectors coming from the owner's
+VectorIndex files.
+
+    python kb_snapshot.py build              every owner with training data, and all rows
+    python kb_snapshot.py build --owner 3
+    python kb_snapshot.py info
+"""
+import os
+import sys
+import json
+import math
+import mmap
+import fcntl
+import bisect
+import logging
+import argparse
+import datetime
+import threading
+import numpy as np
+from arabic_text import token_string
+from corpus_store import FIELDS, CorpusStore, from_stamp
+from knowledge_index import Entry, KnowledgeIndex, data_fingerprint
+from vector_index import IVF_MIN_VECTORS, VECTOR_SEARCH, IVFLayout, VectorIndex, get_embedder, owner_folder
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"KBSNAP01"
+SNAPSHOT_NAME = "knowledge.snapshot"
+# Sections start on cache-line boundaries
+ALIGNMENT = 64
+
+
+def _aligned(size):
+    return -(-size // ALIGNMENT) * ALIGNMENT
+
+
+def _version(fingerprint):
+    # Comparable across processes, whatever types the database returned
+    return tuple(str(value) for value in fingerprint)
+
+
+def _decode(rows):
+    if rows.dtype == np.int8:
+        return rows.astype(np.float32) / 127.0
+    return np.asarray(rows)
+
+
+def snapshot_path(owner=None):
+    folder = owner_folder(owner)
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, SNAPSHOT_NAME)
+
+
+_embedder = None
+_embedder_lock = threading.Lock()
+
+
+def _shared_embedder():
+    # One per process, whatever the number of snapshots (a model embedder is costly to load)
+    global _embedder
+    with _embedder_lock:
+        if _embedder is None:
+            _embedder = get_embedder()
+        return _embedder
+
+
+def _write(path, header, sections):
+    layout, size = {}, 0
+    for name, array in sections.items():
+        layout[name] = [size, array.dtype.str, list(array.shape)]
+        size += _aligned(array.nbytes)
+    encoded = json.dumps(dict(header, sections=layout)).encode("utf-8")
+    start = _aligned(len(MAGIC) + 8 + len(encoded))
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC + len(encoded).to_bytes(8, "little") + encoded)
+        for name, array in sections.items():
+            f.seek(start + layout[name][0])
+            f.write(np.ascontiguousarray(array).data)
+        f.truncate(start + size)
+        f.flush()
+        os.fsync(f.fileno())
+    # Readers of the previous file keep their mapping; new readers get this one
+    os.replace(tmp_path, path)
+
+
+def build(owner=None, path=None):
+    """Write the snapshot of ``owner``'s training data (needs an app context). Returns its path."""
+    path = path or snapshot_path(owner)
+    # Only the building process holds the corpus, and only until the file is written
+    corpus = CorpusStore.load(owner)
+    n = len(corpus)
+
+    lengths = np.empty(n, dtype=np.int32)
+    postings = {}
+    for number, record in enumerate(corpus):
+        counts = KnowledgeIndex.term_counts(record)
+        lengths[number] = sum(counts.values())
+        for token, tf in counts.items():
+            postings.setdefault(token.encode("utf-8"), []).append((number, tf))
+    vocabulary = sorted(postings)
+    total = sum(len(posting) for posting in postings.values())
+
+    columns = corpus.arrays()
+    sections = {
+        "ids": columns["ids"],
+        "user_ids": columns["user_ids"],
+        "stamps": columns["updated"],
+        "lengths": lengths,
+        "text": columns["text"],
+        "text_offsets": columns["offsets"],
+        "tokens": np.frombuffer(b"".join(vocabulary), dtype=np.uint8),
+        "token_offsets": np.concatenate([[0], np.cumsum([len(t) for t in vocabulary])]).astype(np.int64),
+        "posting_offsets": np.concatenate([[0], np.cumsum([len(postings[t]) for t in vocabulary])]).astype(np.int64),
+        "posting_docs": np.fromiter((d for t in vocabulary for d, _ in postings[t]), dtype=np.int32, count=total),
+        "posting_tf": np.fromiter((tf for t in vocabulary for _, tf in postings[t]), dtype=np.int32, count=total),
+    }
+    del postings
+
+    vectors = None
+    if VECTOR_SEARCH and n:
+        vector_index = VectorIndex(embedder=_shared_embedder(), folder=owner_folder(owner))
+        vector_index.sync(corpus)
+        rows = vector_index.stored_rows(list(corpus.ids))
+        docs = np.arange(n, dtype=np.int32)
+        if n >= IVF_MIN_VECTORS:
+            centroids, assignments = IVFLayout.kmeans(_decode(rows))
+            order = np.argsort(assignments, kind="stable")
+            rows, docs = rows[order], docs[order]
+            counts = np.bincount(assignments, minlength=len(centroids))
+            sections["centroids"] = centroids.astype(np.float32)
+            sections["cluster_offsets"] = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        sections["vectors"] = rows
+        sections["vector_docs"] = docs
+        vectors = {"embedder": vector_index.embedder.name, "dim": vector_index.dim}
+
+    header = {
+        "owner": owner,
+        "fingerprint": _version(corpus.fingerprint),
+        "rows": n,
+        "total_length": int(sections["lengths"].sum()),
+        "vectors": vectors,
+        "created_at": datetime.datetime.utcnow().isoformat(),
+    }
+    _write(path, header, sections)
+    logger.info(f"Knowledge snapshot of owner {owner} written: {n} rows, {len(vocabulary)} tokens, "
+                f"{os.path.getsize(path) // 1024} KiB")
+    return path
+
+
+class SnapshotVectors:
+    """Vector search over the embeddings stored in a snapshot (same results as VectorIndex.search)."""
+
+    def __init__(self, embedder, rows, docs, ids, ivf=None):
+        self.embedder = embedder
+        self.rows = rows
+        self.docs = docs
+        self.ids = ids
+        self.ivf = ivf
+
+    def __len__(self):
+        return len(self.rows)
+
+    def search(self, query, limit=10):
+        """Return [(entry_id, cosine)] best first."""
+        if not len(self.rows):
+            return []
+        q = self.embedder.embed([query])[0]
+        ranges = [(0, len(self.rows))] if self.ivf is None else self.ivf.probe(q)[0]
+        slot_parts, score_parts = [], []
+        for start, end in ranges:
+            if end > start:
+                slot_parts.append(np.arange(start, end))
+                score_parts.append(_decode(self.rows[start:end]) @ q)
+        if not slot_parts:
+            return []
+
+        slots = np.concatenate(slot_parts)
+        scores = np.concatenate(score_parts)
+        k = min(limit, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        ids = self.ids[self.docs[slots[top]]]
+        return [(int(i), float(s)) for i, s in zip(ids, scores[top])]
+
+
+class Snapshot:
+    """
+    Read-only KnowledgeIndex over a snapshot file. Its arrays are views of
+    the shared mapping; Entry objects are only created for the rows asked for.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a knowledge snapshot")
+        size = int.from_bytes(self._map[len(MAGIC):len(MAGIC) + 8], "little")
+        header = json.loads(self._map[len(MAGIC) + 8:len(MAGIC) + 8 + size])
+        start = _aligned(len(MAGIC) + 8 + size)
+        if hasattr(mmap, "MADV_WILLNEED"):
+            self._map.madvise(mmap.MADV_WILLNEED)
+
+        self.path = path
+        self.owner = header["owner"]
+        self.fingerprint = tuple(header["fingerprint"])
+        self.created_at = header["created_at"]
+        # Counted against KB_MEMORY_LIMIT_MB like a private index, though the pages are shared
+        self.memory = len(self._map)
+        self._total_length = header["total_length"]
+
+        arrays = {}
+        for name, (offset, dtype, shape) in header["sections"].items():
+            dtype, count = np.dtype(dtype), math.prod(shape)
+            if count:
+                arrays[name] = np.frombuffer(self._map, dtype=dtype, count=count, offset=start + offset).reshape(shape)
+            else:
+                arrays[name] = np.empty(shape, dtype=dtype)
+        self._ids = arrays["ids"]
+        self._user_ids = arrays["user_ids"]
+        self._stamps = arrays["stamps"]
+        self._lengths = arrays["lengths"]
+        self._text = arrays["text"]
+        self._text_offsets = arrays["text_offsets"]
+        self._tokens = arrays["tokens"]
+        self._token_offsets = arrays["token_offsets"]
+        self._posting_offsets = arrays["posting_offsets"]
+        self._posting_docs = arrays["posting_docs"]
+        self._posting_tf = arrays["posting_tf"]
+
+        self.vectors = None
+        if header["vectors"]:
+            embedder = _shared_embedder()
+            if (embedder.name, embedder.dim) != (header["vectors"]["embedder"], header["vectors"]["dim"]):
+                logger.warning(f"{path} holds {header['vectors']['embedder']} vectors; "
+                               f"vector search is off until it is rebuilt with {embedder.name}")
+            else:
+                ivf = None
+                if "centroids" in arrays:
+                    ivf = IVFLayout(arrays["centroids"], arrays["cluster_offsets"])
+                self.vectors = SnapshotVectors(embedder, arrays["vectors"], arrays["vector_docs"], self._ids, ivf)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, entry_id):
+        return self._number(entry_id) is not None
+
+    def _number(self, entry_id):
+        number = int(np.searchsorted(self._ids, entry_id))
+        if number < len(self._ids) and self._ids[number] == entry_id:
+            return number
+        return None
+
+    def _entry(self, number):
+        offsets = self._text_offsets[len(FIELDS) * number:len(FIELDS) * (number + 1) + 1]
+        texts = [self._text[offsets[k]:offsets[k + 1]].tobytes().decode("utf-8") for k in range(len(FIELDS))]
+        entry = Entry(int(self._ids[number]), int(self._user_ids[number]), *texts,
+                      from_stamp(self._stamps[number]))
+        entry.length = int(self._lengths[number])
+        return entry
+
+    def get(self, entry_id):
+        number = self._number(entry_id)
+        return None if number is None else self._entry(number)
+
+    def entries(self):
+        return [self._entry(number) for number in range(len(self._ids))]
+
+    def stamps(self):
+        return {int(i): from_stamp(stamp) for i, stamp in zip(self._ids, self._stamps)}
+
+    def _token_at(self, position):
+        return self._tokens[self._token_offsets[position]:self._token_offsets[position + 1]].tobytes()
+
+    def _postings(self, token):
+        key = token.encode("utf-8")
+        size = len(self._token_offsets) - 1
+        position = bisect.bisect_left(range(size), key, key=self._token_at)
+        if position == size or self._token_at(position) != key:
+            return None
+        start, end = self._posting_offsets[position], self._posting_offsets[position + 1]
+        return self._posting_docs[start:end], self._posting_tf[start:end]
+
+    def search(self, query, limit=10, user_id=None):
+        """Return [(entry_id, score)] best first for a raw (unnormalized) query (BM25 as in KnowledgeIndex)."""
+        tokens = set(token_string(query).split())
+        n = len(self._ids)
+        if not tokens or not n:
+            return []
+
+        k1, b = KnowledgeIndex.K1, KnowledgeIndex.B
+        avg_length = self._total_length / n
+        doc_parts, score_parts = [], []
+        for token in tokens:
+            posting = self._postings(token)
+            if posting is None:
+                continue
+            docs, tf = posting[0], posting[1].astype(np.float64)
+            idf = math.log(1 + (n - len(docs) + 0.5) / (len(docs) + 0.5))
+            norm = tf + k1 * (1 - b + b * self._lengths[docs] / avg_length)
+            doc_parts.append(docs)
+            score_parts.append(idf * tf * (k1 + 1) / norm)
+        if not doc_parts:
+            return []
+
+        docs, inverse = np.unique(np.concatenate(doc_parts), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(score_parts))
+        if user_id is not None:
+            mine = self._user_ids[docs] == user_id
+            docs, scores = docs[mine], scores[mine]
+        ids = self._ids[docs]
+        order = np.lexsort((ids, -scores))[:limit]
+        return [(int(ids[i]), float(scores[i])) for i in order]
+
+
+def open_snapshot(path):
+    """The snapshot at ``path``, or None if there is none (or it is unreadable)."""
+    try:
+        return Snapshot(path)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError) as e:
+        logger.warning(f"Ignoring unreadable knowledge snapshot {path}: {e}")
+        return None
+
+
+def current_snapshot(owner=None, previous=None):
+    """
+    The snapshot of ``owner``'s training data (needs an app context):
+    ``previous`` while the data is unchanged, else the file on disk, rebuilt
+    first if it is out of date too. While another process rebuilds it,
+    ``previous`` is served if there is one.
+    """
+    version = _version(data_fingerprint(owner))
+    if previous is not None and previous.fingerprint == version:
+        return previous
+    path = snapshot_path(owner)
+    snapshot = open_snapshot(path)
+    if snapshot is not None and snapshot.fingerprint == version:
+        return snapshot
+
+    with open(path + ".lock", "a") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | (fcntl.LOCK_NB if previous is not None else 0))
+        except BlockingIOError:
+            return previous
+        try:
+            # Another process may have written it while this one waited for the lock
+            snapshot = open_snapshot(path)
+            if snapshot is None or snapshot.fingerprint != version:
+                build(owner, path)
+                snapshot = open_snapshot(path)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return snapshot
+
+
+def _owners():
+    from database import db
+    from models import TrainingData
+    return [None] + sorted(db.session.scalars(db.select(TrainingData.user_id).distinct()))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["build", "info"])
+    parser.add_argument("--owner", type=int, action="append",
+                        help="user id (repeatable; default: every owner with training data, and all rows)")
+    args = parser.parse_args(argv)
+
+    from app import app
+    with app.app_context():
+        for owner in args.owner or _owners():
+            path = build(owner) if args.command == "build" else snapshot_path(owner)
+            snapshot = open_snapshot(path)
+            if snapshot is None:
+                print(f"owner {owner}: no snapshot")
+                continue
+            current = snapshot.fingerprint == _version(data_fingerprint(owner))
+            print(f"owner {owner}: {len(snapshot)} rows, {snapshot.memory / 1024 / 1024:.1f} MiB, "
+                  f"{len(snapshot.vectors) if snapshot.vectors is not None else 'no'} vectors, "
+                  f"written {snapshot.created_at}{'' if current else ' (out of date)'}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,362 @@
+import logging
+import math
+import os
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict
+from arabic_text import token_string
+
+logger = logging.getLogger(__name__)
+
+# Seconds between checks of whether training_data changed
+REFRESH_INTERVAL = float(os.environ.get("KB_REFRESH_INTERVAL", "5"))
+# Serve get_index() from shared memory-mapped snapshots instead of a private index (see kb_snapshot.py)
+KB_SNAPSHOT = os.environ.get("KB_SNAPSHOT", "1") == "1"
+# Rows loaded per query when (re)building the index
+LOAD_CHUNK_SIZE = 500
+# Memory the per-owner indexes may take together; least recently used owners are evicted beyond it
+KB_MEMORY_LIMIT = int(float(os.environ.get("KB_MEMORY_LIMIT_MB", "512")) * 1024 * 1024)
+# Estimated bytes of one posting (dict slot, key and count) and of an entry besides its strings
+POSTING_BYTES = 100
+ENTRY_BYTES = 400
+
+
+class Entry:
+    __slots__ = ("id", "user_id", "question", "answer", "question_norm", "answer_norm", "updated_at", "length")
+
+    def __init__(self, id, user_id, question, answer, question_norm, answer_norm, updated_at):
+        self.id = id
+        self.user_id = user_id
+        self.question = question
+        self.answer = answer
+        self.question_norm = question_norm
+        self.answer_norm = answer_norm
+        self.updated_at = updated_at
+        self.length = 0
+
+
+class KnowledgeIndex:
+    """
+    Inverted index over the precomputed TrainingData tokens.
+
+    Documents are scored with BM25; question tokens count twice so a match on
+    the stored question outranks an incidental match inside a long answer.
+    Nothing is re-normalized at query time except the query itself.
+    """
+
+    QUESTION_WEIGHT = 2
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self, owner=None):
+        self._entries = {}
+        self._postings = {}
+        self._by_question = {}
+        self._total_length = 0
+        self.fingerprint = None
+        # user_id whose training data the index holds (None: every owner's)
+        self.owner = owner
+        # Estimated size in bytes
+        self.memory = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, entry_id):
+        return entry_id in self._entries
+
+    def get(self, entry_id):
+        return self._entries.get(entry_id)
+
+    def entries(self):
+        return [self._entries[i] for i in sorted(self._entries)]
+
+    def stamps(self):
+        return {i: e.updated_at for i, e in self._entries.items()}
+
+    def add(self, entry):
+        if entry.id in self._entries:
+            self.remove(entry.id)
+
+        counts = self.term_counts(entry)
+        entry.length = sum(counts.values())
+        self._entries[entry.id] = entry
+        self._total_length += entry.length
+        self.memory += _entry_bytes(entry, len(counts))
+        for token, tf in counts.items():
+            self._postings.setdefault(token, {})[entry.id] = tf
+        self._by_question.setdefault(entry.question_norm, set()).add(entry.id)
+
+    @classmethod
+    def term_counts(cls, entry):
+        """Weighted term frequencies of an entry."""
+        counts = Counter()
+        for token in entry.question_norm.split():
+            counts[token] += cls.QUESTION_WEIGHT
+        for token in entry.answer_norm.split():
+            counts[token] += 1
+        return counts
+
+    def remove(self, entry_id):
+        entry = self._entries.pop(entry_id, None)
+        if entry is None:
+            return
+        self._total_length -= entry.length
+        tokens = set(entry.question_norm.split()) | set(entry.answer_norm.split())
+        self.memory -= _entry_bytes(entry, len(tokens))
+        for token in tokens:
+            posting = self._postings.get(token)
+            if posting is not None:
+                posting.pop(entry_id, None)
+                if not posting:
+                    del self._postings[token]
+        ids = self._by_question.get(entry.question_norm)
+        if ids is not None:
+            ids.discard(entry_id)
+            if not ids:
+                del self._by_question[entry.question_norm]
+
+    def search(self, query, limit=10, user_id=None):
+        """Return [(entry_id, score)] best first for a raw (unnormalized) query."""
+        tokens = set(token_string(query).split())
+        if not tokens or not self._entries:
+            return []
+
+        n = len(self._entries)
+        avg_length = self._total_length / n if n else 1
+        scores = {}
+        for token in tokens:
+            posting = self._postings.get(token)
+            if not posting:
+                continue
+            idf = math.log(1 + (n - len(posting) + 0.5) / (len(posting) + 0.5))
+            for entry_id, tf in posting.items():
+                length = self._entries[entry_id].length
+                norm = tf + self.K1 * (1 - self.B + self.B * length / avg_length)
+                scores[entry_id] = scores.get(entry_id, 0.0) + idf * tf * (self.K1 + 1) / norm
+
+        if user_id is not None:
+            scores = {i: s for i, s in scores.items() if self._entries[i].user_id == user_id}
+        return sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:limit]
+
+    def find_duplicates(self, question, user_id=None):
+        """Ids of entries whose normalized question equals that of ``question``."""
+        ids = self._by_question.get(token_string(question), ())
+        if user_id is not None:
+            ids = [i for i in ids if self._entries[i].user_id == user_id]
+        return sorted(ids)
+
+
+def _entry_bytes(entry, distinct_tokens):
+    strings = (entry.question, entry.answer, entry.question_norm, entry.answer_norm)
+    return ENTRY_BYTES + sum(sys.getsizeof(s) for s in strings) + POSTING_BYTES * distinct_tokens
+
+
+def _owned(query, owner):
+    from models import TrainingData
+    return query if owner is None else query.filter(TrainingData.user_id == owner)
+
+
+def data_fingerprint(owner=None):
+    """(rows, highest id, latest update) of ``owner``'s training data; changes with any insert, edit or delete."""
+    # Database imports stay local: the index itself is used without a Flask app (see ai_engine)
+    from sqlalchemy import func
+    from database import db
+    from models import TrainingData
+    return tuple(_owned(db.session.query(
+        func.count(TrainingData.id), func.max(TrainingData.id), func.max(TrainingData.updated_at)
+    ), owner).one())
+
+
+def _load_entries(ids):
+    from database import db
+    from models import TrainingData
+    columns = (
+        TrainingData.id, TrainingData.user_id, TrainingData.question, TrainingData.answer,
+        TrainingData.question_norm, TrainingData.answer_norm, TrainingData.updated_at
+    )
+    for start in range(0, len(ids), LOAD_CHUNK_SIZE):
+        chunk = ids[start:start + LOAD_CHUNK_SIZE]
+        for row in db.session.query(*columns).filter(TrainingData.id.in_(chunk)):
+            question_norm = row.question_norm if row.question_norm is not None else token_string(row.question)
+            answer_norm = row.answer_norm if row.answer_norm is not None else token_string(row.answer)
+            yield Entry(row.id, row.user_id, row.question, row.answer, question_norm, answer_norm, row.updated_at)
+
+
+def sync_index(index):
+    """Bring ``index`` up to date with its owner's training data, touching only changed rows."""
+    from database import db
+    from models import TrainingData
+
+    fingerprint = data_fingerprint(index.owner)
+    if fingerprint == index.fingerprint:
+        return 0
+
+    current = dict(_owned(db.session.query(TrainingData.id, TrainingData.updated_at), index.owner))
+    known = index.stamps()
+    for entry_id in known.keys() - current.keys():
+        index.remove(entry_id)
+    changed = [i for i, stamp in current.items() if i not in known or known[i] != stamp]
+    for entry in _load_entries(changed):
+        index.add(entry)
+
+    index.fingerprint = fingerprint
+    logger.info(f"Knowledge index of owner {index.owner} synced: {len(changed)} rows loaded, {len(index)} total")
+    return len(changed)
+
+
+class _Loaded:
+    __slots__ = ("index", "checked_at", "refreshing")
+
+    def __init__(self, index=None):
+        self.index = index
+        self.checked_at = 0.0
+        # A background thread is bringing the snapshot up to date
+        self.refreshing = False
+
+
+# owner -> _Loaded, least recently used first
+_indexes = OrderedDict()
+_lock = threading.Lock()
+# owner -> lock held while that owner's first snapshot is opened or built
+_first_loads = {}
+_evict_listeners = []
+
+
+def on_evict(listener):
+    """Call ``listener(owner, index)`` when an owner's index is dropped (to release what belongs to it)."""
+    _evict_listeners.append(listener)
+
+
+def _evict(limit=None):
+    limit = KB_MEMORY_LIMIT if limit is None else limit
+    total = sum(loaded.index.memory for loaded in _indexes.values())
+    # The most recently used index stays, even if it alone is over the limit
+    while total > limit and len(_indexes) > 1:
+        owner, loaded = _indexes.popitem(last=False)
+        total -= loaded.index.memory
+        logger.info(f"Evicted the knowledge index of owner {owner} ({len(loaded.index)} rows, "
+                    f"{loaded.index.memory // 1024} KiB est.)")
+        for listener in _evict_listeners:
+            listener(owner, loaded.index)
+
+
+def get_index(owner=None):
+    """
+    The index of ``owner``'s training data (None: every owner's), loaded on
+    first use and re-synced at most every REFRESH_INTERVAL seconds. With
+    KB_SNAPSHOT this is the owner's kb_snapshot.Snapshot, shared by every
+    process on the host.
+    """
+    if KB_SNAPSHOT:
+        return _snapshot_index(owner)
+    with _lock:
+        loaded = _indexes.get(owner) or _Loaded(KnowledgeIndex(owner))
+        now = time.monotonic()
+        if now - loaded.checked_at >= REFRESH_INTERVAL:
+            sync_index(loaded.index)
+            loaded.checked_at = now
+        # Registered once loaded, so a failed first load leaves nothing behind
+        _indexes[owner] = loaded
+        _indexes.move_to_end(owner)
+        _evict()
+    return loaded.index
+
+
+def _snapshot_index(owner):
+    """
+    The snapshot of ``owner``. Rebuilds run on a background thread, outside
+    _lock, while the previous snapshot keeps being served; only an owner
+    with no snapshot at all (in memory or on disk) waits for one to be built.
+    """
+    from kb_snapshot import current_snapshot, open_snapshot, snapshot_path
+
+    with _lock:
+        loaded = _indexes.get(owner)
+        if loaded is not None:
+            _indexes.move_to_end(owner)
+            _refresh_if_due(owner, loaded)
+            return loaded.index
+        first_load = _first_loads.setdefault(owner, threading.Lock())
+
+    with first_load:
+        with _lock:
+            loaded = _indexes.get(owner)
+        if loaded is not None:
+            return loaded.index
+        # A snapshot left on disk (by another process, or before a restart) is served while it is checked
+        index = open_snapshot(snapshot_path(owner))
+        checked = index is None
+        if index is None:
+            index = current_snapshot(owner)
+        with _lock:
+            loaded = _indexes[owner] = _Loaded(index)
+            if checked:
+                loaded.checked_at = time.monotonic()
+            _first_loads.pop(owner, None)
+            _evict()
+            _refresh_if_due(owner, loaded)
+        return index
+
+
+def _refresh_if_due(owner, loaded):
+    # Called with _lock held
+    if loaded.refreshing or time.monotonic() - loaded.checked_at < REFRESH_INTERVAL:
+        return
+    from flask import current_app
+    loaded.refreshing = True
+    threading.Thread(
+        target=_refresh, args=(current_app._get_current_object(), owner, loaded),
+        name=f"kb-refresh-{owner}", daemon=True
+    ).start()
+
+
+def _refresh(app, owner, loaded):
+    from database import db
+    from kb_snapshot import current_snapshot
+
+    index = loaded.index
+    with app.app_context():
+        try:
+            index = current_snapshot(owner, loaded.index)
+        except Exception as e:
+            logger.error(f"Refreshing the knowledge snapshot of owner {owner} failed: {e}")
+        finally:
+            db.session.remove()
+    with _lock:
+        loaded.index = index
+        loaded.checked_at = time.monotonic()
+        loaded.refreshing = False
+        if _indexes.get(owner) is loaded:
+            _evict()
+
+
+def cached_index(owner=None):
+    """The index of ``owner`` if it is loaded and not due for a database check, else None."""
+    with _lock:
+        loaded = _indexes.get(owner)
+        if loaded is None or time.monotonic() - loaded.checked_at >= REFRESH_INTERVAL:
+            return None
+        _indexes.move_to_end(owner)
+        return loaded.index
+
+
+def loaded_indexes():
+    """[(owner, rows, estimated bytes)] of the indexes in memory, least recently used first."""
+    with _lock:
+        return [(owner, len(loaded.index), loaded.index.memory) for owner, loaded in _indexes.items()]
+
+
+def mark_stale():
+    """
+    Force the next get_index() call of every owner to re-check the database.
+    With KB_SNAPSHOT (and an app context, as after an ingest) the snapshots
+    start rebuilding in the background right away.
+    """
+    from flask import has_app_context
+    with _lock:
+        for owner, loaded in _indexes.items():
+            loaded.checked_at = 0.0
+            if KB_SNAPSHOT and has_app_context():
+                _refresh_if_due(owner, loaded)
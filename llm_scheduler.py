@@ -0,0 +1,312 @@
+"""
+Admission control for outbound Gemini calls, shared by every process.
+
+Each model has a token bucket for its requests-per-minute and
+tokens-per-minute quota. With DatabaseBuckets the buckets live in the
+llm_quotas table, so gunicorn workers, the Telegram consumers and batch jobs
+draw from the same budget (updates are compare-and-set on a version column,
+so no row locks are needed on SQLite or PostgreSQL).
+
+Priority classes keep part of each bucket out of reach of lower classes:
+
+    PRIORITY_INTERACTIVE   web chat, may use the whole bucket
+    PRIORITY_TELEGRAM      leaves RESERVES[TELEGRAM] of the quota for the web
+    PRIORITY_BATCH         leaves half of it for the two above
+
+A request that cannot be admitted waits until the bucket has refilled, as
+long as that fits its deadline; otherwise LLMOverloaded is raised at once.
+While it waits, its class is marked as waiting on the bucket and lower
+classes are not admitted to that model, so refilled capacity goes to the
+highest class waiting for it. Waiters sleep until their bucket should have
+refilled and then try again; there is no wake-up across processes.
+When the preferred model is out of quota, a model that can serve the request
+now is chosen instead, and a 429 from Gemini empties the bucket of that model
+(for every process) before the request is scheduled again.
+"""
+import os
+import re
+import json
+import time
+import logging
+import threading
+from contextlib import nullcontext
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_TELEGRAM = 1
+PRIORITY_BATCH = 2
+
+# Share of each quota a priority class may not use (kept for the classes above it)
+RESERVES = {PRIORITY_INTERACTIVE: 0.0, PRIORITY_TELEGRAM: 0.1, PRIORITY_BATCH: 0.5}
+# Seconds a request may wait for quota before it fails
+DEADLINES = {
+    PRIORITY_INTERACTIVE: float(os.environ.get("LLM_DEADLINE_INTERACTIVE", "20")),
+    PRIORITY_TELEGRAM: float(os.environ.get("LLM_DEADLINE_TELEGRAM", "45")),
+    PRIORITY_BATCH: float(os.environ.get("LLM_DEADLINE_BATCH", "600")),
+}
+
+# Rough size of a token, used to charge a request before its usage is known
+CHARS_PER_TOKEN = 4
+# Output tokens charged up front; corrected from usageMetadata afterwards
+OUTPUT_TOKENS_ESTIMATE = int(os.environ.get("LLM_OUTPUT_TOKENS_ESTIMATE", "512"))
+# Seconds a model is considered exhausted after a 429 without Retry-After
+THROTTLE_SECONDS = 60
+# Seconds a waiting mark outlives the wait it was set for, covering the waiter's retry
+WAIT_MARGIN = 1.0
+
+
+class Quota:
+    __slots__ = ("rpm", "tpm")
+
+    def __init__(self, rpm, tpm):
+        self.rpm = rpm
+        self.tpm = tpm
+
+
+MODEL_QUOTAS = {
+    "gemini-2.5-flash": Quota(int(os.environ.get("GEMINI_25_RPM", "10")), int(os.environ.get("GEMINI_25_TPM", "250000"))),
+    "gemini-1.5-flash": Quota(int(os.environ.get("GEMINI_15_RPM", "15")), int(os.environ.get("GEMINI_15_TPM", "1000000"))),
+}
+
+_MODEL_NAME = re.compile(r'/models/([^:/?]+)')
+
+
+class LLMOverloaded(Exception):
+    """No model can serve the request before its deadline."""
+
+
+def model_name(url):
+    match = _MODEL_NAME.search(url or "")
+    return match.group(1) if match else url
+
+
+def estimate_tokens(payload):
+    """Tokens a generateContent request is charged for: prompt estimate plus expected output."""
+    chars = sum(
+        len(part.get("text", "")) for content in payload.get("contents", []) for part in content.get("parts", [])
+    )
+    return chars // CHARS_PER_TOKEN + OUTPUT_TOKENS_ESTIMATE
+
+
+def _refill(requests, tokens, refilled_at, quota, now):
+    elapsed = max(0.0, now - refilled_at)
+    return (
+        min(quota.rpm, requests + elapsed * quota.rpm / 60.0),
+        min(quota.tpm, tokens + elapsed * quota.tpm / 60.0),
+    )
+
+
+def _admit(requests, tokens, cost, quota, reserve):
+    """Seconds until the bucket can pay ``cost`` above ``reserve`` (0: now)."""
+    need_requests = 1 + reserve * quota.rpm - requests
+    need_tokens = cost + reserve * quota.tpm - tokens
+    if need_requests <= 0 and need_tokens <= 0:
+        return 0.0
+    if cost > (1 - reserve) * quota.tpm:
+        return float('inf')
+    return max(need_requests * 60.0 / quota.rpm, need_tokens * 60.0 / quota.tpm, 0.01)
+
+
+def _ahead(waiting, priority, now):
+    """Seconds until no request of a class above ``priority`` waits for the bucket (0: none does)."""
+    return max([until - now for p, until in waiting.items() if p < priority and until > now], default=0.0)
+
+
+def _marked(waiting, priority, until, now):
+    """``waiting`` with ``priority`` waiting until ``until`` (None if it already was), expired marks dropped."""
+    if waiting.get(priority, 0.0) >= until:
+        return None
+    marked = {p: t for p, t in waiting.items() if t > now}
+    marked[priority] = until + WAIT_MARGIN
+    return marked
+
+
+class LocalBuckets:
+    """Buckets shared by the threads of one process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._state = {}  # model -> [requests, tokens, refilled_at]
+        self._waiting = {}  # model -> {priority: until}
+
+    def take(self, model, quota, cost, reserve, priority=PRIORITY_INTERACTIVE, max_wait=float('inf')):
+        now = time.time()
+        with self._lock:
+            state = self._state.setdefault(model, [quota.rpm, quota.tpm, now])
+            requests, tokens = _refill(*state, quota, now)
+            waiting = self._waiting.get(model, {})
+            wait = max(_admit(requests, tokens, cost, quota, reserve), _ahead(waiting, priority, now))
+            if not wait:
+                requests, tokens = requests - 1, tokens - cost
+            elif wait <= max_wait:
+                marked = _marked(waiting, priority, now + wait, now)
+                if marked is not None:
+                    self._waiting[model] = marked
+            self._state[model] = [requests, tokens, now]
+            return wait
+
+    def adjust(self, model, tokens):
+        with self._lock:
+            if model in self._state:
+                self._state[model][1] += tokens
+
+    def exhaust(self, model, quota, seconds):
+        with self._lock:
+            self._state[model] = [-quota.rpm * seconds / 60.0, 0.0, time.time()]
+
+
+class DatabaseBuckets:
+    """Buckets in the llm_quotas table, shared by every process using the database."""
+
+    def __init__(self, app=None, retries=5):
+        self.app = app
+        self.retries = retries
+
+    def _app_context(self):
+        from flask import has_app_context
+        if has_app_context():
+            return nullcontext()
+        if self.app is None:
+            from app import app
+            self.app = app
+        return self.app.app_context()
+
+    def take(self, model, quota, cost, reserve, priority=PRIORITY_INTERACTIVE, max_wait=float('inf')):
+        from sqlalchemy import insert, select, update
+        from sqlalchemy.exc import IntegrityError
+        from database import db
+        from models import LLMQuota
+
+        table = LLMQuota.__table__
+        # Its own connection: the caller's session may have uncommitted work
+        with self._app_context():
+            for _ in range(self.retries):
+                now = time.time()
+                try:
+                    with db.engine.begin() as conn:
+                        row = conn.execute(select(table).where(table.c.model == model)).first()
+                        if row is None:
+                            conn.execute(insert(table).values(
+                                model=model, requests=quota.rpm, tokens=quota.tpm, refilled_at=now, version=0
+                            ))
+                            continue
+                        requests, tokens = _refill(row.requests, row.tokens, row.refilled_at, quota, now)
+                        waiting = {int(p): until for p, until in json.loads(row.waiting or '{}').items()}
+                        wait = max(_admit(requests, tokens, cost, quota, reserve), _ahead(waiting, priority, now))
+                        if wait:
+                            marked = _marked(waiting, priority, now + wait, now) if wait <= max_wait else None
+                            if marked is not None:
+                                # Losing this compare-and-set is harmless: the next attempt marks again
+                                conn.execute(
+                                    update(table).where(table.c.model == model, table.c.version == row.version).values(
+                                        waiting=json.dumps(marked), version=row.version + 1
+                                    )
+                                )
+                            return wait
+                        changed = conn.execute(
+                            update(table).where(table.c.model == model, table.c.version == row.version).values(
+                                requests=requests - 1, tokens=tokens - cost, refilled_at=now, version=row.version + 1
+                            )
+                        ).rowcount
+                    if changed:
+                        return 0.0
+                except IntegrityError:
+                    pass  # Another process created the row first
+            # Lost every compare-and-set to other processes: try again shortly
+            return 0.05
+
+    def adjust(self, model, tokens):
+        from sqlalchemy import update
+        from database import db
+        from models import LLMQuota
+
+        table = LLMQuota.__table__
+        with self._app_context(), db.engine.begin() as conn:
+            conn.execute(update(table).where(table.c.model == model).values(
+                tokens=table.c.tokens + tokens, version=table.c.version + 1
+            ))
+
+    def exhaust(self, model, quota, seconds):
+        from sqlalchemy import update
+        from database import db
+        from models import LLMQuota
+
+        table = LLMQuota.__table__
+        with self._app_context(), db.engine.begin() as conn:
+            conn.execute(update(table).where(table.c.model == model).values(
+                requests=-quota.rpm * seconds / 60.0, tokens=0.0, refilled_at=time.time(),
+                version=table.c.version + 1
+            ))
+
+
+class LLMScheduler:
+    """Chooses the model for each Gemini call and paces calls to the shared quotas."""
+
+    def __init__(self, buckets=None, quotas=None, reserves=None, deadlines=None):
+        self.buckets = buckets if buckets is not None else LocalBuckets()
+        self.quotas = quotas if quotas is not None else MODEL_QUOTAS
+        self.reserves = reserves if reserves is not None else RESERVES
+        self.deadlines = deadlines if deadlines is not None else DEADLINES
+
+    def deadline(self, priority):
+        """Absolute time.monotonic() by which a request of this class must have been admitted."""
+        return time.monotonic() + self.deadlines.get(priority, DEADLINES[PRIORITY_BATCH])
+
+    def acquire(self, models, tokens, priority=PRIORITY_INTERACTIVE, deadline=None):
+        """
+        Block until one of ``models`` (in order of preference) may be called
+        and return it. Raises LLMOverloaded if none can be before ``deadline``.
+        """
+        if deadline is None:
+            deadline = self.deadline(priority)
+        reserve = self.reserves.get(priority, 0.0)
+        while True:
+            waits = []
+            for model in models:
+                quota = self.quotas.get(model)
+                if quota is None:
+                    return model
+                wait = self.buckets.take(
+                    model, quota, tokens, reserve, priority=priority, max_wait=deadline - time.monotonic()
+                )
+                if not wait:
+                    return model
+                waits.append(wait)
+            wait = min(waits)
+            if wait == float('inf'):
+                raise LLMOverloaded(f"Request of {tokens} tokens exceeds the quota of {', '.join(models)}")
+            if time.monotonic() + wait > deadline:
+                raise LLMOverloaded(f"No quota for {', '.join(models)} within the deadline (next in {wait:.1f}s)")
+            time.sleep(wait)
+
+    def settle(self, model, charged, used):
+        """Correct the token charge of a finished call with the usage Gemini reported."""
+        if model in self.quotas and used is not None and used != charged:
+            self.buckets.adjust(model, charged - used)
+
+    def throttled(self, model, retry_after=None):
+        """Gemini answered 429: treat the model as exhausted for every process."""
+        quota = self.quotas.get(model)
+        if quota is not None:
+            self.buckets.exhaust(model, quota, retry_after or THROTTLE_SECONDS)
+
+
+def retry_after(response):
+    try:
+        return float(response.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+def usage_tokens(result):
+    """totalTokenCount of a generateContent response (or the last streamed event), if reported."""
+    try:
+        return int(result["usageMetadata"]["totalTokenCount"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def default_scheduler():
+    """The scheduler shared through the application database."""
+    return LLMScheduler(DatabaseBuckets())
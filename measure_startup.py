@@ -0,0 +1,96 @@
+"""
+Measure how long the web app and the Telegram bot take to start.
+
+Each run starts a fresh interpreter and reports two numbers per process:
+
+    import   time to import the entry module (app / telegram_bot)
+    first    time from then until the first request is served: GET /login
+             for the web app, the per-update reads (chat lookup and admin
+             setting) for the bot
+
+The "lazy" mode is the default startup; "eager" sets AUTO_MIGRATE=1 and
+LAZY_BLUEPRINTS=0, i.e. schema work and every view imported at startup.
+
+    python measure_startup.py
+    python measure_startup.py --runs 10 --database-url postgresql://...
+
+Without --database-url a throwaway SQLite database is migrated first. With
+it, only reads are issued against that database.
+"""
+import os
+import sys
+import json
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+MODES = {
+    'lazy': {'AUTO_MIGRATE': '0', 'LAZY_BLUEPRINTS': '1'},
+    'eager': {'AUTO_MIGRATE': '1', 'LAZY_BLUEPRINTS': '0'},
+}
+
+_WEB = """
+import json, logging, time
+t0 = time.perf_counter()
+import app
+t1 = time.perf_counter()
+logging.disable(logging.CRITICAL)
+response = app.app.test_client().get('/login')
+assert response.status_code == 200, response.status_code
+t2 = time.perf_counter()
+print(json.dumps({'import': t1 - t0, 'first': t2 - t1}))
+"""
+
+_BOT = """
+import json, logging, time
+t0 = time.perf_counter()
+import telegram_bot
+t1 = time.perf_counter()
+logging.disable(logging.CRITICAL)
+with telegram_bot.app.app_context():
+    telegram_bot.store.unit_of_work({'id': 'measure-startup'})
+    telegram_bot.store.get_setting('admin_telegram_id')
+t2 = time.perf_counter()
+print(json.dumps({'import': t1 - t0, 'first': t2 - t1}))
+"""
+
+
+def run_once(code, env):
+    result = subprocess.run(
+        [sys.executable, "-c", code], cwd=ROOT, env=env, capture_output=True, text=True, check=False
+    )
+    if result.returncode != 0:
+        raise SystemExit(f"Startup run failed:\n{result.stderr[-2000:]}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--modes", nargs="+", choices=sorted(MODES), default=["eager", "lazy"])
+    parser.add_argument("--database-url", help="database to start against (default: a throwaway SQLite file)")
+    args = parser.parse_args(argv)
+
+    env = dict(os.environ)
+    if args.database_url:
+        env["DATABASE_URL"] = args.database_url
+    else:
+        env["DATABASE_URL"] = f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='alhabib_startup_'), 'startup.db')}"
+        subprocess.run([sys.executable, "migrate.py"], cwd=ROOT, env=env, capture_output=True, check=True)
+
+    print(f"median of {args.runs} runs, milliseconds")
+    print(f"{'process':<10}{'mode':<8}{'import':>9}{'first':>9}{'total':>9}")
+    for process, code in (("web", _WEB), ("bot", _BOT)):
+        for mode in args.modes:
+            runs = [run_once(code, {**env, **MODES[mode]}) for _ in range(args.runs)]
+            imported = statistics.median(r['import'] for r in runs) * 1000
+            first = statistics.median(r['first'] for r in runs) * 1000
+            total = statistics.median(r['import'] + r['first'] for r in runs) * 1000
+            print(f"{process:<10}{mode:<8}{imported:>9.0f}{first:>9.0f}{total:>9.0f}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
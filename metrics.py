@@ -0,0 +1,99 @@
+"""
+Prometheus text exposition of the shared counters at /metrics.
+
+The counters live in stat_counters (see stats.py), so values written by the
+web workers and the Telegram consumers are all visible from any web process.
+The endpoint is off (404) unless METRICS_TOKEN is set, and then requires
+"Authorization: Bearer <token>".
+
+    chatbot_intent_checked_total{channel}          messages checked by the intent router
+    chatbot_intent_routed_total{channel,intent}    of those, answered without the model
+    chatbot_intent_hit_ratio{channel}              routed / checked
+    chatbot_stat_counter{key}                      every other counter
+"""
+import os
+import hmac
+import logging
+from flask import Blueprint, Response, abort, request
+from sqlalchemy import insert, select
+from sqlalchemy.exc import IntegrityError
+from database import db
+from models import StatCounter
+
+logger = logging.getLogger(__name__)
+
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+
+metrics_bp = Blueprint('metrics', __name__)
+
+_CHECKED = "intent_checked_"
+_ROUTED = "intent_routed_"
+
+
+def ensure_counters(keys):
+    """Create missing counters at zero, so increment() has rows to update."""
+    table = StatCounter.__table__
+    # Its own connection: the caller's session may have uncommitted work
+    with db.engine.begin() as conn:
+        existing = set(conn.execute(select(table.c.key).where(table.c.key.in_(keys))).scalars())
+        missing = [key for key in keys if key not in existing]
+    for key in missing:
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(insert(table).values(key=key, value=0))
+        except IntegrityError:
+            pass  # Created by another process meanwhile
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+
+def render():
+    counters = dict(db.session.query(StatCounter.key, StatCounter.value))
+    checked, routed, other = {}, {}, {}
+    for key, value in sorted(counters.items()):
+        if key.startswith(_CHECKED):
+            checked[key[len(_CHECKED):]] = value
+        elif key.startswith(_ROUTED):
+            channel, _, intent = key[len(_ROUTED):].partition('_')
+            routed[(channel, intent)] = value
+        else:
+            other[key] = value
+
+    lines = [
+        "# HELP chatbot_intent_checked_total Messages checked by the intent router.",
+        "# TYPE chatbot_intent_checked_total counter",
+    ]
+    lines += [f'chatbot_intent_checked_total{{channel="{_label(c)}"}} {v}' for c, v in checked.items()]
+    lines += [
+        "# HELP chatbot_intent_routed_total Messages answered by the intent router without the model.",
+        "# TYPE chatbot_intent_routed_total counter",
+    ]
+    lines += [
+        f'chatbot_intent_routed_total{{channel="{_label(c)}",intent="{_label(i)}"}} {v}'
+        for (c, i), v in routed.items()
+    ]
+    lines += [
+        "# HELP chatbot_intent_hit_ratio Share of checked messages answered by the intent router.",
+        "# TYPE chatbot_intent_hit_ratio gauge",
+    ]
+    for channel, total in checked.items():
+        hits = sum(v for (c, _), v in routed.items() if c == channel)
+        lines.append(f'chatbot_intent_hit_ratio{{channel="{_label(channel)}"}} {hits / total if total else 0.0:.6f}')
+    lines += [
+        "# HELP chatbot_stat_counter Other application counters.",
+        "# TYPE chatbot_stat_counter gauge",
+    ]
+    lines += [f'chatbot_stat_counter{{key="{_label(k)}"}} {v}' for k, v in other.items()]
+    return "\n".join(lines) + "\n"
+
+
+@metrics_bp.route('/metrics')
+def metrics():
+    if not METRICS_TOKEN:
+        abort(404)
+    supplied = request.headers.get('Authorization', '')
+    if not hmac.compare_digest(supplied, f"Bearer {METRICS_TOKEN}"):
+        abort(401)
+    return Response(render(), mimetype='text/plain; version=0.0.4')
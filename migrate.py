@@ -0,0 +1,26 @@
+"""
+Bring the database schema up to date (see schema.upgrade_schema).
+
+Run once per deploy before the web and bot processes start; they no longer
+touch the schema themselves unless AUTO_MIGRATE=1:
+
+    python migrate.py
+"""
+import sys
+import time
+import logging
+from app import app
+from schema import upgrade_schema
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    start = time.perf_counter()
+    with app.app_context():
+        upgrade_schema()
+    logger.info(f"Schema is up to date ({time.perf_counter() - start:.2f}s)")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
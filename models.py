@@ -1,5 +1,7 @@
 import datetime
+from sqlalchemy import event
 from database import db
+from arabic_text import normalize, token_string
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 
@@ -26,6 +28,11 @@ class User(UserMixin, db.Model):
         return f'<User {self.username}>'
 
 
+def _search_text(context):
+    # Column default, so ORM adds and bulk Core inserts both store it; messages are never edited
+    return token_string(context.get_current_parameters().get('content'))
+
+
 class Conversation(db.Model):
     __tablename__ = 'conversations'
     
@@ -49,6 +56,8 @@ class Message(db.Model):
     conversation_id = db.Column(db.Integer, db.ForeignKey('conversations.id'), nullable=False)
     role = db.Column(db.String(10), nullable=False)  # 'user' or 'assistant'
     content = db.Column(db.Text, nullable=False)
+    # Normalized tokens indexed for full-text search (see search.py)
+    content_norm = db.Column(db.Text, nullable=True, default=_search_text)
     created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
     
     def __repr__(self):
@@ -59,33 +68,90 @@ class TrainingData(db.Model):
     __tablename__ = 'training_data'
     
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
     question = db.Column(db.Text, nullable=False)
     answer = db.Column(db.Text, nullable=False)
     source_type = db.Column(db.String(20), nullable=False)  # 'manual', 'file'
     source_name = db.Column(db.String(256), nullable=True)  # Original filename if from file
+    # Normalized, space-separated tokens (see arabic_text.token_string)
+    question_norm = db.Column(db.Text, nullable=True)
+    answer_norm = db.Column(db.Text, nullable=True)
+    # MinHash signature of question_norm, used for near-duplicate detection (see dedupe.py)
+    question_signature = db.Column(db.LargeBinary, nullable=True)
+    # SHA-256 of question and answer, used to diff re-ingested files (see reingest.py)
+    content_hash = db.Column(db.String(64), nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow, nullable=True)
+    
+    __table_args__ = (
+        db.Index('ix_training_data_user_source', 'user_id', 'source_name'),
+    )
     
     def __repr__(self):
         return f'<TrainingData {self.id}: {self.question[:30]}>'
 
 
+@event.listens_for(TrainingData, 'before_insert')
+@event.listens_for(TrainingData, 'before_update')
+def _normalize_training_data(mapper, connection, target):
+    # Every write path (manual, edits, file parsers, scripts) stores precomputed tokens
+    from dedupe import signature_bytes, pair_hash
+    target.question_norm = token_string(target.question)
+    target.answer_norm = token_string(target.answer)
+    target.question_signature = signature_bytes(target.question_norm or normalize(target.question))
+    target.content_hash = pair_hash(target.question, target.answer)
+
+
+class PrecomputedAnswer(db.Model):
+    """Model-rendered answer of a stored question, generated at ingestion time (see precompute.py)."""
+    __tablename__ = 'precomputed_answers'
+
+    id = db.Column(db.Integer, primary_key=True)
+    training_data_id = db.Column(
+        db.Integer, db.ForeignKey('training_data.id', ondelete='CASCADE'), unique=True, nullable=False
+    )
+    answer = db.Column(db.Text, nullable=False)
+    # The source row the answer was rendered from; it is served only while the row still matches
+    content_hash = db.Column(db.String(64), nullable=True)
+    source_updated_at = db.Column(db.DateTime, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+
+    def __repr__(self):
+        return f'<PrecomputedAnswer {self.training_data_id}>'
+
+
 class TrainingFile(db.Model):
     __tablename__ = 'training_files'
     
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
-    filename = db.Column(db.String(256), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
+    filename = db.Column(db.String(256), nullable=False)  # Path relative to UPLOAD_FOLDER (see upload_store)
     original_filename = db.Column(db.String(256), nullable=False)
     file_size = db.Column(db.Integer, nullable=False)  # Size in bytes
     file_type = db.Column(db.String(50), nullable=False)  # MIME type
     status = db.Column(db.String(20), nullable=False, default='processing')  # 'processing', 'completed', 'failed'
+    dedupe_report = db.Column(db.Text, nullable=True)  # JSON summary written by dedupe.Deduplicator
+    content_hash = db.Column(db.String(64), nullable=True, index=True)  # SHA-256 of the uploaded bytes
+    # Earlier upload with identical content whose extracted pairs this file reuses
+    duplicate_of_id = db.Column(db.Integer, db.ForeignKey('training_files.id'), nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
     processed_at = db.Column(db.DateTime, nullable=True)
     
     def __repr__(self):
         return f'<TrainingFile {self.id}: {self.original_filename}>'
 
+def telegram_user_search_text(first_name=None, last_name=None, username=None, phone_number=None, chat_id=None):
+    """Normalized tokens the admin customer search matches (see search.py)."""
+    return token_string(' '.join(str(v) for v in (first_name, last_name, username, phone_number, chat_id) if v))
+
+
+def _telegram_user_search_text(context):
+    params = context.get_current_parameters()
+    return telegram_user_search_text(*(params.get(key) for key in
+                                       ('first_name', 'last_name', 'username', 'phone_number', 'chat_id')))
+
+
 class TelegramUser(db.Model):
     __tablename__ = 'telegram_users'
     
@@ -96,6 +162,8 @@ class TelegramUser(db.Model):
     username = db.Column(db.String(100))
     phone_number = db.Column(db.String(20))
     created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    # Names, username, phone and chat id as normalized tokens; writers that change them refresh it
+    content_norm = db.Column(db.Text, nullable=True, default=_telegram_user_search_text)
     
     messages = db.relationship('TelegramMessage', backref='telegram_user', lazy='dynamic', cascade='all, delete-orphan')
 
@@ -104,16 +172,135 @@ class TelegramUser(db.Model):
 
 class TelegramMessage(db.Model):
     __tablename__ = 'telegram_messages'
+    __table_args__ = (
+        # Keyset pagination of one customer's conversation
+        db.Index('ix_telegram_messages_user_id_id', 'telegram_user_id', 'id'),
+        # A Telegram update is stored at most once, even if it is delivered again
+        db.Index('ux_telegram_messages_update_id', 'update_id', unique=True),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     telegram_user_id = db.Column(db.Integer, db.ForeignKey('telegram_users.id'), nullable=False)
     role = db.Column(db.String(10), nullable=False)  # 'user' or 'assistant'
     content = db.Column(db.Text, nullable=False)
+    # Normalized tokens indexed for full-text search (see search.py)
+    content_norm = db.Column(db.Text, nullable=True, default=_search_text)
+    # update_id of the Telegram update that carried a customer message (NULL for replies)
+    update_id = db.Column(db.BigInteger, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
 
     def __repr__(self):
         return f'<TelegramMessage {self.id}: {self.role}>'
 
+class TelegramUpdate(db.Model):
+    """A received Telegram update waiting for a bot consumer (see telegram_queue.py)."""
+    __tablename__ = 'telegram_updates'
+    __table_args__ = (
+        # Consumers read the pending updates of one partition in arrival order
+        db.Index('ix_telegram_updates_partition_id', 'partition', 'id'),
+    )
+
+    id = db.Column(db.BigInteger, primary_key=True, autoincrement=False)  # Telegram update_id
+    chat_id = db.Column(db.String(50), nullable=False)
+    partition = db.Column(db.Integer, nullable=False)
+    payload = db.Column(db.Text, nullable=False)  # The update as JSON
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
+    def __repr__(self):
+        return f'<TelegramUpdate {self.id} (chat {self.chat_id})>'
+
+class TelegramDeadUpdate(db.Model):
+    """A queued update whose handling raised, set aside for inspection or requeueing (see telegram_queue.py)."""
+    __tablename__ = 'telegram_dead_updates'
+
+    id = db.Column(db.BigInteger, primary_key=True, autoincrement=False)  # Telegram update_id
+    chat_id = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    error = db.Column(db.Text)
+    failed_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
+    def __repr__(self):
+        return f'<TelegramDeadUpdate {self.id} (chat {self.chat_id})>'
+
+class TelegramQueuePartition(db.Model):
+    """Lease on a slice of the chats; only its owner processes their updates."""
+    __tablename__ = 'telegram_queue_partitions'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    owner = db.Column(db.String(64), nullable=True)  # Consumer holding (or last holding) the lease
+    previous_owner = db.Column(db.String(64), nullable=True)  # Holder before the current lease
+    lease_until = db.Column(db.DateTime, nullable=True)  # NULL when released
+    released_at = db.Column(db.DateTime, nullable=True)
+
+    def __repr__(self):
+        return f'<TelegramQueuePartition {self.id}: {self.owner}>'
+
+class ArchivedSegment(db.Model):
+    """A compressed file holding old messages of one conversation (see archive.py)."""
+    __tablename__ = 'archived_segments'
+    __table_args__ = (
+        db.Index('ix_archived_segments_owner', 'table_name', 'owner_id', 'first_message_id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    table_name = db.Column(db.String(32), nullable=False)  # 'messages' or 'telegram_messages'
+    owner_id = db.Column(db.Integer, nullable=False)  # conversation_id or telegram_user_id
+    path = db.Column(db.String(256), nullable=False)  # Relative to ARCHIVE_FOLDER
+    first_message_id = db.Column(db.Integer, nullable=False)
+    last_message_id = db.Column(db.Integer, nullable=False)
+    row_count = db.Column(db.Integer, nullable=False)
+    size_bytes = db.Column(db.Integer, nullable=False)
+    first_created_at = db.Column(db.DateTime, nullable=True)
+    last_created_at = db.Column(db.DateTime, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
+    def __repr__(self):
+        return f'<ArchivedSegment {self.table_name}/{self.owner_id}: {self.row_count} rows>'
+
+class LLMQuota(db.Model):
+    """Shared token bucket of one Gemini model (see llm_scheduler.py)."""
+    __tablename__ = 'llm_quotas'
+
+    id = db.Column(db.Integer, primary_key=True)
+    model = db.Column(db.String(64), unique=True, nullable=False)
+    requests = db.Column(db.Float, nullable=False)  # Requests left in the bucket
+    tokens = db.Column(db.Float, nullable=False)  # Tokens left in the bucket
+    refilled_at = db.Column(db.Float, nullable=False)  # Unix time the counts were computed at
+    version = db.Column(db.Integer, nullable=False, default=0)  # Compare-and-set guard
+    waiting = db.Column(db.Text, nullable=True)  # JSON {priority: unix time until which a request of it waits}
+
+    def __repr__(self):
+        return f'<LLMQuota {self.model}: {self.requests:.1f} req, {self.tokens:.0f} tok>'
+
+class GeminiCacheHandle(db.Model):
+    """A Gemini cachedContents handle of one model and knowledge base, shared by every process (see context_cache.py)."""
+    __tablename__ = 'gemini_cache_handles'
+    __table_args__ = (db.UniqueConstraint('model', 'namespace', name='uq_gemini_cache_handles_model_namespace'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    model = db.Column(db.String(64), nullable=False)
+    namespace = db.Column(db.String(64), nullable=False, default='')  # Knowledge-base owner ('' for the shared one)
+    name = db.Column(db.String(128), nullable=True)  # cachedContents/...; NULL: send uncached until expires_at
+    kb_version = db.Column(db.Text, nullable=True)  # Knowledge-base version the handle holds
+    expires_at = db.Column(db.Float, nullable=True)  # Unix time
+    creating_until = db.Column(db.Float, nullable=True)  # Claim of the process registering a new handle
+    used_at = db.Column(db.Float, nullable=True)  # Last registration or extension, for trimming
+
+    def __repr__(self):
+        return f'<GeminiCacheHandle {self.model}/{self.namespace}: {self.name}>'
+
+class StatCounter(db.Model):
+    """Incrementally maintained counters, so dashboards never COUNT(*) large tables."""
+    __tablename__ = 'stat_counters'
+
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String(64), unique=True, nullable=False)
+    value = db.Column(db.BigInteger, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+
+    def __repr__(self):
+        return f'<StatCounter {self.key}: {self.value}>'
+
 class AppSetting(db.Model):
     __tablename__ = 'app_settings'
     
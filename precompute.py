@@ -0,0 +1,345 @@
+"""
+Answers to the stored questions, rendered by the model at ingestion time.
+
+Most incoming questions are variants of questions already in training_data.
+After an upload, a manual add or an edit, a background pass asks Gemini once
+per stored question for a polished answer that relies only on the stored
+answer, and keeps it in precomputed_answers. At chat time, a confident match
+(the direct route, see retrieval.py) is answered with that text without any
+model call, so LLM spend moves from request time to ingestion time, where
+latency does not matter.
+
+The background passes are off unless PRECOMPUTE_ANSWERS=1: each one calls the
+model for every stored question whose answer is missing or stale, across all
+owners. Running this script renders them on demand either way.
+
+Each answer records the content hash and updated_at of its source row:
+
+    edited row               its old answer is no longer served (updated_at differs)
+                             and is rendered again (content hash differs)
+    saved with same content  only the recorded updated_at is refreshed
+    deleted row              its answer is removed
+
+Calls run on PRECOMPUTE_WORKERS threads at batch priority, so they draw on
+the quota left over by chat traffic (see llm_scheduler.py). A pass holds a
+lock file in INDEX_FOLDER, so passes of the web workers, the bot and this
+script run one after another and each renders only what the previous ones
+left pending.
+
+    python precompute.py                render missing and stale answers
+    python precompute.py --workers 8
+"""
+import os
+import sys
+import fcntl
+import logging
+import argparse
+import threading
+import time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from sqlalchemy import delete, func, or_, select, update
+from sqlalchemy.exc import IntegrityError
+from database import db
+from models import PrecomputedAnswer, TrainingData
+from knowledge_index import REFRESH_INTERVAL, on_evict
+
+logger = logging.getLogger(__name__)
+
+# Render answers in the background after every change to the training data (off by default)
+PRECOMPUTE_ANSWERS = os.environ.get("PRECOMPUTE_ANSWERS", "0") == "1"
+# Concurrent Gemini calls of one pass
+PRECOMPUTE_WORKERS = int(os.environ.get("PRECOMPUTE_WORKERS", "4"))
+# Rendered answers written per commit
+WRITE_CHUNK_SIZE = 100
+
+POLISH_PROMPT = """
+    أنت مساعد مؤسسة الحبيب للمستلزمات الطبية (Al-Habib Medical Institution).
+    أعد صياغة الإجابة المعتمدة التالية لتكون رداً واضحاً، مهنياً وودوداً على سؤال العميل، باللغة العربية الفصحى.
+    لا تضف أي معلومة غير موجودة في الإجابة المعتمدة، ولا تحذف منها أي تفصيل (أسماء، أرقام، عناوين، أسعار).
+    اكتب الرد فقط، دون مقدمات أو ملاحظات.
+
+    سؤال العميل: {question}
+    الإجابة المعتمدة: {answer}
+    """
+
+
+def render_answer(engine, question, answer):
+    """The model-rendered answer for one stored pair, or None if the call failed."""
+    from ai_engine import ERROR_BUSY, ERROR_CONNECTION, ERROR_RESPONSE, ERROR_UNEXPECTED, GENERATION_CONFIG, Prepared
+    from llm_scheduler import PRIORITY_BATCH
+
+    payload = {
+        "contents": [{"role": "user", "parts": [{"text": POLISH_PROMPT.format(question=question, answer=answer)}]}],
+        "generationConfig": GENERATION_CONFIG
+    }
+    text = engine.complete(Prepared(payload=payload), priority=PRIORITY_BATCH)
+    if not text or text in (ERROR_BUSY, ERROR_CONNECTION, ERROR_RESPONSE, ERROR_UNEXPECTED):
+        return None
+    return text
+
+
+def _remove_orphans():
+    removed = db.session.execute(
+        delete(PrecomputedAnswer).where(PrecomputedAnswer.training_data_id.not_in(select(TrainingData.id)))
+    ).rowcount
+    db.session.commit()
+    return removed
+
+
+def _pending():
+    """(rows needing a new answer, (answer id, updated_at) of answers whose row was saved unchanged)."""
+    rows = db.session.query(
+        TrainingData.id, TrainingData.question, TrainingData.answer, TrainingData.content_hash,
+        TrainingData.updated_at, PrecomputedAnswer.id.label('answer_id'),
+        PrecomputedAnswer.content_hash.label('answer_hash')
+    ).outerjoin(PrecomputedAnswer, PrecomputedAnswer.training_data_id == TrainingData.id).filter(or_(
+        PrecomputedAnswer.id.is_(None),
+        PrecomputedAnswer.content_hash.is_distinct_from(TrainingData.content_hash),
+        PrecomputedAnswer.source_updated_at.is_distinct_from(TrainingData.updated_at)
+    )).all()
+    stale = [row for row in rows if row.answer_id is None or row.answer_hash != row.content_hash]
+    touched = [(row.answer_id, row.updated_at) for row in rows if row.answer_id is not None
+               and row.answer_hash == row.content_hash]
+    return stale, touched
+
+
+def _store(rendered):
+    """Write [(source row, answer text)]; the source row's hash and stamp are those the text was rendered from."""
+    if not rendered:
+        return 0
+    existing = dict(db.session.query(PrecomputedAnswer.training_data_id, PrecomputedAnswer.id).filter(
+        PrecomputedAnswer.training_data_id.in_([row.id for row, _ in rendered])
+    ))
+    try:
+        for row, text in rendered:
+            values = {'answer': text, 'content_hash': row.content_hash, 'source_updated_at': row.updated_at}
+            if row.id in existing:
+                db.session.execute(
+                    update(PrecomputedAnswer).where(PrecomputedAnswer.id == existing[row.id]).values(**values)
+                )
+            else:
+                db.session.add(PrecomputedAnswer(training_data_id=row.id, **values))
+        db.session.commit()
+    except IntegrityError:
+        # Another process stored some of them first, or a row was deleted meanwhile: store them one by one
+        db.session.rollback()
+        return sum(_store_one(row, text) for row, text in rendered)
+    return len(rendered)
+
+
+def _store_one(row, text):
+    values = {'answer': text, 'content_hash': row.content_hash, 'source_updated_at': row.updated_at}
+    # A failed insert means another process inserted it first: the second round updates that answer
+    for _ in range(2):
+        try:
+            updated = db.session.execute(
+                update(PrecomputedAnswer).where(PrecomputedAnswer.training_data_id == row.id).values(**values)
+            ).rowcount
+            if not updated:
+                db.session.add(PrecomputedAnswer(training_data_id=row.id, **values))
+            db.session.commit()
+            return 1
+        except IntegrityError:
+            db.session.rollback()
+    # The row was deleted meanwhile
+    logger.warning(f"Could not store the precomputed answer of row {row.id}")
+    return 0
+
+
+@contextmanager
+def _pass_lock():
+    from vector_index import INDEX_FOLDER
+    os.makedirs(INDEX_FOLDER, exist_ok=True)
+    with open(os.path.join(INDEX_FOLDER, "precompute.lock"), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def precompute(engine=None, workers=PRECOMPUTE_WORKERS):
+    """Render every missing or stale answer (needs an app context). Returns a report dict."""
+    if engine is None:
+        from ai_engine import get_engine
+        engine = get_engine()
+
+    # Waits for a pass of another process; what it rendered is then no longer pending
+    with _pass_lock():
+        return _precompute(engine, workers)
+
+
+def _precompute(engine, workers):
+    removed = _remove_orphans()
+    stale, touched = _pending()
+    for answer_id, updated_at in touched:
+        db.session.execute(
+            update(PrecomputedAnswer).where(PrecomputedAnswer.id == answer_id).values(source_updated_at=updated_at)
+        )
+    db.session.commit()
+
+    rendered, failed = 0, 0
+    if stale:
+        logger.info(f"Rendering {len(stale)} precomputed answers with {workers} workers")
+        # Only the Gemini calls run on the pool; the database is written from this thread
+        with ThreadPoolExecutor(max(1, workers), thread_name_prefix="precompute") as executor:
+            futures = {executor.submit(render_answer, engine, row.question, row.answer): row for row in stale}
+            batch = []
+            for future in as_completed(futures):
+                text = future.result()
+                if text is None:
+                    failed += 1
+                    continue
+                batch.append((futures[future], text))
+                if len(batch) >= WRITE_CHUNK_SIZE:
+                    rendered += _store(batch)
+                    batch = []
+            rendered += _store(batch)
+
+    mark_stale()
+    report = {'rendered': rendered, 'failed': failed, 'refreshed': len(touched), 'removed': removed}
+    logger.info(f"Precomputed answers: {report}")
+    return report
+
+
+_worker_lock = threading.Lock()
+_running = False
+_again = False
+
+
+def _run(app):
+    global _running, _again
+    while True:
+        with app.app_context():
+            try:
+                precompute()
+            except Exception as e:
+                logger.error(f"Precomputing answers failed: {e}")
+            finally:
+                db.session.remove()
+        with _worker_lock:
+            if not _again:
+                _running = False
+                return
+            _again = False
+
+
+def schedule(app=None):
+    """
+    Start a background pass after the training data changed. A change made
+    while a pass is running triggers one more pass after it.
+    """
+    global _running, _again
+    if not PRECOMPUTE_ANSWERS:
+        return False
+    if app is None:
+        from flask import current_app
+        app = current_app._get_current_object()
+    with _worker_lock:
+        if _running:
+            _again = True
+            return True
+        _running = True
+    threading.Thread(target=_run, args=(app,), name="precompute", daemon=True).start()
+    return True
+
+
+class AnswerCache:
+    """
+    Precomputed answers of one owner's rows (None: every owner's) by
+    training_data id, with the updated_at of the row each was rendered from.
+    """
+
+    def __init__(self, owner=None):
+        self.owner = owner
+        self._answers = {}
+        self.fingerprint = None
+        self.checked_at = 0.0
+
+    def __len__(self):
+        return len(self._answers)
+
+    def get(self, entry):
+        """The answer for a knowledge_index.Entry, if it was rendered from the entry's current version."""
+        stored = self._answers.get(entry.id)
+        if stored is None or stored[0] != entry.updated_at:
+            return None
+        return stored[1]
+
+    def _owned(self, query):
+        if self.owner is None:
+            return query
+        return query.join(TrainingData, TrainingData.id == PrecomputedAnswer.training_data_id).filter(
+            TrainingData.user_id == self.owner
+        )
+
+    def sync(self):
+        fingerprint = tuple(self._owned(db.session.query(
+            func.count(PrecomputedAnswer.id), func.max(PrecomputedAnswer.updated_at)
+        )).one())
+        if fingerprint == self.fingerprint:
+            return
+        self._answers = {
+            row.training_data_id: (row.source_updated_at, row.answer) for row in self._owned(db.session.query(
+                PrecomputedAnswer.training_data_id, PrecomputedAnswer.source_updated_at, PrecomputedAnswer.answer
+            ))
+        }
+        self.fingerprint = fingerprint
+        logger.info(f"Loaded {len(self._answers)} precomputed answers of owner {self.owner}")
+
+
+_caches = {}  # owner -> AnswerCache
+_lock = threading.Lock()
+
+
+def get_answers(owner=None):
+    """The answer cache of ``owner``, re-synced at most every KB_REFRESH_INTERVAL seconds."""
+    with _lock:
+        cache = _caches.get(owner)
+        if cache is None:
+            cache = _caches[owner] = AnswerCache(owner)
+        now = time.monotonic()
+        if now - cache.checked_at >= REFRESH_INTERVAL:
+            cache.sync()
+            cache.checked_at = now
+    return cache
+
+
+def cached_answers(owner=None):
+    """The answer cache of ``owner`` if it is loaded and not due for a database check, else None."""
+    cache = _caches.get(owner)
+    if cache is None or time.monotonic() - cache.checked_at >= REFRESH_INTERVAL:
+        return None
+    return cache
+
+
+def mark_stale():
+    with _lock:
+        for cache in _caches.values():
+            cache.checked_at = 0.0
+
+
+def _release(owner, index):
+    # Answers are only needed while the owner's knowledge index is loaded
+    with _lock:
+        _caches.pop(owner, None)
+
+
+on_evict(_release)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=PRECOMPUTE_WORKERS, help="concurrent Gemini calls")
+    args = parser.parse_args(argv)
+
+    from app import app
+    with app.app_context():
+        report = precompute(workers=args.workers)
+    print(f"{report['rendered']} rendered, {report['failed']} failed, "
+          f"{report['refreshed']} refreshed, {report['removed']} removed")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,183 @@
+"""
+Diff-based re-ingestion of a training source.
+
+When a new version of a file (identified by its source_name) is loaded, the
+parsed pairs are compared with the rows already stored for that source:
+
+    unchanged  same content hash               -> not touched
+    changed    same or reworded question       -> UPDATE of that row (id kept)
+    added      no counterpart                  -> INSERT
+    removed    row without a counterpart       -> DELETE
+
+All changes are applied in one transaction. Untouched rows keep their
+updated_at, so the knowledge and vector indexes reload only changed rows.
+
+    python reingest.py alhabib_medical_data.txt --user admin
+"""
+import os
+import sys
+import logging
+import argparse
+from database import db
+from models import TrainingData
+from arabic_text import normalize, token_string
+from dedupe import LSHIndex, pair_hash, signature
+
+logger = logging.getLogger(__name__)
+
+DELETE_CHUNK_SIZE = 500
+# Estimated question similarity at which a leftover new pair is taken as an edit of a leftover row
+REWORD_THRESHOLD = 0.5
+# Leftover pairs are compared exhaustively up to this many comparisons, through LSH beyond
+EXHAUSTIVE_LIMIT = 250_000
+
+
+def _question_key(question):
+    return token_string(question) or normalize(question)
+
+
+class ReingestPlan:
+    def __init__(self):
+        self.unchanged = 0
+        self.changed = []  # (row id, question, answer)
+        self.added = []    # (question, answer)
+        self.removed = []  # row ids
+
+    @property
+    def touched(self):
+        return len(self.changed) + len(self.added) + len(self.removed)
+
+    def report(self):
+        return {
+            'unchanged': self.unchanged,
+            'changed': len(self.changed),
+            'added': len(self.added),
+            'removed': len(self.removed),
+        }
+
+
+def diff_source(user_id, source_name, pairs):
+    """Compare parsed ``pairs`` with the stored rows of ``source_name``. Returns a ReingestPlan."""
+    plan = ReingestPlan()
+    stored = db.session.query(
+        TrainingData.id, TrainingData.question, TrainingData.answer, TrainingData.content_hash
+    ).filter(TrainingData.user_id == user_id, TrainingData.source_name == source_name).order_by(TrainingData.id)
+
+    by_hash = {}
+    questions = {}
+    for row in stored:
+        content_hash = row.content_hash or pair_hash(row.question, row.answer)
+        by_hash.setdefault(content_hash, []).append(row.id)
+        questions[row.id] = row.question
+
+    # 1. Identical pairs
+    pending = []
+    for question, answer in pairs:
+        ids = by_hash.get(pair_hash(question, answer))
+        if ids:
+            questions.pop(ids.pop(0))
+            plan.unchanged += 1
+        else:
+            pending.append((question, answer))
+
+    # 2. Same normalized question, new answer or wording
+    by_key = {}
+    for row_id, question in questions.items():
+        by_key.setdefault(_question_key(question), []).append(row_id)
+    unmatched = []
+    for question, answer in pending:
+        ids = by_key.get(_question_key(question))
+        if ids:
+            row_id = ids.pop(0)
+            questions.pop(row_id)
+            plan.changed.append((row_id, question, answer))
+        else:
+            unmatched.append((question, answer))
+
+    # 3. Reworded questions (an edit, not a delete plus an insert)
+    if unmatched and questions:
+        lsh = LSHIndex()
+        slots = []
+        for row_id, question in questions.items():
+            key = _question_key(question)
+            lsh.add(signature(key), key)
+            slots.append(row_id)
+        lsh.compact()
+        exhaustive = len(unmatched) * len(slots) <= EXHAUSTIVE_LIMIT
+        for question, answer in unmatched:
+            sig = signature(_question_key(question))
+            best_slot, best_score = None, REWORD_THRESHOLD
+            for slot in (range(len(slots)) if exhaustive else lsh.candidates(sig)):
+                if slots[slot] not in questions:
+                    continue
+                score = lsh.similarity(sig, slot)
+                if score >= best_score:
+                    best_slot, best_score = slot, score
+            if best_slot is not None:
+                row_id = slots[best_slot]
+                questions.pop(row_id)
+                plan.changed.append((row_id, question, answer))
+            else:
+                plan.added.append((question, answer))
+    else:
+        plan.added.extend(unmatched)
+
+    plan.removed = sorted(questions)
+    return plan
+
+
+def reingest_source(user_id, source_name, pairs, source_type='file'):
+    """Apply the new version of a source in one transaction. Returns the plan's report."""
+    from knowledge_index import mark_stale
+    from stats import stats_cache
+
+    plan = diff_source(user_id, source_name, pairs)
+    try:
+        for row_id, question, answer in plan.changed:
+            row = db.session.get(TrainingData, row_id)
+            row.question = question
+            row.answer = answer
+        for question, answer in plan.added:
+            db.session.add(TrainingData(
+                user_id=user_id, question=question, answer=answer,
+                source_type=source_type, source_name=source_name
+            ))
+        for start in range(0, len(plan.removed), DELETE_CHUNK_SIZE):
+            chunk = plan.removed[start:start + DELETE_CHUNK_SIZE]
+            TrainingData.query.filter(TrainingData.id.in_(chunk)).delete(synchronize_session=False)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    if plan.touched:
+        mark_stale()
+        stats_cache.discard(('dashboard', user_id))
+    logger.info(f"Re-ingested {source_name}: {plan.report()}")
+    return plan.report()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("file", help="training file (same formats as uploads)")
+    parser.add_argument("--user", default="admin", help="username owning the pairs")
+    parser.add_argument("--source-name", help="source to replace (default: the file's base name)")
+    args = parser.parse_args(argv)
+
+    from app import app
+    from models import User
+    from training import parse_training_text
+
+    with open(args.file, 'r', encoding='utf-8') as f:
+        pairs = parse_training_text(f.read())
+    with app.app_context():
+        user = User.query.filter_by(username=args.user).first()
+        if user is None:
+            raise SystemExit(f"Unknown user: {args.user}")
+        report = reingest_source(user.id, args.source_name or os.path.basename(args.file), pairs)
+    print(f"{report['added']} added, {report['changed']} changed, "
+          f"{report['removed']} removed, {report['unchanged']} unchanged")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
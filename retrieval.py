@@ -0,0 +1,160 @@
+"""
+Hybrid retrieval and answer routing for incoming questions.
+
+Candidates come from the BM25 index and the vector index (fused with
+reciprocal rank fusion) and are re-ranked by how closely their stored
+question matches the user's question:
+
+    confidence = LEXICAL_WEIGHT * token dice + (1 - LEXICAL_WEIGHT) * question cosine
+
+The best candidate's confidence picks one of three routes:
+
+    direct    >= RETRIEVAL_DIRECT_THRESHOLD  stored answer is returned, no LLM call
+    grounded  >= RETRIEVAL_MIN_THRESHOLD     only the top candidates go to Gemini
+    none      below that                     Gemini is told nothing relevant exists
+
+Thresholds are tuned against eval/retrieval_eval.jsonl with tune_retrieval.py.
+"""
+import os
+import numpy as np
+from arabic_text import tokenize
+from knowledge_index import on_evict
+from vector_index import HashingEmbedder
+
+KB_CONTEXT_LIMIT = int(os.environ.get("KB_CONTEXT_LIMIT", "20"))
+DIRECT_THRESHOLD = float(os.environ.get("RETRIEVAL_DIRECT_THRESHOLD", "0.5"))
+MIN_THRESHOLD = float(os.environ.get("RETRIEVAL_MIN_THRESHOLD", "0.1"))
+# Candidates placed in the prompt for the grounded route
+GROUNDING_CANDIDATES = int(os.environ.get("RETRIEVAL_GROUNDING_CANDIDATES", "5"))
+# Wraps a direct answer; {answer} and {question} are substituted
+DIRECT_ANSWER_TEMPLATE = os.environ.get("DIRECT_ANSWER_TEMPLATE", "{answer}")
+LEXICAL_WEIGHT = 0.5
+RRF_K = 60
+
+ROUTE_DIRECT = 'direct'
+ROUTE_GROUNDED = 'grounded'
+ROUTE_NONE = 'none'
+
+
+class Candidate:
+    __slots__ = ("entry", "lexical", "semantic", "confidence")
+
+    def __init__(self, entry, lexical, semantic):
+        self.entry = entry
+        self.lexical = lexical
+        self.semantic = semantic
+        self.confidence = LEXICAL_WEIGHT * lexical + (1 - LEXICAL_WEIGHT) * semantic
+
+
+class Decision:
+    __slots__ = ("route", "confidence", "candidates")
+
+    def __init__(self, route, confidence, candidates):
+        self.route = route
+        self.confidence = confidence
+        self.candidates = candidates
+
+    @property
+    def best(self):
+        return self.candidates[0] if self.candidates else None
+
+
+def fuse_rankings(rankings, k=RRF_K):
+    """Reciprocal rank fusion of several [(entry_id, score)] lists."""
+    fused = {}
+    for ranking in rankings:
+        for rank, (entry_id, _) in enumerate(ranking):
+            fused[entry_id] = fused.get(entry_id, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(fused, key=lambda entry_id: -fused[entry_id])
+
+
+def _tokens(text):
+    # Questions made only of stop words ("مين انتم") still need something to compare
+    return set(tokenize(text)) or set(tokenize(text, keep_stop_words=True))
+
+
+class Reranker:
+    """Scores candidates on question-to-question similarity; caches question vectors."""
+
+    def __init__(self, embedder=None):
+        self.embedder = embedder or HashingEmbedder()
+        self._vectors = {}
+
+    def _question_vectors(self, entries):
+        missing = [e for e in entries if self._vectors.get(e.id, (None,))[0] != e.updated_at]
+        if missing:
+            for entry, vector in zip(missing, self.embedder.embed([e.question for e in missing])):
+                self._vectors[entry.id] = (entry.updated_at, vector)
+        return np.array([self._vectors[e.id][1] for e in entries])
+
+    def forget(self, entry_ids):
+        for entry_id in entry_ids:
+            self._vectors.pop(entry_id, None)
+
+    def rank(self, query, entries):
+        if not entries:
+            return []
+        query_tokens = _tokens(query)
+        query_vector = self.embedder.embed([query])[0]
+        cosines = self._question_vectors(entries) @ query_vector
+
+        candidates = []
+        for entry, cosine in zip(entries, cosines):
+            question_tokens = _tokens(entry.question)
+            total = len(query_tokens) + len(question_tokens)
+            dice = 2 * len(query_tokens & question_tokens) / total if total else 0.0
+            candidates.append(Candidate(entry, dice, max(0.0, float(cosine))))
+        candidates.sort(key=lambda c: (-c.confidence, c.entry.id))
+        return candidates
+
+
+def retrieve(query, index, vectors=None, reranker=None, limit=KB_CONTEXT_LIMIT):
+    """Re-ranked candidates for ``query`` from a KnowledgeIndex (and optional VectorIndex)."""
+    if len(index) <= limit:
+        entries = index.entries()
+    else:
+        ranked = [index.search(query, limit=limit)]
+        if vectors is not None:
+            ranked.append(vectors.search(query, limit=limit))
+        entries = [index.get(i) for i in fuse_rankings(ranked) if i in index][:limit]
+    return (reranker or get_reranker(vectors)).rank(query, entries)
+
+
+def route(candidates, direct_threshold=DIRECT_THRESHOLD, min_threshold=MIN_THRESHOLD,
+          grounding_candidates=GROUNDING_CANDIDATES):
+    """Pick the answer route for already ranked candidates."""
+    confidence = candidates[0].confidence if candidates else 0.0
+    if confidence >= direct_threshold:
+        return Decision(ROUTE_DIRECT, confidence, candidates[:1])
+    if confidence >= min_threshold:
+        return Decision(ROUTE_GROUNDED, confidence, candidates[:grounding_candidates])
+    return Decision(ROUTE_NONE, confidence, [])
+
+
+def decide(query, index, vectors=None, limit=KB_CONTEXT_LIMIT, **route_options):
+    return route(retrieve(query, index, vectors, limit=limit), **route_options)
+
+
+def render_direct_answer(candidate, answer=None):
+    """The reply for a direct match: ``answer`` (e.g. a precomputed one) or else the stored answer."""
+    return DIRECT_ANSWER_TEMPLATE.format(answer=answer or candidate.entry.answer, question=candidate.entry.question)
+
+
+_reranker = None
+
+
+def get_reranker(vectors=None):
+    """Process-wide reranker, sharing the vector index's embedder when there is one."""
+    global _reranker
+    embedder = vectors.embedder if vectors is not None else None
+    if _reranker is None or (embedder is not None and _reranker.embedder is not embedder):
+        _reranker = Reranker(embedder)
+    return _reranker
+
+
+def _forget_evicted(owner, index):
+    if _reranker is not None:
+        _reranker.forget(index.stamps())
+
+
+on_evict(_forget_evicted)
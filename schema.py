@@ -0,0 +1,77 @@
+import logging
+from sqlalchemy import inspect, or_, text
+from sqlalchemy.orm.attributes import flag_modified
+from database import db
+
+logger = logging.getLogger(__name__)
+
+
+def upgrade_schema():
+    """
+    Create missing tables, columns and indexes declared on the models.
+
+    db.create_all() only creates tables that do not exist yet, so columns and
+    indexes added to existing models would never reach a live database. New
+    columns must be nullable (or carry a server default) to be added here.
+    """
+    import models  # noqa: F401  (register all tables on the metadata)
+
+    db.create_all()
+    engine = db.engine
+    inspector = inspect(engine)
+
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+
+        existing_columns = {c["name"] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+            if not column.nullable and column.server_default is None:
+                logger.warning(f"Cannot add NOT NULL column {table.name}.{column.name} without a server default")
+                continue
+            column_type = column.type.compile(dialect=engine.dialect)
+            ddl = f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'
+            if column.server_default is not None:
+                default = column.server_default.arg
+                ddl += f" DEFAULT {getattr(default, 'text', default)}"
+            with engine.begin() as conn:
+                conn.execute(text(ddl))
+            logger.info(f"Added column {table.name}.{column.name}")
+
+        existing_indexes = {i["name"] for i in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                index.create(engine)
+                logger.info(f"Created index {index.name}")
+
+    backfill_training_tokens()
+
+    from search import backfill_search_text, ensure_search_indexes
+    backfill_search_text()
+    ensure_search_indexes()
+
+
+def backfill_training_tokens(chunk_size=500):
+    """Store normalized tokens, signatures and hashes for TrainingData rows written before they existed."""
+    from models import TrainingData
+
+    total = 0
+    while True:
+        rows = TrainingData.query.filter(
+            or_(
+                TrainingData.question_norm.is_(None),
+                TrainingData.question_signature.is_(None),
+                TrainingData.content_hash.is_(None)
+            )
+        ).limit(chunk_size).all()
+        if not rows:
+            break
+        for row in rows:
+            # Marking the row dirty lets the before_update hook fill every derived column
+            flag_modified(row, 'question')
+        db.session.commit()
+        total += len(rows)
+    if total:
+        logger.info(f"Backfilled normalized tokens for {total} training rows")
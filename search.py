@@ -0,0 +1,220 @@
+"""
+Full-text search over web chat messages, Telegram messages and Telegram customers.
+
+These tables store ``content_norm``: the message text (for customers: names,
+username, phone and chat id) reduced to normalized Arabic-aware tokens
+(arabic_text.token_string), filled by a column default on insert. Queries go through the same normalization, so spelling variants
+(أ/إ/ا, ة/ه, ى/ي, diacritics) and attached prefixes (و، ب، ال ...) match.
+
+    PostgreSQL  GIN index on to_tsvector('simple', content_norm)
+    SQLite      FTS5 external-content table kept in sync by triggers
+    other       LIKE on content_norm (no index)
+
+Every query term matches as a prefix, results are newest first with keyset
+pagination on the id, and snippets are highlighted in Python.
+"""
+import logging
+import re
+from markupsafe import Markup, escape
+from sqlalchemy import and_, bindparam, select, text
+from database import db
+from models import Conversation, Message, TelegramMessage, TelegramUser, telegram_user_search_text
+from arabic_text import token_string, tokenize
+
+logger = logging.getLogger(__name__)
+
+SEARCH_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+MAX_QUERY_TERMS = 8
+SNIPPET_WORDS = 30
+BACKFILL_CHUNK_SIZE = 2000
+
+SEARCHABLE_TABLES = ('messages', 'telegram_messages', 'telegram_users')
+
+_WORD = re.compile(r'\w+', re.UNICODE)
+
+
+def query_terms(q):
+    """Normalized search terms of a raw query string."""
+    return token_string(q).split()[:MAX_QUERY_TERMS]
+
+
+def _match_clause(model, terms):
+    table = model.__tablename__
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        tsquery = ' & '.join(f"{term}:*" for term in terms)
+        return text(
+            f"to_tsvector('simple', coalesce({table}.content_norm, '')) @@ to_tsquery('simple', :tsquery)"
+        ).bindparams(tsquery=tsquery)
+    if dialect == 'sqlite':
+        fts_query = ' AND '.join(f'"{term}"*' for term in terms)
+        matches = select(text('rowid')).select_from(text(f'{table}_fts')).where(
+            text(f'{table}_fts MATCH :fts_query').bindparams(fts_query=fts_query)
+        )
+        return model.id.in_(matches)
+    return and_(*(model.content_norm.like(f'%{term}%') for term in terms))
+
+
+def _page(query, model, before, limit):
+    limit = max(1, min(limit or SEARCH_PAGE_SIZE, MAX_PAGE_SIZE))
+    if before:
+        query = query.filter(model.id < before)
+    rows = query.order_by(model.id.desc()).limit(limit + 1).all()
+    next_before = rows[limit - 1].id if len(rows) > limit else None
+    return rows[:limit], next_before
+
+
+def _filter_dates(query, model, date_from=None, date_to=None):
+    if date_from:
+        query = query.filter(model.created_at >= date_from)
+    if date_to:
+        query = query.filter(model.created_at < date_to)
+    return query
+
+
+def search_messages(q, user_id, conversation_id=None, date_from=None, date_to=None, before=None, limit=None):
+    """Web chat messages of ``user_id`` matching ``q``. Returns (messages, terms, next_before)."""
+    terms = query_terms(q)
+    if not terms:
+        return [], terms, None
+    query = Message.query.join(Conversation, Message.conversation_id == Conversation.id).filter(
+        Conversation.user_id == user_id, _match_clause(Message, terms)
+    )
+    if conversation_id:
+        query = query.filter(Message.conversation_id == conversation_id)
+    query = _filter_dates(query, Message, date_from, date_to)
+    rows, next_before = _page(query, Message, before, limit)
+    return rows, terms, next_before
+
+
+def search_telegram_messages(q, telegram_user_id=None, date_from=None, date_to=None, before=None, limit=None):
+    """Telegram messages matching ``q``. Returns (messages, terms, next_before)."""
+    terms = query_terms(q)
+    if not terms:
+        return [], terms, None
+    query = TelegramMessage.query.filter(_match_clause(TelegramMessage, terms))
+    if telegram_user_id:
+        query = query.filter(TelegramMessage.telegram_user_id == telegram_user_id)
+    query = _filter_dates(query, TelegramMessage, date_from, date_to)
+    rows, next_before = _page(query, TelegramMessage, before, limit)
+    return rows, terms, next_before
+
+
+def telegram_user_filter(q):
+    """Index-backed filter for customers with a word starting with each term of ``q`` (None: no terms)."""
+    terms = query_terms(q)
+    return _match_clause(TelegramUser, terms) if terms else None
+
+
+def highlight(content, terms, words=SNIPPET_WORDS):
+    """HTML snippet of ``content`` around the first match, with matching words in <mark>."""
+    content = content or ''
+    spans = [m.span() for m in _WORD.finditer(content)]
+    hits = [
+        i for i, (start, end) in enumerate(spans)
+        if any(token.startswith(term) for token in tokenize(content[start:end]) for term in terms)
+    ]
+    if not spans:
+        return escape(content)
+
+    first = hits[0] if hits else 0
+    lo = max(0, first - words // 3)
+    hi = min(len(spans), lo + words)
+    hit_set = set(hits)
+
+    out = ['…' if lo > 0 else '']
+    position = spans[lo][0] if lo > 0 else 0
+    for i in range(lo, hi):
+        start, end = spans[i]
+        out.append(escape(content[position:start]))
+        word = escape(content[start:end])
+        out.append(Markup(f'<mark>{word}</mark>') if i in hit_set else word)
+        position = end
+    if hi < len(spans):
+        out.append('…')
+    else:
+        out.append(escape(content[position:]))
+    return Markup('').join(out)
+
+
+def backfill_search_text(chunk_size=BACKFILL_CHUNK_SIZE):
+    """Fill content_norm for messages and Telegram customers stored before it existed."""
+    for model in (Message, TelegramMessage):
+        total = 0
+        while True:
+            rows = db.session.query(model.id, model.content).filter(
+                model.content_norm.is_(None)
+            ).order_by(model.id).limit(chunk_size).all()
+            if not rows:
+                break
+            db.session.execute(
+                model.__table__.update().where(model.__table__.c.id == bindparam('row_id')),
+                [{'row_id': row.id, 'content_norm': token_string(row.content)} for row in rows]
+            )
+            db.session.commit()
+            total += len(rows)
+        if total:
+            logger.info(f"Backfilled search text for {total} rows of {model.__tablename__}")
+
+    total = 0
+    while True:
+        rows = db.session.query(
+            TelegramUser.id, TelegramUser.first_name, TelegramUser.last_name,
+            TelegramUser.username, TelegramUser.phone_number, TelegramUser.chat_id
+        ).filter(TelegramUser.content_norm.is_(None)).order_by(TelegramUser.id).limit(chunk_size).all()
+        if not rows:
+            break
+        db.session.execute(
+            TelegramUser.__table__.update().where(TelegramUser.__table__.c.id == bindparam('row_id')),
+            [{'row_id': row.id, 'content_norm': telegram_user_search_text(*row[1:])} for row in rows]
+        )
+        db.session.commit()
+        total += len(rows)
+    if total:
+        logger.info(f"Backfilled search text for {total} rows of telegram_users")
+
+
+def ensure_search_indexes():
+    """Create the dialect-specific full-text indexes if they are missing."""
+    engine = db.engine
+    dialect = engine.dialect.name
+    with engine.begin() as conn:
+        for table in SEARCHABLE_TABLES:
+            if dialect == 'postgresql':
+                conn.execute(text(
+                    f"CREATE INDEX IF NOT EXISTS ix_{table}_search ON {table} "
+                    f"USING gin (to_tsvector('simple', coalesce(content_norm, '')))"
+                ))
+            elif dialect == 'sqlite':
+                _ensure_fts5(conn, table)
+
+
+def _ensure_fts5(conn, table):
+    fts = f'{table}_fts'
+    exists = conn.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"), {'name': fts}
+    ).first()
+    if exists:
+        return
+    conn.execute(text(
+        f"CREATE VIRTUAL TABLE {fts} USING fts5(content_norm, content='{table}', content_rowid='id')"
+    ))
+    conn.execute(text(f"""
+        CREATE TRIGGER {fts}_ai AFTER INSERT ON {table} BEGIN
+            INSERT INTO {fts}(rowid, content_norm) VALUES (new.id, new.content_norm);
+        END
+    """))
+    conn.execute(text(f"""
+        CREATE TRIGGER {fts}_ad AFTER DELETE ON {table} BEGIN
+            INSERT INTO {fts}({fts}, rowid, content_norm) VALUES ('delete', old.id, old.content_norm);
+        END
+    """))
+    conn.execute(text(f"""
+        CREATE TRIGGER {fts}_au AFTER UPDATE OF content_norm ON {table} BEGIN
+            INSERT INTO {fts}({fts}, rowid, content_norm) VALUES ('delete', old.id, old.content_norm);
+            INSERT INTO {fts}(rowid, content_norm) VALUES (new.id, new.content_norm);
+        END
+    """))
+    conn.execute(text(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')"))
+    logger.info(f"Created full-text index {fts}")
@@ -1,31 +1,13 @@
 import os
 from app import app
 from database import db
-from models import User, TrainingData, TrainingFile
-import re
+from models import User
+from training import parse_training_text
+from reingest import reingest_source
 
 def process_text_content(content, user_id, filename):
-    # Arabic: س: ... ج: ...
-    arabic_pattern = re.compile(r'س:(.*?)(?=س:|Q:|Question:|$)', re.DOTALL | re.IGNORECASE)
-    
-    data_count = 0
-    for match in arabic_pattern.finditer(content):
-        chunk = match.group(1).strip()
-        if 'ج:' in chunk:
-            parts = chunk.split('ج:', 1)
-            question = parts[0].strip()
-            answer = parts[1].strip()
-            if question and answer:
-                training_data = TrainingData(
-                    user_id=user_id,
-                    question=question,
-                    answer=answer,
-                    source_type='file',
-                    source_name=filename
-                )
-                db.session.add(training_data)
-                data_count += 1
-    return data_count
+    # Re-running the setup applies only the pairs that changed in the file
+    return reingest_source(user_id, filename, parse_training_text(content))
 
 def setup():
     with app.app_context():
@@ -40,22 +22,16 @@ def setup():
             db.session.add(admin)
             db.session.commit()
         
-        # Check if data already exists
-        if True: # Force reload for new institution
-            print("Cleaning old data...")
-            TrainingData.query.delete()
-            print("Loading initial data from alhabib_medical_data.txt...")
-            data_file = 'alhabib_medical_data.txt'
-            if os.path.exists(data_file):
-                with open(data_file, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                count = process_text_content(content, admin.id, data_file)
-                db.session.commit()
-                print(f"Loaded {count} entries.")
-            else:
-                print("Data file not found!")
+        print("Loading initial data from alhabib_medical_data.txt...")
+        data_file = 'alhabib_medical_data.txt'
+        if os.path.exists(data_file):
+            with open(data_file, 'r', encoding='utf-8') as f:
+                content = f.read()
+            report = process_text_content(content, admin.id, data_file)
+            print(f"Loaded {report['added']} new entries "
+                  f"({report['changed']} updated, {report['removed']} removed, {report['unchanged']} unchanged).")
         else:
-            print("Database already contains data.")
+            print("Data file not found!")
 
 if __name__ == "__main__":
     setup()
@@ -1,5 +1,9 @@
 #!/bin/bash
 
+# تحديث مخطط قاعدة البيانات مرة واحدة قبل تشغيل العمليات
+echo "Migrating database schema..."
+python migrate.py
+
 # تشغيل بوت التلجرام في الخلفية
 echo "Starting Telegram Bot..."
 python telegram_bot.py &
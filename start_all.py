@@ -17,6 +17,10 @@ if __name__ == "__main__":
         print("Initializing database...")
         subprocess.run([sys.executable, "init_and_train.py"])
 
+    # Schema changes are applied once here, not by every process that imports the app
+    print("Migrating database schema...")
+    subprocess.run([sys.executable, "migrate.py"])
+
     flask_process = run_flask()
     time.sleep(2)  # Give Flask a moment to start
     bot_process = run_telegram_bot()
@@ -81,6 +81,7 @@ document.addEventListener('DOMContentLoaded', function() {
             // Create FormData
             const formData = new FormData();
             formData.append('file', files[0]);
+            appendDuplicatePolicy(formData);
             
             // Upload file
             uploadFile(formData);
@@ -150,10 +151,22 @@ document.addEventListener('DOMContentLoaded', function() {
         
         const formData = new FormData();
         formData.append('file', fileInput.files[0]);
+        appendDuplicatePolicy(formData);
         
         uploadFile(formData);
     }
     
+    /**
+     * Add the selected duplicate policy to an upload
+     * @param {FormData} formData - Form data with file
+     */
+    function appendDuplicatePolicy(formData) {
+        const policySelect = document.getElementById('duplicate-policy');
+        if (policySelect) {
+            formData.append('duplicate_policy', policySelect.value);
+        }
+    }
+    
     /**
      * Upload a file to the server
      * @param {FormData} formData - Form data with file
@@ -0,0 +1,89 @@
+import logging
+import os
+import time
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+from database import db
+from models import StatCounter, TelegramUser, TelegramMessage
+
+logger = logging.getLogger(__name__)
+
+# Dashboard aggregates are reused for this many seconds per process
+STATS_TTL = int(os.environ.get("DASHBOARD_STATS_TTL", "30"))
+
+# Counter key -> model whose rows it counts (used to seed a missing counter)
+COUNTED_MODELS = {
+    'telegram_users': TelegramUser,
+    'telegram_messages': TelegramMessage,
+}
+
+
+def _count(key):
+    value = COUNTED_MODELS[key].query.count()
+    if key == 'telegram_messages':
+        from archive import total_archived
+        value += total_archived(key)
+    return value
+
+
+def increment(key, amount=1):
+    """Bump a counter inside the caller's transaction (no commit).
+
+    A counter of ``COUNTED_MODELS`` that does not exist yet is seeded in the same
+    transaction from COUNT(*), which already includes the caller's flushed rows.
+    """
+    if not amount:
+        return
+    bump = update(StatCounter).where(StatCounter.key == key).values(value=StatCounter.value + amount)
+    if db.session.execute(bump).rowcount or key not in COUNTED_MODELS:
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.add(StatCounter(key=key, value=_count(key)))
+    except IntegrityError:
+        # Another process seeded it meanwhile, without this transaction's rows
+        db.session.execute(bump)
+
+
+def get_counter(key):
+    """Read a counter, seeding it once from COUNT(*) if it does not exist yet."""
+    counter = StatCounter.query.filter_by(key=key).first()
+    if counter is not None:
+        return counter.value
+
+    value = _count(key)
+    try:
+        db.session.add(StatCounter(key=key, value=value))
+        db.session.commit()
+    except IntegrityError:
+        # Another process seeded it first (a writer's increment() included)
+        db.session.rollback()
+        return StatCounter.query.filter_by(key=key).first().value
+    logger.info(f"Seeded counter {key} = {value}")
+    return value
+
+
+class TTLCache:
+    """A tiny per-process cache for values that may be a few seconds stale."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._items = {}
+
+    def get(self, key, loader):
+        now = time.monotonic()
+        item = self._items.get(key)
+        if item and now - item[1] < self.ttl:
+            return item[0]
+        value = loader()
+        self._items[key] = (value, now)
+        return value
+
+    def discard(self, key):
+        self._items.pop(key, None)
+
+    def clear(self):
+        self._items.clear()
+
+
+stats_cache = TTLCache(STATS_TTL)
@@ -1,9 +1,15 @@
 import logging
 import time
-import requests
 import os
-from app import app, db
-from models import TelegramUser, TelegramMessage, AppSetting
+import uuid
+import socket
+import argparse
+from app import app
+from cassette import http_session
+from telegram_store import TelegramStore
+from llm_scheduler import PRIORITY_TELEGRAM
+from intent_router import PHONE, count_keys, route_message
+import telegram_queue
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -13,12 +19,26 @@ logger = logging.getLogger(__name__)
 TELEGRAM_TOKEN = os.environ.get("TELEGRAM_TOKEN", "6571793763:AAFJlDbgGEnOeD_ctbIrujAdYgLb7ObMo7A")
 TELEGRAM_API_URL = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}"
 
+# Shared keep-alive session (records or replays traffic when HTTP_CASSETTE is set)
+http = http_session("telegram")
+
+# Send the answer while Gemini is still writing it, editing the message as text arrives
+STREAM_REPLIES = os.environ.get("TELEGRAM_STREAM_REPLIES", "1") == "1"
+# Minimum seconds between two edits of the same message (Telegram throttles faster edits)
+EDIT_INTERVAL = float(os.environ.get("TELEGRAM_EDIT_INTERVAL", "1.0"))
+# Edits that must land (the final text, the head of a split) wait at most this long for the
+# rate limit and are tried EDIT_ATTEMPTS times; then the rest is sent as a new message
+MAX_EDIT_WAIT = float(os.environ.get("TELEGRAM_MAX_EDIT_WAIT", "10"))
+EDIT_ATTEMPTS = 3
+# Telegram rejects longer message texts
+MESSAGE_LIMIT = 4096
+
 def get_updates(offset=None):
     url = f"{TELEGRAM_API_URL}/getUpdates?timeout=30"
     if offset:
         url += f"&offset={offset}"
     try:
-        response = requests.get(url, timeout=35)
+        response = http.get(url, timeout=35)
         return response.json()
     except Exception as e:
         logger.error(f"Error getting updates: {e}")
@@ -31,7 +51,7 @@ def send_chat_action(chat_id, action="typing"):
         "action": action
     }
     try:
-        requests.post(url, json=payload)
+        http.post(url, json=payload)
     except Exception as e:
         logger.error(f"Error sending chat action: {e}")
 
@@ -46,34 +66,241 @@ def send_message(chat_id, text, reply_markup=None):
         payload["reply_markup"] = reply_markup
         
     try:
-        response = requests.post(url, json=payload)
+        response = http.post(url, json=payload)
         if not response.ok:
             logger.warning(f"Failed to send message with HTML, trying plain text: {response.text}")
             # If HTML fails, try plain text
             payload.pop("parse_mode")
-            requests.post(url, json=payload)
+            response = http.post(url, json=payload)
+        if response.ok:
+            return response.json().get("result", {}).get("message_id")
     except Exception as e:
         logger.error(f"Error sending message: {e}")
+    return None
+
+def _retry_after(response):
+    """Seconds Telegram asks to wait after a 429 (0 for any other response)."""
+    if response.status_code != 429:
+        return 0
+    try:
+        return float(response.json().get("parameters", {}).get("retry_after", 1))
+    except ValueError:
+        return 1.0
+
+def edit_message(chat_id, message_id, text):
+    """Returns (ok, retry_after)."""
+    url = f"{TELEGRAM_API_URL}/editMessageText"
+    payload = {
+        "chat_id": chat_id,
+        "message_id": message_id,
+        "text": text,
+        "parse_mode": "HTML"
+    }
+    try:
+        response = http.post(url, json=payload)
+        if not response.ok and response.status_code != 429 and "message is not modified" not in response.text:
+            # Half-written HTML fails to parse mid-stream; plain text always does
+            payload.pop("parse_mode")
+            response = http.post(url, json=payload)
+        return response.ok, _retry_after(response)
+    except Exception as e:
+        logger.error(f"Error editing message: {e}")
+        return False, 0
+
+def split_text(text, limit=MESSAGE_LIMIT):
+    """Split ``text`` into pieces of at most ``limit`` characters, preferring line and word breaks."""
+    pieces = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut < limit // 2:
+            cut = text.rfind(" ", 0, limit)
+        if cut < limit // 2:
+            cut = limit
+        pieces.append(text[:cut])
+        text = text[cut:].lstrip()
+    pieces.append(text)
+    return pieces
+
+def send_long_message(chat_id, text, reply_markup=None):
+    for piece in split_text(text):
+        send_message(chat_id, piece, reply_markup=reply_markup)
+
+class StreamingReply:
+    """
+    Shows a reply while it is being generated: the first piece is sent as a
+    message, later text is applied with rate-limited editMessageText calls,
+    and text beyond MESSAGE_LIMIT continues in follow-up messages. Intermediate
+    edits are skipped while throttled; the edits that complete a message wait
+    for the rate limit, and if they still fail the text that did not make it
+    is sent as a new message.
+    """
+
+    def __init__(self, chat_id, edit_interval=EDIT_INTERVAL, limit=MESSAGE_LIMIT):
+        self.chat_id = chat_id
+        self.edit_interval = edit_interval
+        self.limit = limit
+        self.full = ""       # the whole reply so far
+        self.text = ""       # text of the message currently being written
+        self.shown = ""      # what Telegram displays for that message
+        self.sent = False    # whether that message was sent (message_id is None if it failed)
+        self.message_id = None
+        self.edited_at = 0.0
+        self.retry_at = 0.0  # set by a 429: no edit before this time
+
+    def _next_edit_at(self):
+        return max(self.edited_at + self.edit_interval, self.retry_at)
 
-def get_or_create_user(chat_data):
-    chat_id = str(chat_data["id"])
-    user = TelegramUser.query.filter_by(chat_id=chat_id).first()
-    if not user:
-        user = TelegramUser(
-            chat_id=chat_id,
-            first_name=chat_data.get("first_name"),
-            last_name=chat_data.get("last_name"),
-            username=chat_data.get("username")
-        )
-        db.session.add(user)
-        db.session.commit()
-        logger.info(f"New Telegram user created: {chat_id}")
-    return user
-
-def save_message(user_id, role, content):
-    msg = TelegramMessage(telegram_user_id=user_id, role=role, content=content)
-    db.session.add(msg)
-    db.session.commit()
+    def _edit(self):
+        ok, retry_after = edit_message(self.chat_id, self.message_id, self.text)
+        self.edited_at = time.monotonic()
+        if ok:
+            self.shown = self.text
+        elif retry_after:
+            self.retry_at = self.edited_at + retry_after
+        return ok
+
+    def _edit_when_allowed(self):
+        for _ in range(EDIT_ATTEMPTS):
+            wait = self._next_edit_at() - time.monotonic()
+            if wait > MAX_EDIT_WAIT:
+                return False
+            if wait > 0:
+                time.sleep(wait)
+            if self._edit():
+                return True
+        return False
+
+    def _show(self, force=False):
+        if self.text == self.shown or not self.text.strip():
+            return
+        if not self.sent:
+            self.message_id = send_message(self.chat_id, self.text)
+            self.sent = True
+            self.shown = self.text
+            self.edited_at = time.monotonic()
+        elif self.message_id is None:
+            if force:
+                # The first send of this message failed; try once more with its final text
+                self.message_id = send_message(self.chat_id, self.text)
+                self.shown = self.text
+        elif not force:
+            if time.monotonic() >= self._next_edit_at():
+                self._edit()
+        elif not self._edit_when_allowed():
+            # The message keeps its last shown text; what it is missing follows in a new message
+            rest = self.text[len(self.shown):].lstrip()
+            if rest:
+                send_message(self.chat_id, rest)
+            self.shown = self.text
+
+    def add(self, chunk):
+        self.full += chunk
+        self.text += chunk
+        while len(self.text) > self.limit:
+            head = split_text(self.text, self.limit)[0]
+            rest = self.text[len(head):].lstrip()
+            self.text = head
+            self._show(force=True)
+            self.text, self.shown, self.sent, self.message_id = rest, "", False, None
+        self._show()
+
+    def finish(self):
+        """Show the complete text and return the whole reply."""
+        self._show(force=True)
+        return self.full
+
+def send_streamed_reply(chat_id, chunks):
+    reply = StreamingReply(chat_id)
+    for chunk in chunks:
+        reply.add(chunk)
+    return reply.finish()
+
+store = TelegramStore()
+
+def handle_update(update):
+    message = update["message"]
+    chat_id = message["chat"]["id"]
+
+    # A redelivered update (e.g. after a crash before the offset was stored) is not answered twice
+    if store.already_handled(update.get("update_id")):
+        logger.info(f"Skipping update {update['update_id']}: already handled")
+        return
+
+    with store.unit_of_work(message["chat"], update.get("update_id")) as uow:
+        # Handle contact/phone number
+        if "contact" in message:
+            contact = message["contact"]
+            if str(contact["user_id"]) == str(chat_id):
+                uow.set_phone(contact["phone_number"])
+                send_message(chat_id, "شكراً لك، تم حفظ رقم هاتفك بنجاح. كيف يمكنني مساعدتك الآن؟", reply_markup={"remove_keyboard": True})
+            return
+
+        if "text" not in message:
+            return
+
+        user_text = message["text"]
+        logger.info(f"Received message from {chat_id}: {user_text}")
+
+        # Previous turns, read before the current message is recorded
+        history = uow.history
+        uow.add_message("user", user_text)
+
+        if user_text.startswith("/start"):
+            welcome_msg = "<b>مرحباً بك في بوت مؤسسة الحبيب الطبية.</b>\n\nأنا مساعدك الذكي، يمكنني الإجابة على استفساراتك حول خدماتنا الطبية، المستلزمات، الوكالات المعتمدة، وغيرها.\n\nيرجى تزويدنا برقم هاتفك للتواصل الأفضل:"
+
+            keyboard = {
+                "keyboard": [[{"text": "مشاركة رقم الهاتف", "request_contact": True}]],
+                "resize_keyboard": True,
+                "one_time_keyboard": True
+            }
+            send_message(chat_id, welcome_msg, reply_markup=keyboard)
+            return
+
+        # Greetings, thanks, a phone number... are answered from templates without the model
+        routed = route_message(user_text, 'telegram')
+        for key in count_keys('telegram', routed):
+            uow.count(key)
+        if routed is not None:
+            if routed.intent == PHONE:
+                uow.set_phone(routed.phone)
+            send_message(chat_id, routed.reply)
+            uow.add_message("assistant", routed.reply)
+            return
+
+        # Show "typing" status while generating response
+        send_chat_action(chat_id)
+
+        try:
+            if STREAM_REPLIES:
+                from ai_engine import stream_ai_response
+
+                # The customer sees the first words as soon as the model produces them
+                response_text = send_streamed_reply(
+                    chat_id, stream_ai_response(
+                        user_text, history=history, priority=PRIORITY_TELEGRAM, owner=store.kb_owner()
+                    )
+                )
+            else:
+                from ai_engine import generate_ai_response
+
+                response_text = generate_ai_response(
+                    user_text, history=history, priority=PRIORITY_TELEGRAM, owner=store.kb_owner()
+                )
+                send_long_message(chat_id, response_text)
+
+            # Save assistant message
+            uow.add_message("assistant", response_text)
+
+            # Check if admin notification is needed (e.g., specific keywords)
+            admin_id = store.get_setting("admin_telegram_id")
+            if admin_id:
+                user = uow.state
+                admin_notify = f"🔔 *رسالة جديدة*\n👤 العميل: {user.first_name} {user.last_name or ''}\n📱 الهاتف: {user.phone_number or 'غير متوفر'}\n💬 الرسالة: {user_text}"
+                send_message(admin_id, admin_notify)
+
+        except Exception as e:
+            logger.error(f"Error generating/sending AI response: {e}")
+            send_message(chat_id, "عذراً، واجهت مشكلة في معالجة طلبك. يرجى المحاولة لاحقاً.")
 
 def handle_updates(updates):
     if not updates or "result" not in updates:
@@ -85,88 +312,153 @@ def handle_updates(updates):
         
         # Handle messages
         if "message" in update:
-            message = update["message"]
-            chat_id = message["chat"]["id"]
-            
             with app.app_context():
-                user = get_or_create_user(message["chat"])
-                
-                # Handle contact/phone number
-                if "contact" in message:
-                    contact = message["contact"]
-                    if str(contact["user_id"]) == str(chat_id):
-                        user.phone_number = contact["phone_number"]
-                        db.session.commit()
-                        send_message(chat_id, "شكراً لك، تم حفظ رقم هاتفك بنجاح. كيف يمكنني مساعدتك الآن؟", reply_markup={"remove_keyboard": True})
-                    continue
-
-                if "text" in message:
-                    user_text = message["text"]
-                    logger.info(f"Received message from {chat_id}: {user_text}")
-                    
-                    # Save user message
-                    save_message(user.id, "user", user_text)
-                    
-                    if user_text.startswith("/start"):
-                        welcome_msg = "<b>مرحباً بك في بوت مؤسسة الحبيب الطبية.</b>\n\nأنا مساعدك الذكي، يمكنني الإجابة على استفساراتك حول خدماتنا الطبية، المستلزمات، الوكالات المعتمدة، وغيرها.\n\nيرجى تزويدنا برقم هاتفك للتواصل الأفضل:"
-                        
-                        keyboard = {
-                            "keyboard": [[{"text": "مشاركة رقم الهاتف", "request_contact": True}]],
-                            "resize_keyboard": True,
-                            "one_time_keyboard": True
-                        }
-                        send_message(chat_id, welcome_msg, reply_markup=keyboard)
-                        continue
-
-                    # Show "typing" status while generating response
-                    send_chat_action(chat_id)
-                    
-                    try:
-                        from ai_engine import generate_ai_response
-                        
-                        # Get telegram history
-                        history_msgs = TelegramMessage.query.filter_by(telegram_user_id=user.id).order_by(TelegramMessage.created_at.asc()).limit(10).all()
-                        history = [{"role": m.role, "content": m.content} for m in history_msgs]
-                        
-                        response_text = generate_ai_response(user_text, history=history)
-                        
-                        # Save assistant message
-                        save_message(user.id, "assistant", response_text)
-                        
-                        send_message(chat_id, response_text)
-                        
-                        # Check if admin notification is needed (e.g., specific keywords)
-                        admin_id = AppSetting.get_setting("admin_telegram_id")
-                        if admin_id:
-                            admin_notify = f"🔔 *رسالة جديدة*\n👤 العميل: {user.first_name} {user.last_name or ''}\n📱 الهاتف: {user.phone_number or 'غير متوفر'}\n💬 الرسالة: {user_text}"
-                            send_message(admin_id, admin_notify)
-                            
-                    except Exception as e:
-                        logger.error(f"Error generating/sending AI response: {e}")
-                        send_message(chat_id, "عذراً، واجهت مشكلة في معالجة طلبك. يرجى المحاولة لاحقاً.")
+                try:
+                    handle_update(update)
+                except Exception as e:
+                    logger.error(f"Error handling update {last_update_id}: {e}")
             
     return last_update_id
 
-def main():
+def run():
+    """Poll Telegram and answer the updates in this process."""
     logger.info("Starting Telegram Bot with Admin Control Features...")
+
+    # Resume after the last update whose effects were committed
     with app.app_context():
-        db.create_all()
-        
-    offset = None
+        offset = store.load_offset()
+    if offset:
+        logger.info(f"Resuming from update {offset}")
+    try:
+        while True:
+            try:
+                updates = get_updates(offset)
+                if updates and updates.get("ok"):
+                    last_id = handle_updates(updates)
+                    if last_id:
+                        offset = last_id + 1
+                else:
+                    if updates:
+                        logger.warning(f"Telegram API returned not OK: {updates}")
+                with app.app_context():
+                    store.flush()
+            except Exception as e:
+                logger.error(f"Main loop error: {e}")
+
+            time.sleep(0.5)
+    finally:
+        # Do not lose rows still sitting in the write-behind buffer
+        with app.app_context():
+            store.flush(force=True)
+
+def poll():
+    """Only fetch updates and queue them for the consumers (see telegram_queue.py)."""
+    logger.info("Starting Telegram poller...")
+    with app.app_context():
+        offset = store.load_offset()
+        telegram_queue.ensure_partitions()
+    if offset:
+        logger.info(f"Resuming from update {offset}")
     while True:
         try:
             updates = get_updates(offset)
             if updates and updates.get("ok"):
-                last_id = handle_updates(updates)
-                if last_id:
-                    offset = last_id + 1
-            else:
-                if updates:
-                    logger.warning(f"Telegram API returned not OK: {updates}")
+                result = updates.get("result") or []
+                if result:
+                    with app.app_context():
+                        queued = telegram_queue.enqueue(result)
+                    offset = max(u["update_id"] for u in result) + 1
+                    logger.info(f"Queued {queued} of {len(result)} updates")
+                    continue
+            elif updates:
+                logger.warning(f"Telegram API returned not OK: {updates}")
         except Exception as e:
-            logger.error(f"Main loop error: {e}")
-        
+            logger.error(f"Poller error: {e}")
         time.sleep(0.5)
 
+def process_claim(claim):
+    """Answer the updates of one leased queue partition in order, then release it."""
+    if claim.taken_over and claim.updates:
+        # Another consumer served these chats last: our cached history is stale,
+        # and if it crashed, its last update may already have been answered
+        for _, update in claim.updates:
+            store.forget(update["message"]["chat"]["id"])
+        store.mark_replay(claim.updates[0][0])
+
+    handled = []
+    for update_id, update in claim.updates:
+        with app.app_context():
+            try:
+                handle_update(update)
+            except Exception as e:
+                logger.error(f"Error handling update {update_id}: {e}")
+                # Set aside rather than deleted unanswered, or retried ahead of the chat's later updates
+                if not telegram_queue.dead_letter(claim, update_id, e):
+                    give_up(claim)
+                    return
+                continue
+            handled.append(update_id)
+            # Updates whose messages sit in the write-behind buffer are acknowledged once flushed
+            if not store.pending_count:
+                if not telegram_queue.ack(claim, handled):
+                    give_up(claim)
+                    return
+                handled = []
+
+    with app.app_context():
+        store.flush(force=True)
+        if store.pending_count:
+            # The updates stay queued and will be answered again: their rows must not be stored later
+            store.discard_pending()
+            handled = []
+        if not telegram_queue.ack(claim, handled, release=True):
+            give_up(claim)
+
+def give_up(claim):
+    """Leave a partition whose lease was lost to another consumer, which now serves its chats."""
+    with app.app_context():
+        store.flush(force=True)
+        if store.pending_count:
+            store.discard_pending()
+    for _, update in claim.updates:
+        store.forget(update["message"]["chat"]["id"])
+
+def consume(owner=None, idle_sleep=0.5, until_empty=False):
+    """Answer queued updates; run any number of these next to one poller (until_empty: stop once the queue is drained)."""
+    owner = owner or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    # The poller owns the getUpdates offset
+    store.track_offset = False
+    logger.info(f"Starting Telegram consumer {owner}...")
+    while True:
+        try:
+            with app.app_context():
+                claim = telegram_queue.claim(owner)
+            if claim is None:
+                if until_empty:
+                    with app.app_context():
+                        if not telegram_queue.pending_count():
+                            return
+                time.sleep(idle_sleep)
+                continue
+            process_claim(claim)
+        except Exception as e:
+            logger.error(f"Consumer error: {e}")
+            time.sleep(idle_sleep)
+
+def requeue():
+    with app.app_context():
+        count = telegram_queue.requeue_dead()
+    logger.info(f"Requeued {count} failed Telegram updates")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Telegram bot")
+    parser.add_argument(
+        "mode", nargs="?", choices=["run", "poll", "consume", "requeue"], default="run",
+        help="run: poll and answer in one process; poll / consume: the queue-based split (see telegram_queue.py); "
+             "requeue: put the updates that failed back in the queue"
+    )
+    args = parser.parse_args(argv)
+    {"run": run, "poll": poll, "consume": consume, "requeue": requeue}[args.mode]()
+
 if __name__ == "__main__":
     main()
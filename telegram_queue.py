@@ -0,0 +1,227 @@
+"""
+Durable queue between the Telegram poller and the bot consumers.
+
+Only one process may call getUpdates for a bot token, so with the queue the
+bot runs as one poller and any number of consumers:
+
+    python telegram_bot.py poll       fetch updates, store them here, advance the offset
+    python telegram_bot.py consume    (N processes) answer the queued updates
+
+Chats are spread over QUEUE_PARTITIONS partitions by chat_id. A consumer
+leases a whole partition (SELECT ... FOR UPDATE SKIP LOCKED on PostgreSQL; on
+SQLite, which has no row locks, the single-statement UPDATE that takes the
+lease is serialized by the database write lock), answers its updates in
+update_id order and deletes them. A chat therefore never has two updates in
+flight, while different partitions are processed in parallel.
+
+A lease that is not renewed within QUEUE_LEASE seconds (crashed consumer)
+is taken over by another consumer, which re-checks the first update against
+the stored messages so it is not answered twice.
+
+An update whose handling raises is moved to telegram_dead_updates rather
+than retried forever or deleted; ``python telegram_bot.py requeue`` puts
+the dead updates back in the queue.
+"""
+import os
+import json
+import zlib
+import logging
+import datetime
+from sqlalchemy import delete, exists, or_, select, update
+from database import db
+from models import AppSetting, TelegramDeadUpdate, TelegramQueuePartition, TelegramUpdate
+from telegram_store import OFFSET_KEY
+
+logger = logging.getLogger(__name__)
+
+# Changing the partition count re-maps chats: only do it with an empty queue
+QUEUE_PARTITIONS = int(os.environ.get("TELEGRAM_QUEUE_PARTITIONS", "64"))
+# Seconds a consumer may hold a partition without renewing its lease
+QUEUE_LEASE = float(os.environ.get("TELEGRAM_QUEUE_LEASE", "300"))
+# Updates taken from a partition per claim
+QUEUE_BATCH = int(os.environ.get("TELEGRAM_QUEUE_BATCH", "20"))
+
+
+def partition_of(chat_id, partitions=QUEUE_PARTITIONS):
+    try:
+        return int(chat_id) % partitions
+    except (TypeError, ValueError):
+        return zlib.crc32(str(chat_id).encode('utf-8')) % partitions
+
+
+class Claim:
+    """The updates of one leased partition, oldest first."""
+
+    def __init__(self, partition, owner, previous_owner, updates):
+        self.partition = partition
+        self.owner = owner
+        self.previous_owner = previous_owner
+        self.updates = updates  # [(update_id, update dict)]
+
+    @property
+    def taken_over(self):
+        """The partition was last served by another consumer (whose cached chat state is not ours)."""
+        return self.previous_owner != self.owner
+
+
+def ensure_partitions(partitions=QUEUE_PARTITIONS):
+    existing = {p for (p,) in db.session.query(TelegramQueuePartition.id)}
+    missing = [p for p in range(partitions) if p not in existing]
+    for p in missing:
+        db.session.add(TelegramQueuePartition(id=p))
+    db.session.commit()
+    if missing:
+        logger.info(f"Created {len(missing)} Telegram queue partitions")
+
+
+def enqueue(updates, partitions=QUEUE_PARTITIONS):
+    """
+    Store the message updates of one getUpdates response and advance the
+    stored offset past every update, in a single transaction. Returns the
+    number of updates queued.
+    """
+    if not updates:
+        return 0
+    messages = [u for u in updates if "message" in u]
+    queued = set()
+    if messages:
+        queued = {
+            update_id for (update_id,) in db.session.query(TelegramUpdate.id).filter(
+                TelegramUpdate.id.in_([u["update_id"] for u in messages])
+            )
+        }
+    rows = []
+    for u in messages:
+        if u["update_id"] in queued:
+            continue
+        chat_id = str(u["message"]["chat"]["id"])
+        rows.append(TelegramUpdate(
+            id=u["update_id"], chat_id=chat_id, partition=partition_of(chat_id, partitions),
+            payload=json.dumps(u, ensure_ascii=False)
+        ))
+    try:
+        db.session.add_all(rows)
+        db.session.execute(
+            update(AppSetting).where(AppSetting.key == OFFSET_KEY).values(
+                value=str(max(u["update_id"] for u in updates))
+            )
+        )
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return len(rows)
+
+
+def claim(owner, lease=QUEUE_LEASE, batch=QUEUE_BATCH):
+    """Lease the partition with pending updates that waited longest. None if there is no work."""
+    now = datetime.datetime.utcnow()
+    free = or_(TelegramQueuePartition.lease_until.is_(None), TelegramQueuePartition.lease_until < now)
+    candidate = select(TelegramQueuePartition.id).where(
+        free, exists().where(TelegramUpdate.partition == TelegramQueuePartition.id)
+    ).order_by(
+        TelegramQueuePartition.released_at.asc().nulls_first()
+    ).limit(1).with_for_update(skip_locked=True).scalar_subquery()
+
+    try:
+        # SET reads the old owner, so previous_owner is the consumer that last held the lease
+        leased = db.session.execute(
+            update(TelegramQueuePartition).where(TelegramQueuePartition.id == candidate, free).values(
+                previous_owner=TelegramQueuePartition.owner, owner=owner,
+                lease_until=now + datetime.timedelta(seconds=lease)
+            ).returning(TelegramQueuePartition.id, TelegramQueuePartition.previous_owner)
+        ).first()
+        if leased is None:
+            db.session.rollback()
+            return None
+        partition, last_owner = leased
+        rows = db.session.query(TelegramUpdate.id, TelegramUpdate.payload).filter(
+            TelegramUpdate.partition == partition
+        ).order_by(TelegramUpdate.id).limit(batch).all()
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return Claim(partition, owner, last_owner, [(update_id, json.loads(payload)) for update_id, payload in rows])
+
+
+def ack(claim, update_ids, release=False, lease=QUEUE_LEASE):
+    """
+    Delete handled updates and renew (or release) the lease. Returns False if
+    the lease was lost to another consumer, which then owns the partition.
+    """
+    now = datetime.datetime.utcnow()
+    values = {'lease_until': None, 'released_at': now} if release else {
+        'lease_until': now + datetime.timedelta(seconds=lease)
+    }
+    try:
+        held = db.session.execute(
+            update(TelegramQueuePartition).where(
+                TelegramQueuePartition.id == claim.partition, TelegramQueuePartition.owner == claim.owner
+            ).values(**values)
+        ).rowcount
+        if held and update_ids:
+            db.session.execute(delete(TelegramUpdate).where(TelegramUpdate.id.in_(update_ids)))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    if not held:
+        logger.warning(f"Lost the lease on Telegram queue partition {claim.partition}")
+    return bool(held)
+
+
+def dead_letter(claim, update_id, error, lease=QUEUE_LEASE):
+    """
+    Move a queued update whose handling failed to telegram_dead_updates and
+    renew the lease. Returns False if the lease was lost (the update stays queued).
+    """
+    now = datetime.datetime.utcnow()
+    try:
+        held = db.session.execute(
+            update(TelegramQueuePartition).where(
+                TelegramQueuePartition.id == claim.partition, TelegramQueuePartition.owner == claim.owner
+            ).values(lease_until=now + datetime.timedelta(seconds=lease))
+        ).rowcount
+        row = db.session.get(TelegramUpdate, update_id) if held else None
+        if row is not None:
+            # merge: an update requeued earlier may fail again
+            db.session.merge(TelegramDeadUpdate(
+                id=row.id, chat_id=row.chat_id, payload=row.payload, error=str(error)[:2000], failed_at=now
+            ))
+            db.session.delete(row)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    if not held:
+        logger.warning(f"Lost the lease on Telegram queue partition {claim.partition}")
+        return False
+    logger.error(f"Telegram update {update_id} moved to the dead-letter table: {error}")
+    return True
+
+
+def requeue_dead(partitions=QUEUE_PARTITIONS):
+    """Put every dead update back in the queue. Returns the number requeued."""
+    try:
+        dead = db.session.query(TelegramDeadUpdate).order_by(TelegramDeadUpdate.id).all()
+        queued = {
+            update_id for (update_id,) in db.session.query(TelegramUpdate.id).filter(
+                TelegramUpdate.id.in_([d.id for d in dead])
+            )
+        } if dead else set()
+        for d in dead:
+            if d.id not in queued:
+                db.session.add(TelegramUpdate(
+                    id=d.id, chat_id=d.chat_id, partition=partition_of(d.chat_id, partitions), payload=d.payload
+                ))
+            db.session.delete(d)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return len(dead)
+
+
+def pending_count():
+    return db.session.query(TelegramUpdate).count()
@@ -0,0 +1,436 @@
+import logging
+import os
+import time
+import datetime
+from collections import OrderedDict, deque
+from sqlalchemy import exists, func, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from database import db
+from models import TelegramUser, TelegramMessage, AppSetting, User, telegram_user_search_text
+from stats import increment
+
+logger = logging.getLogger(__name__)
+
+# Number of previous turns handed to the AI engine as conversation history
+HISTORY_LIMIT = 10
+# How long AppSetting values (e.g. admin_telegram_id) are reused before re-reading
+SETTINGS_TTL = int(os.environ.get("TELEGRAM_SETTINGS_TTL", "60"))
+# Write-behind buffer: 0 disables it (every update commits its own messages)
+MESSAGE_BATCH_SIZE = int(os.environ.get("TELEGRAM_MESSAGE_BATCH", "0"))
+MESSAGE_FLUSH_INTERVAL = float(os.environ.get("TELEGRAM_FLUSH_INTERVAL", "2.0"))
+# Buffered rows kept while the database refuses them; the oldest are dropped beyond it
+MAX_PENDING = int(os.environ.get("TELEGRAM_MAX_PENDING", "10000"))
+# Longest wait between flush attempts after failures (seconds)
+MAX_FLUSH_BACKOFF = 60.0
+# Chats whose state is cached; the least recently active are reloaded from the database
+CHAT_CACHE_SIZE = int(os.environ.get("TELEGRAM_CHAT_CACHE_SIZE", "10000"))
+# AppSetting holding the last update_id whose effects are committed
+OFFSET_KEY = "telegram_last_update_id"
+# Username whose knowledge base answers Telegram customers (unset: every user's training data, as before)
+KB_OWNER = os.environ.get("TELEGRAM_KB_OWNER", "")
+
+
+def _is_duplicate_update(exc):
+    """True when the unique index on telegram_messages.update_id refused the insert."""
+    return 'update_id' in str(getattr(exc, 'orig', exc))
+
+
+class ChatState:
+    """Cached view of one Telegram chat: the user row id and recent history."""
+    __slots__ = ("chat_id", "user_id", "first_name", "last_name", "username", "phone_number", "history")
+
+    def __init__(self, chat_id, user_id=None, first_name=None, last_name=None, username=None, phone_number=None, history=()):
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.first_name = first_name
+        self.last_name = last_name
+        self.username = username
+        self.phone_number = phone_number
+        self.history = deque(history, maxlen=HISTORY_LIMIT)
+
+
+class UnitOfWork:
+    """Collects every write caused by a single Telegram update."""
+
+    def __init__(self, store, state, update_id=None):
+        self.store = store
+        self.state = state
+        self.update_id = update_id
+        self.messages = []
+        self.phone_number = None
+        self.counters = {}
+
+    @property
+    def history(self):
+        return list(self.state.history)
+
+    def add_message(self, role, content):
+        # The customer's message carries the update_id, which is unique per stored update
+        update_id = self.update_id if role == "user" else None
+        self.messages.append((role, content, datetime.datetime.utcnow(), update_id))
+
+    def set_phone(self, phone_number):
+        self.phone_number = phone_number
+
+    def count(self, key, amount=1):
+        """Bump a stat counter in the transaction that stores this update."""
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.store.apply(self)
+        return False
+
+
+class TelegramStore:
+    """
+    Persistence layer for the Telegram bot.
+
+    Each update is handled as one unit of work: reads are served from a
+    chat_id cache where possible and all writes are applied in a single
+    transaction when the update finishes. With a batch size > 0, message
+    rows are held in a write-behind buffer and inserted in batches.
+
+    The last update_id is committed in the same transaction as the rows it
+    produced (with the write-behind buffer: once they are flushed), so a
+    restarted bot resumes right after the last update whose effects were
+    stored. Queue consumers (track_offset=False) leave the offset to the
+    poller (see telegram_queue.py).
+    """
+
+    def __init__(self, batch_size=MESSAGE_BATCH_SIZE, flush_interval=MESSAGE_FLUSH_INTERVAL, settings_ttl=SETTINGS_TTL,
+                 track_offset=True, chat_cache_size=CHAT_CACHE_SIZE, max_pending=MAX_PENDING):
+        self.batch_size = batch_size
+        self.track_offset = track_offset
+        self.flush_interval = flush_interval
+        self.settings_ttl = settings_ttl
+        self.chat_cache_size = chat_cache_size
+        self.max_pending = max_pending
+        # chat_id -> ChatState, least recently active first
+        self._chats = OrderedDict()
+        self._settings = {}
+        self._kb_owner = None
+        self._pending = []
+        # Counter increments of the buffered updates, applied with their rows
+        self._pending_counters = {}
+        self._pending_since = None
+        self._pending_update_id = None
+        # Consecutive failed flushes, and when the next attempt is allowed
+        self._flush_failures = 0
+        self._retry_at = 0.0
+        # Updates up to this id may already be stored (set by load_offset after a restart)
+        self._replay_until = None
+
+    def unit_of_work(self, chat_data, update_id=None):
+        return UnitOfWork(self, self._get_chat(chat_data), update_id)
+
+    def load_offset(self):
+        """The getUpdates offset to resume from (None on first start)."""
+        setting = AppSetting.query.filter_by(key=OFFSET_KEY).first()
+        if setting is None:
+            db.session.add(AppSetting(key=OFFSET_KEY, value="0", description="Last processed Telegram update_id"))
+            db.session.commit()
+            last_update_id = 0
+        else:
+            last_update_id = int(setting.value or 0)
+        stored = db.session.query(func.max(TelegramMessage.update_id)).scalar() or 0
+        self._replay_until = max(last_update_id, stored) or None
+        db.session.rollback()
+        return last_update_id + 1 if last_update_id else None
+
+    def already_handled(self, update_id):
+        """True if a redelivered update's message is already stored."""
+        if update_id is None or self._replay_until is None or update_id > self._replay_until:
+            return False
+        handled = db.session.query(exists().where(TelegramMessage.update_id == update_id)).scalar()
+        db.session.rollback()
+        return handled
+
+    def mark_replay(self, update_id):
+        """Updates up to ``update_id`` may have been handled elsewhere: check them before answering."""
+        self._replay_until = max(self._replay_until or 0, update_id)
+
+    def _save_offset(self, update_id):
+        if update_id is not None and self.track_offset:
+            db.session.execute(
+                update(AppSetting).where(AppSetting.key == OFFSET_KEY).values(value=str(update_id))
+            )
+
+    def _get_chat(self, chat_data):
+        chat_id = str(chat_data["id"])
+        state = self._chats.get(chat_id)
+        if state is not None:
+            self._chats.move_to_end(chat_id)
+            return state
+
+        user = TelegramUser.query.filter_by(chat_id=chat_id).first()
+        if user:
+            recent = TelegramMessage.query.filter_by(telegram_user_id=user.id).order_by(
+                TelegramMessage.created_at.desc(), TelegramMessage.id.desc()
+            ).limit(HISTORY_LIMIT).all()
+            state = ChatState(
+                chat_id,
+                user_id=user.id,
+                first_name=user.first_name,
+                last_name=user.last_name,
+                username=user.username,
+                phone_number=user.phone_number,
+                history=[{"role": m.role, "content": m.content} for m in reversed(recent)]
+            )
+        else:
+            state = ChatState(
+                chat_id,
+                first_name=chat_data.get("first_name"),
+                last_name=chat_data.get("last_name"),
+                username=chat_data.get("username")
+            )
+
+        # End the read transaction so it is not held open while the AI engine runs
+        db.session.rollback()
+        self._chats[chat_id] = state
+        self._trim_chats()
+        return state
+
+    def _trim_chats(self):
+        if len(self._chats) <= self.chat_cache_size:
+            return
+        # A chat with buffered rows keeps its state: reloaded from the database, its history would miss them
+        buffered = {row["telegram_user_id"] for row in self._pending}
+        # The newest entry is the chat being handled
+        for chat_id in list(self._chats)[:-1]:
+            if len(self._chats) <= self.chat_cache_size:
+                break
+            if self._chats[chat_id].user_id not in buffered:
+                del self._chats[chat_id]
+
+    def get_setting(self, key, default=None):
+        cached = self._settings.get(key)
+        now = time.monotonic()
+        if cached and now - cached[1] < self.settings_ttl:
+            return cached[0]
+        value = AppSetting.get_setting(key, default)
+        self._settings[key] = (value, now)
+        return value
+
+    def kb_owner(self):
+        """Id of the TELEGRAM_KB_OWNER user, or None (the shared knowledge base) if unset or unknown."""
+        now = time.monotonic()
+        if self._kb_owner and now - self._kb_owner[1] < self.settings_ttl:
+            return self._kb_owner[0]
+        owner = None
+        if KB_OWNER:
+            owner = db.session.query(User.id).filter_by(username=KB_OWNER).scalar()
+            if owner is None and self._kb_owner is None:
+                logger.warning(f"TELEGRAM_KB_OWNER user {KB_OWNER!r} not found; answering from every user's data")
+        self._kb_owner = (owner, now)
+        return owner
+
+    def apply(self, uow, retry=True):
+        """Write everything recorded by a unit of work in one transaction."""
+        state = uow.state
+        created = state.user_id is None
+        if not created and not uow.messages and uow.phone_number is None:
+            return
+        # Committed as the offset once this update's rows are stored
+        offset = uow.update_id if uow.update_id is not None else self._pending_update_id
+
+        rows = []
+        counters = dict(self._pending_counters)
+        for key, amount in uow.counters.items():
+            counters[key] = counters.get(key, 0) + amount
+        flushed = False
+        user_conflict = False
+        try:
+            if created:
+                user = TelegramUser(
+                    chat_id=state.chat_id,
+                    first_name=state.first_name,
+                    last_name=state.last_name,
+                    username=state.username,
+                    phone_number=uow.phone_number
+                )
+                db.session.add(user)
+                user_conflict = True
+                db.session.flush()
+                user_conflict = False
+                state.user_id = user.id
+                increment('telegram_users')
+            elif uow.phone_number is not None:
+                db.session.execute(
+                    update(TelegramUser).where(TelegramUser.id == state.user_id).values(
+                        phone_number=uow.phone_number,
+                        content_norm=telegram_user_search_text(
+                            state.first_name, state.last_name, state.username, uow.phone_number, state.chat_id
+                        )
+                    )
+                )
+
+            rows = [
+                {"telegram_user_id": state.user_id, "role": role, "content": content,
+                 "created_at": created_at, "update_id": update_id}
+                for role, content, created_at, update_id in uow.messages
+            ]
+            if self.batch_size > 0:
+                rows = self._pending + rows
+                if self._flush_due(len(rows)):
+                    flushed = True
+                    self._insert_messages(rows, counters)
+            else:
+                self._insert_messages(rows, uow.counters)
+            # Buffered rows are not stored yet: the offset only moves past them when they are
+            if not rows or flushed or self.batch_size <= 0:
+                self._save_offset(offset)
+
+            db.session.commit()
+        except IntegrityError as exc:
+            db.session.rollback()
+            if created:
+                state.user_id = None
+            if user_conflict:
+                # Another process created this customer first: write the update against its row
+                existing = TelegramUser.query.filter_by(chat_id=state.chat_id).first()
+                if existing is None:
+                    raise
+                state.user_id = existing.id
+                return self.apply(uow, retry)
+            if flushed and retry and self._pending:
+                # The collision may be in the buffer: store it on its own, then this update alone
+                self.flush(force=True)
+                if not self._pending:
+                    return self.apply(uow, retry=False)
+                # The buffer could not be stored either: this update is not stored
+                raise
+            if not _is_duplicate_update(exc):
+                raise
+            # Another delivery of the same update was stored first; the buffer is left as it was
+            self._pending_update_id = offset
+            logger.warning(f"Telegram update {uow.update_id} was already stored; skipped")
+            return
+        except Exception:
+            db.session.rollback()
+            if created:
+                state.user_id = None
+            raise
+
+        self._pending_update_id = offset
+        if created:
+            logger.info(f"New Telegram user created: {state.chat_id}")
+        if self.batch_size > 0:
+            if flushed:
+                self._pending, self._pending_since, self._pending_counters = [], None, {}
+                self._flush_failures, self._retry_at = 0, 0.0
+            else:
+                if rows and self._pending_since is None:
+                    self._pending_since = time.monotonic()
+                self._pending, self._pending_counters = rows, counters
+                self._trim_pending()
+        if uow.phone_number is not None:
+            state.phone_number = uow.phone_number
+        for role, content, _, _ in uow.messages:
+            state.history.append({"role": role, "content": content})
+
+    def _insert_messages(self, rows, counters=None):
+        if rows:
+            # render_nulls keeps the assistant rows (update_id None) in the same multi-row INSERT
+            db.session.execute(insert(TelegramMessage).execution_options(render_nulls=True), rows)
+            increment('telegram_messages', len(rows))
+        for key, amount in (counters or {}).items():
+            increment(key, amount)
+
+    def _drop_stored(self, rows):
+        """``rows`` without the updates another delivery already stored (their replies included)."""
+        update_ids = [row["update_id"] for row in rows if row["update_id"] is not None]
+        stored = set(db.session.scalars(
+            select(TelegramMessage.update_id).where(TelegramMessage.update_id.in_(update_ids))
+        )) if update_ids else set()
+        db.session.rollback()
+        kept, skipping = [], set()
+        for row in rows:
+            user_id = row["telegram_user_id"]
+            if row["update_id"] is not None:
+                if row["update_id"] in stored:
+                    skipping.add(user_id)
+                    continue
+                skipping.discard(user_id)
+            elif user_id in skipping:
+                # Reply rows follow the customer's row of the same chat
+                continue
+            kept.append(row)
+        return kept
+
+    def _trim_pending(self):
+        excess = len(self._pending) - self.max_pending
+        # Only a buffer the database keeps refusing can grow past a batch
+        if excess <= 0 or not self._flush_failures:
+            return
+        dropped, self._pending = self._pending[:excess], self._pending[excess:]
+        logger.error(f"Dropped {excess} buffered Telegram messages: the database has refused them "
+                     f"{self._flush_failures} times")
+        self._forget_rows(dropped)
+
+    def _forget_rows(self, rows):
+        # The cached history of these rows' chats includes turns that will not be stored
+        users = {row["telegram_user_id"] for row in rows}
+        for chat_id in [c for c, state in self._chats.items() if state.user_id in users]:
+            del self._chats[chat_id]
+
+    def discard_pending(self):
+        """Drop the buffered rows (their updates will be handled again) and the state of their chats."""
+        dropped = self._pending
+        self._pending, self._pending_since, self._pending_counters = [], None, {}
+        if dropped:
+            logger.warning(f"Discarded {len(dropped)} buffered Telegram messages")
+            self._forget_rows(dropped)
+        return len(dropped)
+
+    def _flush_due(self, count):
+        if not count:
+            return False
+        if time.monotonic() < self._retry_at:
+            return False
+        if count >= self.batch_size:
+            return True
+        return self._pending_since is not None and time.monotonic() - self._pending_since >= self.flush_interval
+
+    def flush(self, force=False):
+        """Insert buffered message rows if the batch is full, stale, or forced."""
+        if not self._pending or not (force or self._flush_due(len(self._pending))):
+            return 0
+        rows = self._pending
+        try:
+            try:
+                self._insert_messages(rows, self._pending_counters)
+            except IntegrityError:
+                # Some buffered update was stored by another delivery: keep the rest
+                db.session.rollback()
+                rows = self._drop_stored(rows)
+                logger.warning(f"Skipped {len(self._pending) - len(rows)} buffered Telegram messages already stored")
+                self._insert_messages(rows, self._pending_counters)
+            self._save_offset(self._pending_update_id)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            self._flush_failures += 1
+            backoff = min(MAX_FLUSH_BACKOFF, self.flush_interval * 2 ** self._flush_failures)
+            self._retry_at = time.monotonic() + backoff
+            logger.error(f"Error flushing {len(rows)} buffered Telegram messages (retrying in {backoff:.1f}s): {e}")
+            self._trim_pending()
+            return 0
+        self._pending, self._pending_since, self._pending_counters = [], None, {}
+        self._flush_failures, self._retry_at = 0, 0.0
+        return len(rows)
+
+    @property
+    def pending_count(self):
+        return len(self._pending)
+
+    def forget(self, chat_id=None):
+        """Drop cached chat state (all chats when chat_id is None)."""
+        if chat_id is None:
+            self._chats.clear()
+            self._settings.clear()
+        else:
+            self._chats.pop(str(chat_id), None)
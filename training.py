@@ -1,6 +1,6 @@
 import os
+import json
 import logging
-import uuid
 import datetime
 import re
 from werkzeug.utils import secure_filename
@@ -8,6 +8,12 @@ from flask import Blueprint, render_template, request, jsonify, redirect, url_fo
 from flask_login import login_required, current_user
 from models import TrainingData, TrainingFile
 from database import db
+from stats import stats_cache
+from knowledge_index import mark_stale
+from dedupe import Deduplicator, DEFAULT_POLICY, POLICIES
+from upload_store import save_stream, find_processed
+from reingest import reingest_source
+import precompute
 
 training_bp = Blueprint('training', __name__)
 logger = logging.getLogger(__name__)
@@ -21,7 +27,7 @@ def allowed_file(filename):
 @training_bp.route('/training')
 @login_required
 def training_page():
-    return render_template('training.html')
+    return render_template('training.html', policies=POLICIES, default_policy=DEFAULT_POLICY)
 
 @training_bp.route('/data')
 @login_required
@@ -52,6 +58,9 @@ def add_manual_training():
     try:
         db.session.add(training_data)
         db.session.commit()
+        mark_stale()
+        precompute.schedule()
+        stats_cache.discard(('dashboard', current_user.id))
         return jsonify({
             'id': training_data.id,
             'question': training_data.question,
@@ -73,42 +82,57 @@ def upload_training_file():
     if file.filename == '':
         return jsonify({'error': 'No selected file'}), 400
     
+    policy = request.form.get('duplicate_policy', DEFAULT_POLICY)
+    if policy not in POLICIES:
+        return jsonify({'error': f'Unknown duplicate policy: {policy}'}), 400
+    # Treat the upload as a new version of an earlier file with the same name
+    replace_source = request.form.get('replace_source', '').lower() in ('1', 'true', 'on')
+    
     if file and allowed_file(file.filename):
         original_filename = secure_filename(file.filename)
-        file_extension = original_filename.rsplit('.', 1)[1].lower() if '.' in original_filename else ''
-        unique_filename = f"{uuid.uuid4().hex}.{file_extension}"
         
         training_file = TrainingFile(
             user_id=current_user.id,
-            filename=unique_filename,
             original_filename=original_filename,
-            file_size=0,
             file_type=file.content_type if hasattr(file, 'content_type') else 'application/octet-stream',
             status='processing'
         )
         
         try:
             upload_dir = current_app.config.get('UPLOAD_FOLDER', 'uploads')
-            os.makedirs(upload_dir, exist_ok=True)
+            content_hash, size, stored_name = save_stream(file.stream, upload_dir)
             
-            file_path = os.path.join(upload_dir, unique_filename)
-            file.save(file_path)
+            training_file.filename = stored_name
+            training_file.file_size = size
+            training_file.content_hash = content_hash
             
-            training_file.file_size = os.path.getsize(file_path)
+            # Identical content was already extracted for this user: link to it instead of re-parsing.
+            # A replacement is always reingested: it may restore a version that was since replaced
+            previous = None if replace_source else find_processed(current_user.id, content_hash)
+            if previous:
+                training_file.status = 'completed'
+                training_file.duplicate_of_id = previous.id
+                training_file.processed_at = datetime.datetime.utcnow()
             db.session.add(training_file)
             db.session.commit()
             
-            # Process immediately
-            success = process_training_file(training_file.id)
+            if previous:
+                success = True
+            else:
+                # Process immediately
+                success = process_training_file(training_file.id, policy=policy, replace_source=replace_source)
             
             # Refresh to get updated status
             db.session.refresh(training_file)
+            stats_cache.discard(('dashboard', current_user.id))
             
             return jsonify({
                 'id': training_file.id,
                 'filename': training_file.original_filename,
                 'status': training_file.status,
                 'created_at': training_file.created_at.isoformat(),
+                'dedupe': json.loads(training_file.dedupe_report) if training_file.dedupe_report else None,
+                'duplicate_of': training_file.duplicate_of_id,
                 'success': success
             })
         except Exception as e:
@@ -118,8 +142,61 @@ def upload_training_file():
     
     return jsonify({'error': 'File type not allowed'}), 400
 
-def process_training_file(file_id):
-    """Process an uploaded training file with enhanced extraction logic."""
+def parse_training_text(content):
+    """Extract (question, answer) pairs from the text of a training file."""
+    # Use Regex to find Q&A pairs in both Arabic and English
+    # Arabic: س: ... ج: ...
+    # English: Q: ... A: ... or Question: ... Answer: ...
+    
+    # Pattern for Arabic Q&A
+    arabic_pattern = re.compile(r'س:(.*?)(?=س:|Q:|Question:|$)', re.DOTALL | re.IGNORECASE)
+    english_pattern = re.compile(r'(?:Q:|Question:)(.*?)(?=س:|Q:|Question:|$)', re.DOTALL | re.IGNORECASE)
+    
+    pairs = []
+    
+    # Process Arabic matches
+    for match in arabic_pattern.finditer(content):
+        chunk = match.group(1).strip()
+        if 'ج:' in chunk:
+            parts = chunk.split('ج:', 1)
+            question = parts[0].strip()
+            answer = parts[1].strip()
+            if question and answer:
+                pairs.append((question, answer))
+
+    # Process English matches
+    for match in english_pattern.finditer(content):
+        chunk = match.group(1).strip()
+        if 'A:' in chunk or 'Answer:' in chunk:
+            delimiter = 'A:' if 'A:' in chunk else 'Answer:'
+            parts = chunk.split(delimiter, 1)
+            question = parts[0].strip()
+            answer = parts[1].strip()
+            if question and answer:
+                pairs.append((question, answer))
+    
+    # Fallback for simple line-by-line if no patterns found
+    if not pairs:
+        lines = [l.strip() for l in content.split('\n') if l.strip()]
+        for i in range(0, len(lines) - 1, 2):
+            q = lines[i]
+            a = lines[i+1]
+            # Simple heuristic: if q starts with Q or س and a starts with A or ج
+            q_clean = re.sub(r'^[سQ]:\s*', '', q)
+            a_clean = re.sub(r'^[جA]:\s*', '', a)
+            pairs.append((q_clean, a_clean))
+    
+    return pairs
+
+def process_training_file(file_id, policy=DEFAULT_POLICY, replace_source=False):
+    """Process an uploaded training file with enhanced extraction logic.
+
+    Pairs that duplicate an existing question of the same owner are resolved
+    with the given policy ('skip', 'replace' or 'merge') and summarized in
+    the file's dedupe_report. With ``replace_source`` the file replaces the
+    pairs previously loaded under the same name, changing only rows that
+    differ (see reingest.py).
+    """
     training_file = TrainingFile.query.get(file_id)
     if not training_file:
         return False
@@ -127,79 +204,27 @@ def process_training_file(file_id):
     try:
         file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], training_file.filename)
         
-        if training_file.filename.endswith('.txt'):
+        if training_file.original_filename.lower().endswith('.txt'):
             with open(file_path, 'r', encoding='utf-8') as f:
                 content = f.read()
             
-            # Use Regex to find Q&A pairs in both Arabic and English
-            # Arabic: س: ... ج: ...
-            # English: Q: ... A: ... or Question: ... Answer: ...
-            
-            # Pattern for Arabic Q&A
-            arabic_pattern = re.compile(r'س:(.*?)(?=س:|Q:|Question:|$)', re.DOTALL | re.IGNORECASE)
-            english_pattern = re.compile(r'(?:Q:|Question:)(.*?)(?=س:|Q:|Question:|$)', re.DOTALL | re.IGNORECASE)
-            
-            data_count = 0
-            
-            # Process Arabic matches
-            for match in arabic_pattern.finditer(content):
-                chunk = match.group(1).strip()
-                if 'ج:' in chunk:
-                    parts = chunk.split('ج:', 1)
-                    question = parts[0].strip()
-                    answer = parts[1].strip()
-                    if question and answer:
-                        training_data = TrainingData(
-                            user_id=training_file.user_id,
-                            question=question,
-                            answer=answer,
-                            source_type='file',
-                            source_name=training_file.original_filename
-                        )
-                        db.session.add(training_data)
-                        data_count += 1
-
-            # Process English matches
-            for match in english_pattern.finditer(content):
-                chunk = match.group(1).strip()
-                if 'A:' in chunk or 'Answer:' in chunk:
-                    delimiter = 'A:' if 'A:' in chunk else 'Answer:'
-                    parts = chunk.split(delimiter, 1)
-                    question = parts[0].strip()
-                    answer = parts[1].strip()
-                    if question and answer:
-                        training_data = TrainingData(
-                            user_id=training_file.user_id,
-                            question=question,
-                            answer=answer,
-                            source_type='file',
-                            source_name=training_file.original_filename
-                        )
-                        db.session.add(training_data)
-                        data_count += 1
-            
-            # Fallback for simple line-by-line if no patterns found
-            if data_count == 0:
-                lines = [l.strip() for l in content.split('\n') if l.strip()]
-                for i in range(0, len(lines) - 1, 2):
-                    q = lines[i]
-                    a = lines[i+1]
-                    # Simple heuristic: if q starts with Q or س and a starts with A or ج
-                    q_clean = re.sub(r'^[سQ]:\s*', '', q)
-                    a_clean = re.sub(r'^[جA]:\s*', '', a)
-                    training_data = TrainingData(
-                        user_id=training_file.user_id,
-                        question=q_clean,
-                        answer=a_clean,
-                        source_type='file',
-                        source_name=training_file.original_filename
-                    )
-                    db.session.add(training_data)
-                    data_count += 1
+            if replace_source:
+                report = reingest_source(
+                    training_file.user_id, training_file.original_filename, parse_training_text(content)
+                )
+                report['mode'] = 'reingest'
+            else:
+                deduplicator = Deduplicator(training_file.user_id, policy=policy)
+                for question, answer in parse_training_text(content):
+                    deduplicator.add(question, answer, source_type='file', source_name=training_file.original_filename)
+                report = deduplicator.report
 
+            training_file.dedupe_report = json.dumps(report, ensure_ascii=False)
             training_file.status = 'completed'
             training_file.processed_at = datetime.datetime.utcnow()
             db.session.commit()
+            mark_stale()
+            precompute.schedule()
             return True
             
         training_file.status = 'completed' # Mark as completed even if not txt for now
@@ -207,6 +232,7 @@ def process_training_file(file_id):
         return True
     except Exception as e:
         logger.error(f"Error processing training file: {str(e)}")
+        db.session.rollback()
         training_file.status = 'failed'
         db.session.commit()
         return False
@@ -239,6 +265,8 @@ def delete_training_data(data_id):
     try:
         db.session.delete(training_data)
         db.session.commit()
+        mark_stale()
+        stats_cache.discard(('dashboard', current_user.id))
         return jsonify({'success': True})
     except Exception as e:
         logger.error(f"Error deleting training data: {str(e)}")
@@ -264,6 +292,8 @@ def update_training_data(data_id):
     
     try:
         db.session.commit()
+        mark_stale()
+        precompute.schedule()
         return jsonify({
             'id': training_data.id,
             'question': training_data.question,
@@ -291,7 +321,9 @@ def get_training_files():
         'file_type': file.file_type,
         'status': file.status,
         'created_at': file.created_at.isoformat(),
-        'processed_at': file.processed_at.isoformat() if file.processed_at else None
+        'processed_at': file.processed_at.isoformat() if file.processed_at else None,
+        'dedupe': json.loads(file.dedupe_report) if file.dedupe_report else None,
+        'duplicate_of': file.duplicate_of_id
     } for file in training_files]
     
     return jsonify(result)
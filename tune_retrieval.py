@@ -0,0 +1,159 @@
+"""
+Tune the retrieval confidence thresholds against the labeled eval set.
+
+Each line of the eval file is {"query": ..., "expected": <KB question or null>};
+null marks questions the knowledge base cannot answer. The KB is parsed from a
+training file the same way uploads are, so no database is needed:
+
+    python tune_retrieval.py
+    python tune_retrieval.py --kb alhabib_medical_data.txt --eval eval/retrieval_eval.jsonl --precision 0.95
+
+For every candidate direct threshold the report shows the share of questions
+answered without an LLM call and how many of those direct answers were right;
+the recommended values go into RETRIEVAL_DIRECT_THRESHOLD and
+RETRIEVAL_MIN_THRESHOLD.
+"""
+import os
+import sys
+import json
+import argparse
+import tempfile
+import datetime
+
+from arabic_text import token_string, normalize
+from knowledge_index import Entry, KnowledgeIndex
+from training import parse_training_text
+import retrieval
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_kb(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        pairs = parse_training_text(f.read())
+    index = KnowledgeIndex()
+    stamp = datetime.datetime(2024, 1, 1)
+    for entry_id, (question, answer) in enumerate(pairs, start=1):
+        index.add(Entry(entry_id, 1, question, answer, token_string(question), token_string(answer), stamp))
+    index.fingerprint = ('file', path, len(pairs))
+    return index
+
+
+def load_eval(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def score_queries(index, cases, vectors=None):
+    """Per case: (top confidence, rank of the expected entry or None, answerable)."""
+    by_question = {normalize(e.question): e.id for e in index.entries()}
+    reranker = retrieval.get_reranker(vectors)
+    results = []
+    for case in cases:
+        expected = case.get('expected')
+        expected_id = by_question.get(normalize(expected)) if expected else None
+        if expected and expected_id is None:
+            raise SystemExit(f"Expected question not in the KB: {expected}")
+        candidates = retrieval.retrieve(case['query'], index, vectors, reranker=reranker)
+        ids = [c.entry.id for c in candidates]
+        rank = ids.index(expected_id) if expected_id in ids else None
+        confidence = candidates[0].confidence if candidates else 0.0
+        results.append((confidence, rank, expected_id is not None, case['query']))
+    return results
+
+
+def evaluate(results, direct_threshold, min_threshold):
+    total = len(results)
+    direct = correct_direct = answerable = grounded_hits = unanswerable = false_direct = 0
+    for confidence, rank, is_answerable, _ in results:
+        answerable += is_answerable
+        unanswerable += not is_answerable
+        if confidence >= direct_threshold:
+            direct += 1
+            correct_direct += rank == 0
+            false_direct += not is_answerable
+            grounded_hits += rank == 0
+        elif confidence >= min_threshold and rank is not None and rank < retrieval.GROUNDING_CANDIDATES:
+            grounded_hits += 1
+    return {
+        'llm_avoided': direct / total if total else 0.0,
+        'direct_precision': correct_direct / direct if direct else 1.0,
+        'answerable_recall': grounded_hits / answerable if answerable else 1.0,
+        'false_direct': false_direct,
+        'unanswerable': unanswerable,
+    }
+
+
+def _thresholds(step):
+    count = int(round(1 / step))
+    return [round(i * step, 4) for i in range(count + 1)]
+
+
+def tune(results, precision, recall_loss, step=0.01):
+    """(direct, min) thresholds: most LLM calls avoided at the precision target,
+    highest min threshold that loses at most ``recall_loss`` of the reachable recall."""
+    grid = _thresholds(step)
+    direct_threshold = 1.0
+    # Lowest threshold whose direct answers (and those of every higher threshold) meet the target
+    for t in reversed(grid):
+        if evaluate(results, t, 0.0)['direct_precision'] < precision:
+            break
+        direct_threshold = t
+    target = evaluate(results, direct_threshold, 0.0)['answerable_recall'] - recall_loss
+    min_threshold = 0.0
+    for t in grid:
+        if t > direct_threshold or evaluate(results, direct_threshold, t)['answerable_recall'] < target - 1e-9:
+            break
+        min_threshold = t
+    return direct_threshold, min_threshold
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--kb", default=os.path.join(ROOT, "alhabib_medical_data.txt"))
+    parser.add_argument("--eval", default=os.path.join(ROOT, "eval", "retrieval_eval.jsonl"))
+    parser.add_argument("--precision", type=float, default=1.0, help="required precision of direct answers")
+    parser.add_argument("--recall-loss", type=float, default=0.05,
+                        help="share of answerable questions the min threshold may cut off from the LLM")
+    parser.add_argument("--no-vectors", action="store_true", help="lexical candidates only")
+    parser.add_argument("--verbose", action="store_true", help="list every query with its confidence")
+    args = parser.parse_args(argv)
+
+    index = load_kb(args.kb)
+    cases = load_eval(args.eval)
+    vectors = None
+    if not args.no_vectors:
+        from vector_index import VectorIndex
+        vectors = VectorIndex(folder=tempfile.mkdtemp(prefix="tune_vectors_"))
+        vectors.sync(index)
+
+    results = score_queries(index, cases, vectors)
+    answerable = sum(1 for r in results if r[2])
+    print(f"KB pairs: {len(index)}   eval queries: {len(results)} ({answerable} answerable)")
+
+    if args.verbose:
+        for confidence, rank, is_answerable, query in sorted(results, reverse=True):
+            label = f"rank {rank}" if rank is not None else ("MISSING" if is_answerable else "no answer")
+            print(f"  {confidence:6.3f}  {label:<10} {query}")
+
+    direct_threshold, min_threshold = tune(results, args.precision, args.recall_loss)
+    print(f"\n{'direct >=':>10}{'LLM avoided':>13}{'precision':>11}{'recall':>9}{'false direct':>14}")
+    for t in _thresholds(0.05):
+        if t < 0.3:
+            continue
+        m = evaluate(results, t, min(min_threshold, t))
+        print(f"{t:>10.2f}{m['llm_avoided']:>12.1%}{m['direct_precision']:>11.1%}"
+              f"{m['answerable_recall']:>9.1%}{m['false_direct']:>9}/{m['unanswerable']}")
+
+    chosen = evaluate(results, direct_threshold, min_threshold)
+    current = evaluate(results, retrieval.DIRECT_THRESHOLD, retrieval.MIN_THRESHOLD)
+    print(f"\nRecommended: RETRIEVAL_DIRECT_THRESHOLD={direct_threshold:.2f} RETRIEVAL_MIN_THRESHOLD={min_threshold:.2f}")
+    print(f"  LLM calls avoided {chosen['llm_avoided']:.1%}, direct precision {chosen['direct_precision']:.1%}, "
+          f"answerable recall {chosen['answerable_recall']:.1%}")
+    print(f"Current ({retrieval.DIRECT_THRESHOLD:.2f}/{retrieval.MIN_THRESHOLD:.2f}): "
+          f"LLM calls avoided {current['llm_avoided']:.1%}, direct precision {current['direct_precision']:.1%}, "
+          f"answerable recall {current['answerable_recall']:.1%}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
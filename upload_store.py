@@ -0,0 +1,146 @@
+"""
+Content-addressed storage for uploaded training files.
+
+Uploads are stored once per distinct content under
+``UPLOAD_FOLDER/<first two hex digits>/<sha256>``. The hash is computed while
+the upload is streamed to disk in chunks, so identical files are detected
+without reading them twice or holding them in memory. TrainingFile.filename
+holds the path relative to UPLOAD_FOLDER and TrainingFile.content_hash the
+digest.
+
+collect_garbage() (run by gc_uploads.py) deletes stored files that no
+TrainingFile references any more, abandoned partial uploads and, when
+UPLOAD_RETENTION_DAYS is set, the raw copies of files processed long ago.
+"""
+import os
+import time
+import uuid
+import logging
+import datetime
+from hashlib import sha256
+from database import db
+from models import TrainingFile
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+# Files younger than this are never collected, so in-flight uploads are safe
+GC_GRACE_SECONDS = int(os.environ.get("UPLOAD_GC_GRACE_SECONDS", "3600"))
+# Raw uploads processed more than this many days ago are deleted (0 = keep forever)
+RETENTION_DAYS = int(os.environ.get("UPLOAD_RETENTION_DAYS", "0"))
+_INCOMING_PREFIX = ".incoming-"
+
+
+def relative_path(content_hash):
+    return f"{content_hash[:2]}/{content_hash}"
+
+
+def save_stream(stream, upload_dir):
+    """
+    Copy ``stream`` into the store. Returns (content_hash, size, relative path).
+
+    The data is hashed while it is written to a temporary file, which is then
+    renamed into place, or discarded when the same content is already stored.
+    """
+    os.makedirs(upload_dir, exist_ok=True)
+    tmp_path = os.path.join(upload_dir, f"{_INCOMING_PREFIX}{uuid.uuid4().hex}")
+    digest = sha256()
+    size = 0
+    try:
+        with open(tmp_path, 'wb') as out:
+            for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+        content_hash = digest.hexdigest()
+        relative = relative_path(content_hash)
+        final_path = os.path.join(upload_dir, relative)
+        if os.path.exists(final_path):
+            os.remove(tmp_path)
+            # Restart the GC grace period: the new reference is not committed yet
+            os.utime(final_path)
+        else:
+            os.makedirs(os.path.dirname(final_path), exist_ok=True)
+            os.replace(tmp_path, final_path)
+        return content_hash, size, relative
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def find_processed(user_id, content_hash):
+    """The first successfully processed file of ``user_id`` with this content, if any."""
+    return TrainingFile.query.filter_by(
+        user_id=user_id, content_hash=content_hash, status='completed'
+    ).order_by(TrainingFile.id).first()
+
+
+def adopt_legacy_files(upload_dir):
+    """Move files stored under random names into the content-addressed layout."""
+    adopted = 0
+    for training_file in TrainingFile.query.filter(TrainingFile.content_hash.is_(None)):
+        path = os.path.join(upload_dir, training_file.filename)
+        if not os.path.isfile(path):
+            continue
+        with open(path, 'rb') as f:
+            content_hash, _, relative = save_stream(f, upload_dir)
+        training_file.filename = relative
+        training_file.content_hash = content_hash
+        adopted += 1
+    db.session.commit()
+    return adopted
+
+
+def _stored_files(upload_dir):
+    for dir_path, _, file_names in os.walk(upload_dir):
+        for file_name in file_names:
+            path = os.path.join(dir_path, file_name)
+            yield os.path.relpath(path, upload_dir).replace(os.sep, '/'), path
+
+
+def collect_garbage(upload_dir, grace_seconds=GC_GRACE_SECONDS, retention_days=RETENTION_DAYS, dry_run=False):
+    """Delete unreferenced, abandoned and expired upload files. Returns a summary dict."""
+    report = {'adopted': 0, 'orphaned': 0, 'incomplete': 0, 'expired': 0, 'bytes_freed': 0}
+    if not os.path.isdir(upload_dir):
+        return report
+    if not dry_run:
+        report['adopted'] = adopt_legacy_files(upload_dir)
+
+    referenced = {name for (name,) in db.session.query(TrainingFile.filename).distinct()}
+    expired = set()
+    if retention_days > 0:
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=retention_days)
+        # A stored file expires only when every file record using it was processed before the cutoff
+        recent = {name for (name,) in db.session.query(TrainingFile.filename).filter(
+            (TrainingFile.processed_at.is_(None)) | (TrainingFile.processed_at >= cutoff)
+        ).distinct()}
+        expired = referenced - recent
+
+    now = time.time()
+    for relative, path in _stored_files(upload_dir):
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        if now - st.st_mtime < grace_seconds:
+            continue
+        if os.path.basename(relative).startswith(_INCOMING_PREFIX):
+            reason = 'incomplete'
+        elif relative not in referenced:
+            reason = 'orphaned'
+        elif relative in expired:
+            reason = 'expired'
+        else:
+            continue
+        report[reason] += 1
+        report['bytes_freed'] += st.st_size
+        if not dry_run:
+            os.remove(path)
+            logger.info(f"Removed {reason} upload {relative}")
+
+    if not dry_run:
+        for dir_path, dir_names, file_names in os.walk(upload_dir, topdown=False):
+            if dir_path != upload_dir and not os.listdir(dir_path):
+                os.rmdir(dir_path)
+    return report
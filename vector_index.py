@@ -0,0 +1,437 @@
+"""
+Dense retrieval over TrainingData, computed locally.
+
+Each pair is embedded either with a small CPU sentence-embedding model (when
+EMBEDDING_MODEL names one and sentence-transformers is installed) or with
+hashed character n-gram vectors, which need nothing beyond NumPy. Vectors
+live in a memory-mapped float32 or int8 matrix under INDEX_FOLDER. Small
+indexes are searched exhaustively; larger ones use an IVF (inverted file)
+layout built with spherical k-means, so a query only scores a few clusters.
+Each owner's knowledge index has its own vector files (INDEX_FOLDER/owner-<id>).
+"""
+import fcntl
+import json
+import logging
+import os
+import threading
+import zlib
+from contextlib import contextmanager
+import numpy as np
+from arabic_text import normalize
+from knowledge_index import on_evict
+
+logger = logging.getLogger(__name__)
+
+VECTOR_SEARCH = os.environ.get("VECTOR_SEARCH", "1") == "1"
+EMBEDDING_MODEL = os.environ.get("EMBEDDING_MODEL", "")
+EMBEDDING_DIM = int(os.environ.get("EMBEDDING_DIM", "256"))
+VECTOR_DTYPE = os.environ.get("VECTOR_DTYPE", "float32")  # 'float32' or 'int8'
+INDEX_FOLDER = os.environ.get("INDEX_FOLDER") or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "instance", "index"
+)
+# Below this many vectors the whole matrix is scored; above it IVF is used
+IVF_MIN_VECTORS = 4096
+IVF_NPROBE = 8
+# Question similarity matters more than answer similarity
+QUESTION_WEIGHT = 2.0
+
+
+class HashingEmbedder:
+    """Signed feature hashing of character 2-4 grams of the normalized text."""
+
+    name = "hashing"
+
+    def __init__(self, dim=EMBEDDING_DIM, ngram_range=(2, 4)):
+        self.dim = dim
+        self.ngram_range = ngram_range
+
+    def _features(self, text):
+        text = f" {normalize(text)} "
+        low, high = self.ngram_range
+        for n in range(low, high + 1):
+            for i in range(len(text) - n + 1):
+                yield zlib.crc32(text[i:i + n].encode("utf-8"))
+
+    def embed(self, texts):
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            hashes = np.fromiter(self._features(text), dtype=np.uint32)
+            if not len(hashes):
+                continue
+            signs = np.where(hashes & 0x80000000, -1.0, 1.0).astype(np.float32)
+            np.add.at(matrix[row], (hashes % self.dim).astype(np.intp), signs)
+        return _l2_normalize(matrix)
+
+
+class ModelEmbedder:
+    """A sentence-transformers model run on CPU."""
+
+    def __init__(self, model_name):
+        from sentence_transformers import SentenceTransformer
+        self.name = model_name
+        self.model = SentenceTransformer(model_name, device="cpu")
+        self.dim = self.model.get_sentence_embedding_dimension()
+
+    def embed(self, texts):
+        vectors = self.model.encode(list(texts), batch_size=64, normalize_embeddings=True, show_progress_bar=False)
+        return np.asarray(vectors, dtype=np.float32)
+
+
+def get_embedder():
+    if EMBEDDING_MODEL:
+        try:
+            return ModelEmbedder(EMBEDDING_MODEL)
+        except Exception as e:
+            logger.warning(f"Embedding model {EMBEDDING_MODEL} unavailable ({e}); using hashed n-grams")
+    return HashingEmbedder()
+
+
+def _l2_normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def _stamp(updated_at):
+    return updated_at.timestamp() if updated_at is not None else 0.0
+
+
+class IVFLayout:
+    """
+    Inverted-file layout: centroids plus, for each cluster, a contiguous row
+    range [offsets[c], offsets[c + 1]) of the (repacked) matrix. Rows written
+    after the last repack are tracked per cluster in ``extra``.
+    """
+
+    def __init__(self, centroids, offsets):
+        self.centroids = centroids
+        self.offsets = offsets
+        self.packed = int(offsets[-1])
+        self.extra = {}
+
+    @staticmethod
+    def kmeans(vectors, iterations=8, seed=0):
+        """Spherical k-means with k = sqrt(n); returns (centroids, assignments)."""
+        n = len(vectors)
+        k = max(1, int(np.sqrt(n)))
+        rng = np.random.default_rng(seed)
+        sample = vectors[rng.choice(n, size=min(n, 50 * k), replace=False)]
+        centroids = sample[rng.choice(len(sample), size=k, replace=False)].copy()
+        for _ in range(iterations):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            empty = ~sums.any(axis=1)
+            sums[empty] = centroids[empty]
+            centroids = _l2_normalize(sums)
+        return centroids, _assign(vectors, centroids)
+
+    def add(self, slots, vectors):
+        for slot, cluster in zip(slots, _assign(vectors, self.centroids)):
+            self.extra.setdefault(int(cluster), []).append(int(slot))
+
+    @property
+    def extra_count(self):
+        return sum(len(slots) for slots in self.extra.values())
+
+    def probe(self, query, nprobe=IVF_NPROBE):
+        """Row ranges and extra slots of the clusters closest to ``query``."""
+        clusters = np.argsort(-(self.centroids @ query))[:nprobe]
+        ranges = [(int(self.offsets[c]), int(self.offsets[c + 1])) for c in clusters]
+        extra = [slot for c in clusters for slot in self.extra.get(int(c), ())]
+        return ranges, np.asarray(extra, dtype=np.int64)
+
+
+def _assign(vectors, centroids, chunk=8192):
+    if not len(vectors):
+        return np.empty(0, dtype=np.int64)
+    return np.concatenate([
+        np.argmax(vectors[start:start + chunk] @ centroids.T, axis=1)
+        for start in range(0, len(vectors), chunk)
+    ])
+
+
+class VectorIndex:
+    """
+    Memory-mapped matrix of pair embeddings, kept in step with a KnowledgeIndex.
+
+    Row ``slot`` of the matrix belongs to training row ``ids[slot]`` (-1 = free).
+    A sidecar JSON file records ids, update stamps and the IVF offsets, so
+    other processes and restarts reuse the vectors on disk; a lock file
+    serializes writers. Written rows are never changed: changed pairs are
+    appended, and the matrix is periodically repacked into a new file that
+    replaces the old one (with IVF, so every cluster is one contiguous
+    slice that can be scored without gathering rows).
+    """
+
+    def __init__(self, embedder=None, folder=INDEX_FOLDER, dtype=VECTOR_DTYPE):
+        self.embedder = embedder or get_embedder()
+        self.dtype = np.dtype(dtype)
+        self.dim = self.embedder.dim
+        os.makedirs(folder, exist_ok=True)
+        base = os.path.join(folder, f"vectors-{self.embedder.name.replace('/', '_')}-{self.dim}-{self.dtype.name}")
+        self.matrix_path = base + ".mat"
+        self.centroids_path = base + ".centroids.npy"
+        self.meta_path = base + ".json"
+        self.lock_path = base + ".lock"
+        self.matrix = None
+        self.ids = np.empty(0, dtype=np.int64)
+        self.stamps = np.empty(0, dtype=np.float64)
+        self.slots = {}
+        self.high_water = 0
+        self.version = 0
+        self.synced_fingerprint = None
+        self.ivf = None
+        self._lock = threading.Lock()
+        self._load()
+
+    def __len__(self):
+        return len(self.slots)
+
+    @contextmanager
+    def _file_lock(self):
+        with open(self.lock_path, "a") as handle:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(handle, fcntl.LOCK_UN)
+
+    def _read_meta(self):
+        try:
+            with open(self.meta_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _load(self):
+        meta = self._read_meta()
+        if not meta or not os.path.exists(self.matrix_path):
+            return
+        self.version = meta["version"]
+        self.high_water = meta["high_water"]
+        self.ids = np.asarray(meta["ids"], dtype=np.int64)
+        self.stamps = np.asarray(meta["stamps"], dtype=np.float64)
+        self.matrix = np.memmap(self.matrix_path, dtype=self.dtype, mode="r+", shape=(len(self.ids), self.dim))
+        self.slots = {int(i): slot for slot, i in enumerate(self.ids) if i >= 0}
+        self.ivf = None
+        if meta.get("ivf_offsets"):
+            self.ivf = IVFLayout(np.load(self.centroids_path), np.asarray(meta["ivf_offsets"], dtype=np.int64))
+            appended = np.arange(self.ivf.packed, self.high_water)
+            appended = appended[self.ids[appended] >= 0]
+            self.ivf.add(appended, self._rows(appended))
+
+    def _save_meta(self):
+        self.version += 1
+        meta = {
+            "version": self.version,
+            "high_water": self.high_water,
+            "ids": self.ids.tolist(),
+            "stamps": self.stamps.tolist(),
+            "ivf_offsets": self.ivf.offsets.tolist() if self.ivf is not None else None,
+        }
+        tmp_path = self.meta_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self.meta_path)
+
+    def _ensure_capacity(self, size):
+        capacity = len(self.ids)
+        if size <= capacity:
+            return
+        new_capacity = max(1024, capacity * 2, size)
+        if self.matrix is not None:
+            self.matrix.flush()
+            del self.matrix
+        with open(self.matrix_path, "ab") as f:
+            f.truncate(new_capacity * self.dim * self.dtype.itemsize)
+        self.matrix = np.memmap(self.matrix_path, dtype=self.dtype, mode="r+", shape=(new_capacity, self.dim))
+        self.ids = np.concatenate([self.ids, np.full(new_capacity - capacity, -1, dtype=np.int64)])
+        self.stamps = np.concatenate([self.stamps, np.zeros(new_capacity - capacity)])
+
+    def _encode(self, vectors):
+        if self.dtype == np.int8:
+            return np.clip(np.rint(vectors * 127), -127, 127).astype(np.int8)
+        return vectors.astype(self.dtype)
+
+    def _decode(self, rows):
+        if self.dtype == np.int8:
+            return rows.astype(np.float32) / 127.0
+        return np.asarray(rows)
+
+    def _rows(self, slots):
+        return self._decode(self.matrix[slots])
+
+    def stored_rows(self, entry_ids):
+        """Stored (encoded) vectors of ``entry_ids``, in that order."""
+        with self._lock:
+            if not entry_ids:
+                return np.empty((0, self.dim), dtype=self.dtype)
+            return np.asarray(self.matrix[[self.slots[i] for i in entry_ids]])
+
+    def embed_entries(self, entries):
+        questions = self.embedder.embed([e.question for e in entries])
+        answers = self.embedder.embed([e.answer for e in entries])
+        return _l2_normalize(QUESTION_WEIGHT * questions + answers)
+
+    def sync(self, knowledge_index, batch_size=256):
+        """Embed added/edited pairs and free removed ones. Returns rows embedded."""
+        with self._lock, self._file_lock():
+            meta = self._read_meta()
+            if meta and meta["version"] != self.version:
+                self._load()
+
+            current = knowledge_index.stamps()
+            changed = [
+                entry_id for entry_id, updated_at in current.items()
+                if entry_id not in self.slots or self.stamps[self.slots[entry_id]] != _stamp(updated_at)
+            ]
+            removed = [entry_id for entry_id in self.slots if entry_id not in current]
+            if not changed and not removed:
+                self.synced_fingerprint = knowledge_index.fingerprint
+                return 0
+
+            for entry_id in removed:
+                self.ids[self.slots.pop(entry_id)] = -1
+
+            # Every change is appended, never written over a row another process
+            # may still be reading; repacking into a new file reclaims the space
+            new_slots = []
+            for entry_id in changed:
+                slot = self.slots.get(entry_id)
+                if slot is not None:
+                    self.ids[slot] = -1
+                new_slots.append(self.high_water)
+                self.high_water += 1
+            self._ensure_capacity(self.high_water)
+
+            for start in range(0, len(changed), batch_size):
+                batch_ids = changed[start:start + batch_size]
+                batch_slots = new_slots[start:start + batch_size]
+                entries = [knowledge_index.get(i) for i in batch_ids]
+                vectors = self.embed_entries(entries)
+                self.matrix[batch_slots] = self._encode(vectors)
+                if self.ivf is not None:
+                    self.ivf.add(batch_slots, vectors)
+                for entry_id, slot, entry in zip(batch_ids, batch_slots, entries):
+                    self.ids[slot] = entry_id
+                    self.stamps[slot] = _stamp(entry.updated_at)
+                    self.slots[entry_id] = slot
+
+            if self._needs_repack():
+                self._repack()
+            self.matrix.flush()
+            self._save_meta()
+            self.synced_fingerprint = knowledge_index.fingerprint
+            logger.info(f"Vector index synced: {len(changed)} embedded, {len(removed)} removed, {len(self)} total")
+            return len(changed)
+
+    def _needs_repack(self):
+        size = len(self.slots)
+        garbage = self.high_water - size
+        if self.ivf is None:
+            return size >= IVF_MIN_VECTORS or garbage > max(size // 2, 1024)
+        if size < IVF_MIN_VECTORS // 2:
+            return True
+        return self.ivf.extra_count + garbage > max(size // 2, 1024)
+
+    def _repack(self):
+        """Retrain IVF and rewrite the matrix so each cluster is contiguous."""
+        live = np.flatnonzero(self.ids[:self.high_water] >= 0)
+        size = len(live)
+        ids, stamps = self.ids[live], self.stamps[live]
+        tmp_path = self.matrix_path + ".tmp"
+
+        if size >= IVF_MIN_VECTORS:
+            vectors = self._rows(live)
+            centroids, assignments = IVFLayout.kmeans(vectors)
+            order = np.argsort(assignments, kind="stable")
+            counts = np.bincount(assignments, minlength=len(centroids))
+            offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+            live, ids, stamps = live[order], ids[order], stamps[order]
+            np.save(self.centroids_path, centroids)
+        else:
+            centroids = offsets = None
+
+        capacity = max(1024, 2 * size)
+        packed = np.memmap(tmp_path, dtype=self.dtype, mode="w+", shape=(capacity, self.dim))
+        for start in range(0, size, 8192):
+            chunk = live[start:start + 8192]
+            packed[start:start + len(chunk)] = self.matrix[chunk]
+        packed.flush()
+        del packed, self.matrix
+        os.replace(tmp_path, self.matrix_path)
+
+        self.matrix = np.memmap(self.matrix_path, dtype=self.dtype, mode="r+", shape=(capacity, self.dim))
+        self.ids = np.concatenate([ids, np.full(capacity - size, -1, dtype=np.int64)])
+        self.stamps = np.concatenate([stamps, np.zeros(capacity - size)])
+        self.slots = {int(i): slot for slot, i in enumerate(ids)}
+        self.high_water = size
+        self.ivf = IVFLayout(centroids, offsets) if centroids is not None else None
+        logger.info(f"Vector index repacked: {size} rows, {len(centroids) if centroids is not None else 0} clusters")
+
+    def search(self, query, limit=10):
+        """Return [(entry_id, cosine)] best first."""
+        q = self.embedder.embed([query])[0]
+        with self._lock:
+            if not self.slots:
+                return []
+            if self.ivf is None:
+                ranges, extra = [(0, self.high_water)], np.empty(0, dtype=np.int64)
+            else:
+                ranges, extra = self.ivf.probe(q)
+
+            slot_parts, score_parts = [], []
+            for start, end in ranges:
+                if end > start:
+                    slot_parts.append(np.arange(start, end))
+                    score_parts.append(self._decode(self.matrix[start:end]) @ q)
+            if len(extra):
+                slot_parts.append(extra)
+                score_parts.append(self._rows(extra) @ q)
+            if not slot_parts:
+                return []
+
+            slots = np.concatenate(slot_parts)
+            ids = self.ids[slots]
+            scores = np.where(ids >= 0, np.concatenate(score_parts), -np.inf)
+            k = min(limit, len(scores))
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            return [(int(ids[i]), float(scores[i])) for i in top if ids[i] >= 0]
+
+
+_vector_indexes = {}  # owner -> VectorIndex
+_init_lock = threading.Lock()
+
+
+def owner_folder(owner, folder=INDEX_FOLDER):
+    # The index of every owner's rows keeps the original location
+    return folder if owner is None else os.path.join(folder, f"owner-{owner}")
+
+
+def get_vector_index(knowledge_index):
+    """The vector index of ``knowledge_index``'s owner, synced with it (None if disabled)."""
+    if not VECTOR_SEARCH:
+        return None
+    from kb_snapshot import Snapshot
+    if isinstance(knowledge_index, Snapshot):
+        # Written into the snapshot file along with the postings
+        return knowledge_index.vectors
+    owner = knowledge_index.owner
+    with _init_lock:
+        vector_index = _vector_indexes.get(owner)
+        if vector_index is None:
+            vector_index = _vector_indexes[owner] = VectorIndex(folder=owner_folder(owner))
+    if vector_index.synced_fingerprint != knowledge_index.fingerprint:
+        vector_index.sync(knowledge_index)
+    return vector_index
+
+
+def _release(owner, knowledge_index):
+    # The files stay on disk; the next load maps them again without re-embedding
+    with _init_lock:
+        _vector_indexes.pop(owner, None)
+
+
+on_evict(_release)